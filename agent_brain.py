@@ -1,14 +1,26 @@
 import os
+import re
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
-from typing import List, Dict, Any, TypedDict
+from typing import Annotated, List, Dict, Any, Optional, Tuple, TypedDict
 from langgraph.graph import StateGraph, END
-from langchain_core.messages import HumanMessage, AIMessage
+from langgraph.graph.message import REMOVE_ALL_MESSAGES, add_messages
+from langchain_core.messages import HumanMessage, AIMessage, RemoveMessage
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+import numpy as np
 
 # --- IMPORTAR GESTORES ---
 from rag_manager import get_rag_manager
 from metadata_handler import MetadataHandler
 from memory_manager import get_memory_manager
+from query_gate import StandaloneQueryGate
+from context_builder import build_context
+from reranker import get_reranker
+from answer_cache import get_answer_cache
+from persistent_cache import text_hash
 
 load_dotenv()
 
@@ -24,31 +36,68 @@ llm = ChatGoogleGenerativeAI(
 # --- ESTADO DEL AGENTE ---
 class AgentState(TypedDict):
     input: str 
-    chat_history: List[Any]
+    # Reductor add_messages: los nodos devuelven solo los mensajes nuevos y el
+    # checkpointer guarda cada mensaje una vez (historial como deltas)
+    chat_history: Annotated[List[Any], add_messages]
     context: str 
     search_query: str 
+    sources: str  # Bloque "FUENTES CONSULTADAS" (se envía aparte en /chat/stream)
+    conversation_summary: str  # Resumen de los turnos que ya salieron de chat_history
+    answer_cached: bool  # La respuesta de este turno salió de la caché (sin llamar al LLM)
 
 # --- NODOS DEL GRAFO ---
+# Cada nodo tiene versión síncrona (app.invoke) y asíncrona (app.ainvoke).
+# Ambas comparten la construcción de prompts y el post-procesado.
 
-# NODO 1: Contextualizador (Reescribir la pregunta)
-def contextualize_query(state: AgentState) -> Dict[str, Any]:
-    """
-    Reescribe la consulta del usuario si depende del historial.
-    Ej: "¿Quiénes son sus tutores?" -> "¿Quiénes son los tutores de David Torres?"
-    """
-    user_input = state["input"]
-    chat_history = state["chat_history"]
+RETRIEVAL_K = 25
+# Con búsqueda híbrida (BM25 + vectores) los nombres exactos aparecen arriba
+# del ranking: basta un k mucho menor (menos tokens para Gemma)
+HYBRID_RETRIEVAL_K = 10
 
-    if not chat_history:
-        return {"search_query": user_input}
+# Preguntas por datos de portada (tutores, autor, título): se busca SOLO en las
+# primeras páginas de cada documento (filtro de metadatos dentro de la búsqueda)
+COVER_PAGE_FILTER = {"pages": (0, 1)}  # Páginas 0-based: portada y la siguiente
+COVER_QUESTION_PATTERN = re.compile(
+    r"\b(tutor(?:a|es|as)?|autor(?:a|es|as)?|director(?:a|es)?|"
+    r"t[ií]tulo d(?:e la tesis|el trabajo|el documento))\b",
+    re.IGNORECASE
+)
 
-    # Prompt para reescritura
+# Búsqueda especulativa: mientras el LLM reescribe la pregunta, se busca con la
+# pregunta original. Si la reescritura es casi idéntica en el espacio de embeddings,
+# el nodo de búsqueda reutiliza ese resultado y no vuelve a buscar.
+SPECULATIVE_RETRIEVAL = {
+    "enabled": True,
+    "similarity_threshold": 0.9   # Coseno mínimo (original vs reescrita) para aceptar
+}
+
+# Historial acotado: chat_history conserva solo los últimos turnos literales y los
+# anteriores se resumen en conversation_summary. El resumen se rehace cada
+# fold_every turnos (una llamada al LLM por bloque, no por turno).
+HISTORY_CONFIG = {
+    "raw_turns": 4,             # Turnos (pregunta + respuesta) que quedan literales tras resumir
+    "fold_every": 4,            # Turnos acumulados por encima de raw_turns antes de resumir
+    "summary_max_chars": 1500,  # Tamaño máximo del resumen guardado en el estado
+    "message_max_chars": 600    # Recorte de cada mensaje en el prompt de resumen
+}
+
+NO_RESULTS_CONTEXT = "[SIN RESULTADOS]"
+NO_RESULTS_ANSWER = "La información solicitada no se encuentra en los documentos proporcionados."
+ERROR_ANSWER = "Lo siento, hubo un error al procesar la respuesta."
+
+
+def _build_rewrite_prompt(user_input: str, chat_history: List[Any], summary: str = "") -> str:
+    """Construye el prompt de reescritura a partir del resumen y los últimos turnos."""
     history_str = "\n".join([f"{'User' if isinstance(m, HumanMessage) else 'AI'}: {m.content}" for m in chat_history[-4:]])
+    summary_str = f"""
+    RESUMEN DE LA CONVERSACIÓN ANTERIOR:
+    {summary}
+    """ if summary else ""
     
-    prompt_rewrite = f"""
+    return f"""
     Eres una herramienta de reformulación de búsqueda.
     Tu trabajo es reescribir la "PREGUNTA ACTUAL" para que sea totalmente independiente, basándote en el HISTORIAL.
-    
+    {summary_str}
     HISTORIAL:
     {history_str}
     
@@ -57,57 +106,230 @@ def contextualize_query(state: AgentState) -> Dict[str, Any]:
     
     PREGUNTA REESCRITA (Solo el texto):
     """
+
+
+# Filtro local: si la pregunta ya es independiente no se llama al LLM de reescritura.
+# La similitud usa los embeddings memorizados del RAGManager (la búsqueda reutiliza el vector).
+query_gate = StandaloneQueryGate(embed_fn=lambda texts: get_rag_manager().embed_queries(texts))
+
+
+def _needs_rewrite(user_input: str, chat_history: List[Any]) -> bool:
+    """
+    Consulta el filtro. Se evalúa DENTRO del nodo (y no como arista condicional)
+    porque search_query persiste en el checkpoint: saltar el nodo dejaría la
+    búsqueda con la consulta del turno anterior.
+    """
+    if not chat_history:
+        return False
+    try:
+        needs_rewrite, reason = query_gate.needs_rewrite(user_input, chat_history)
+    except Exception as e:
+        print(f"⚠️ [GATE] Error en el filtro ({e}), se reescribe")
+        return True
+    if not needs_rewrite:
+        print(f"⏭️  [GATE] Pregunta independiente ({reason}): se omite la reescritura")
+    return needs_rewrite
+
+
+# --- BÚSQUEDA ESPECULATIVA ---
+# thread_id -> (consulta, documentos) aceptados para el nodo de búsqueda del turno en curso.
+# Se guardan fuera del estado para no serializar Documentos en el checkpoint.
+_speculative_results: Dict[str, Tuple[str, List[Any]]] = {}
+_speculative_lock = threading.Lock()
+_speculative_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative")
+speculation_stats = {"accepted": 0, "rejected": 0, "failed": 0}
+
+
+def _reset_speculation_after_fork():
+    """Proceso hijo (servidor multi-worker): executor y lock propios."""
+    global _speculative_executor, _speculative_lock
+    _speculative_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative")
+    _speculative_lock = threading.Lock()
+    _speculative_results.clear()
+
+
+os.register_at_fork(after_in_child=_reset_speculation_after_fork)
+
+
+def _thread_id(config: Optional[RunnableConfig]) -> str:
+    """thread_id de la sesión (clave de los resultados especulativos)."""
+    return ((config or {}).get("configurable") or {}).get("thread_id", "")
+
+
+def _retrieval_k() -> int:
+    """k según el modo de búsqueda activo."""
+    return HYBRID_RETRIEVAL_K if get_rag_manager().default_search_mode() == "hybrid" else RETRIEVAL_K
+
+
+def _retrieve(query: str) -> List[Any]:
+    """Búsqueda en la base vectorial (la usan el nodo de búsqueda y la especulación)."""
+    rag_mgr = get_rag_manager()
+    if COVER_QUESTION_PATTERN.search(query):
+        docs = rag_mgr.search(query, k=_retrieval_k(), filters=COVER_PAGE_FILTER)
+        if docs:
+            print(f"📄 [FILTER] Pregunta de portada: búsqueda limitada a {COVER_PAGE_FILTER}")
+            return docs
+    return rag_mgr.search(query, k=_retrieval_k())
+
+
+def _speculation_matches(user_input: str, rewritten_query: str) -> bool:
+    """¿La reescritura es casi idéntica a la pregunta original en el espacio de embeddings?"""
+    if rewritten_query.strip() == user_input.strip():
+        return True
+    # Los dos vectores quedan memorizados: la búsqueda de la reescrita no vuelve a codificarla
+    vectors = get_rag_manager().embed_queries([user_input, rewritten_query])
+    norms = np.linalg.norm(vectors, axis=1)
+    if not norms.all():
+        return False
+    similarity = float(vectors[0] @ vectors[1] / (norms[0] * norms[1]))
+    print(f"🔮 [SPECULATIVE] similitud original/reescrita = {similarity:.3f}")
+    return similarity >= SPECULATIVE_RETRIEVAL["similarity_threshold"]
+
+
+def _count_speculation(outcome: str):
+    with _speculative_lock:
+        speculation_stats[outcome] += 1
+
+
+def _store_speculation(config: Optional[RunnableConfig], query: str, docs: List[Any]):
+    """Deja el resultado especulativo aceptado para el nodo de búsqueda."""
+    _count_speculation("accepted")
+    with _speculative_lock:
+        _speculative_results[_thread_id(config)] = (query, docs)
+
+
+def _resolve_speculation(
+    config: Optional[RunnableConfig],
+    user_input: str,
+    rewritten_query: str,
+    speculative: Future
+):
+    """
+    Decide qué hacer con la búsqueda especulativa (versión síncrona).
+    Si se descarta NO se espera a que termine: el nodo de búsqueda lanza la suya.
+    """
+    try:
+        if not _speculation_matches(user_input, rewritten_query):
+            _count_speculation("rejected")
+            return
+        _store_speculation(config, rewritten_query, speculative.result())
+    except Exception as e:
+        print(f"⚠️ [SPECULATIVE] {e}")
+        _count_speculation("failed")
+
+
+def _take_speculation(config: Optional[RunnableConfig], query: str) -> Optional[List[Any]]:
+    """Recupera (y consume) el resultado especulativo si corresponde a la consulta."""
+    with _speculative_lock:
+        entry = _speculative_results.pop(_thread_id(config), None)
+    if entry and entry[0] == query:
+        return entry[1]
+    return None
+
+
+# NODO 1: Contextualizador (Reescribir la pregunta)
+def contextualize_query(state: AgentState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """
+    Reescribe la consulta del usuario si depende del historial.
+    Ej: "¿Quiénes son sus tutores?" -> "¿Quiénes son los tutores de David Torres?"
     
+    Con SPECULATIVE_RETRIEVAL activo, la búsqueda con la pregunta original
+    corre en paralelo con la llamada al LLM.
+    """
+    user_input = state["input"]
+    chat_history = state["chat_history"]
+
+    if not _needs_rewrite(user_input, chat_history):
+        return {"search_query": user_input}
+
+    speculative = None
+    if SPECULATIVE_RETRIEVAL["enabled"]:
+        speculative = _speculative_executor.submit(_retrieve, user_input)
+
     try:
-        response = llm.invoke(prompt_rewrite)
+        response = llm.invoke(_build_rewrite_prompt(user_input, chat_history, state.get("conversation_summary", "")))
         rewritten_query = response.content.strip()
         print(f"🔄 [REWRITE] '{user_input}' -> '{rewritten_query}'")
-        return {"search_query": rewritten_query}
     except Exception:
+        rewritten_query = user_input
+
+    if speculative is not None:
+        _resolve_speculation(config, user_input, rewritten_query, speculative)
+    return {"search_query": rewritten_query}
+
+
+async def acontextualize_query(state: AgentState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """Versión asíncrona de contextualize_query (no bloquea el event loop)."""
+    user_input = state["input"]
+    chat_history = state["chat_history"]
+
+    # El filtro puede calcular embeddings (CPU): se ejecuta en un hilo
+    if not await asyncio.to_thread(_needs_rewrite, user_input, chat_history):
         return {"search_query": user_input}
 
+    speculative = None
+    if SPECULATIVE_RETRIEVAL["enabled"]:
+        speculative = _speculative_executor.submit(_retrieve, user_input)
+
+    try:
+        response = await llm.ainvoke(_build_rewrite_prompt(user_input, chat_history, state.get("conversation_summary", "")))
+        rewritten_query = response.content.strip()
+        print(f"🔄 [REWRITE] '{user_input}' -> '{rewritten_query}'")
+    except Exception:
+        rewritten_query = user_input
+
+    if speculative is not None:
+        # Comparar embeddings y, si se acepta, esperar la búsqueda: fuera del event loop
+        await asyncio.to_thread(_resolve_speculation, config, user_input, rewritten_query, speculative)
+    return {"search_query": rewritten_query}
+
 
 # NODO 2: Recuperador (Búsqueda + Ordenamiento por Página)
-def run_agent(state: AgentState) -> Dict[str, Any]:
+def run_agent(state: AgentState, config: RunnableConfig = None) -> Dict[str, Any]:
     """Busca en la BD y ordena por número de página para priorizar portadas."""
     query_to_search = state.get("search_query", state["input"])
-    rag_mgr = get_rag_manager()
     
-    # K=25: Suficiente para capturar portada y contenido, sin saturar a Gemma 4B
-    print(f"🚀 Buscando '{query_to_search}' con K=25...")
-    docs = rag_mgr.search(query_to_search, k=25)
+    docs = _take_speculation(config, query_to_search)
+    if docs is not None:
+        print(f"⚡ [SPECULATIVE] Reutilizando la búsqueda hecha durante la reescritura")
+    else:
+        # K=25 (MMR) o K=10 (híbrida): portada y contenido sin saturar a Gemma 4B
+        print(f"🚀 Buscando '{query_to_search}' con K={_retrieval_k()}...")
+        docs = _retrieve(query_to_search)
+    
+    # Reordenamiento opcional con cross-encoder: menos fragmentos y mejor ordenados
+    # (si no está listo o se pasa de su presupuesto, se usa el orden de la búsqueda)
+    reranker = get_reranker()
+    if reranker is not None and docs:
+        docs = reranker.rerank(query_to_search, docs)
     
     if not docs:
-        context = "[SIN RESULTADOS]"
+        context = NO_RESULTS_CONTEXT
+        sources_list = ""
     else:
-        # --- TRUCO MAESTRO: ORDENAR POR PÁGINA ---
-        # Ordenamos los documentos para que la Página 1, 2, 3 aparezcan PRIMERO.
-        # Esto ayuda al modelo a ver los "Datos Formales" antes que los "Agradecimientos".
-        docs.sort(key=lambda x: x.metadata.get('page', 999))
-        
-        context_text = rag_mgr.format_context(docs)
-        sources_list = MetadataHandler.format_source_list(docs)
+        # Fusiona contiguos, quita duplicados y empaqueta por relevancia hasta el
+        # presupuesto de tokens. --- TRUCO MAESTRO: ORDENAR POR PÁGINA ---
+        # El resultado se presenta con la Página 1, 2, 3 PRIMERO, para que el modelo
+        # vea los "Datos Formales" antes que los "Agradecimientos".
+        context_text, packed_docs, _ = build_context(docs)
+        sources_list = MetadataHandler.format_source_list(packed_docs)
         context = f"{context_text}\n\n{sources_list}"
     
-    return {"context": context}
+    return {"context": context, "sources": sources_list}
 
 
-# NODO 3: Generador (Auditor Estricto)
-def generate_response(state: AgentState) -> Dict[str, Any]:
-    context = state["context"]
-    input_message = state["input"] # Usamos la original para responder
-    current_chat_history = state["chat_history"]
-    
-    if context == "[SIN RESULTADOS]":
-        return {
-            "chat_history": current_chat_history + [
-                HumanMessage(content=input_message),
-                AIMessage(content="La información solicitada no se encuentra en los documentos proporcionados.")
-            ]
-        }
+async def arun_agent(state: AgentState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """
+    Versión asíncrona de run_agent.
+    La búsqueda FAISS + embeddings es CPU, así que se ejecuta en un hilo.
+    """
+    return await asyncio.to_thread(run_agent, state, config)
+
 
+def _build_answer_prompt(context: str, input_message: str) -> str:
+    """Construye el prompt del auditor con el contexto recuperado."""
     # PROMPT DISEÑADO PARA GEMMA Y DATOS ACADÉMICOS
-    system_prompt = f"""
+    return f"""
     Eres un AUDITOR DE DOCUMENTOS ACADÉMICOS. Tu única fuente de verdad es el CONTEXTO proporcionado.
     
     INSTRUCCIONES CRÍTICAS SOBRE "TUTORES" Y "AUTORES":
@@ -128,32 +350,212 @@ def generate_response(state: AgentState) -> Dict[str, Any]:
     
     RESPUESTA:
     """
+
+
+def _answer_cache_model() -> str:
+    """Modelo + hash de la plantilla del prompt (si cambia el prompt, no se reutilizan respuestas)."""
+    model = getattr(llm, "model", None) or type(llm).__name__
+    return f"{model}:{text_hash(_build_answer_prompt('{context}', '{input}'))[:12]}"
+
+
+def _answer_cache_args(state: AgentState) -> Tuple[str, str, str, str, Optional[str]]:
+    """
+    (modelo, pregunta original, consulta de búsqueda, contexto empaquetado,
+    versión del vectorstore) del turno. La pregunta original va en la clave
+    porque es la que recibe el prompt de respuesta.
+    """
+    query = state.get("search_query") or state["input"]
+    return _answer_cache_model(), state["input"], query, state["context"], get_rag_manager().index_version
+
+
+def _cached_answer(state: AgentState) -> Optional[str]:
+    """Respuesta guardada para el prompt de este turno, o None."""
+    cache = get_answer_cache()
+    if cache is None:
+        return None
+    try:
+        answer = cache.get(*_answer_cache_args(state))
+    except Exception as e:
+        print(f"⚠️ [ANSWER CACHE] Error al leer ({e}), se llama al LLM")
+        return None
+    if answer is not None:
+        print("💾 [ANSWER CACHE] Respuesta reutilizada, sin llamar al LLM")
+    return answer
+
+
+def _store_answer(state: AgentState, response_content: str):
+    """Guarda la respuesta generada (los errores del LLM no se cachean)."""
+    cache = get_answer_cache()
+    if cache is None or response_content == ERROR_ANSWER:
+        return
+    try:
+        cache.put(*_answer_cache_args(state), response_content)
+    except Exception as e:
+        print(f"⚠️ [ANSWER CACHE] Error al guardar ({e})")
+
+
+def _format_turns(messages: List[Any]) -> str:
+    """Mensajes como texto 'Usuario/Asistente: ...' (recortados) para el prompt de resumen."""
+    limit = HISTORY_CONFIG["message_max_chars"]
+    return "\n".join(
+        f"{'Usuario' if isinstance(m, HumanMessage) else 'Asistente'}: {m.content[:limit]}"
+        for m in messages
+    )
+
+
+def _build_summary_prompt(summary: str, folded: List[Any]) -> str:
+    """Construye el prompt que integra los turnos antiguos en el resumen."""
+    return f"""
+    Resume la conversación entre un usuario y un asistente que consulta tesis académicas.
+    Integra los NUEVOS TURNOS en el RESUMEN ACTUAL. Conserva nombres propios, títulos de
+    documentos, autores, tutores y los temas consultados. Máximo {HISTORY_CONFIG["summary_max_chars"]} caracteres.
+    
+    RESUMEN ACTUAL:
+    {summary or "(vacío)"}
+    
+    NUEVOS TURNOS:
+    {_format_turns(folded)}
+    
+    RESUMEN ACTUALIZADO (Solo el texto):
+    """
+
+
+def _fallback_summary(summary: str, folded: List[Any]) -> str:
+    """Resumen extractivo (sin LLM): agrega las preguntas del usuario al resumen previo."""
+    parts = [summary] if summary else []
+    parts += [f"El usuario preguntó: {m.content[:150]}" for m in folded if isinstance(m, HumanMessage)]
+    merged = "; ".join(parts)
+    # Se conserva lo más reciente si se excede el límite
+    return merged[-HISTORY_CONFIG["summary_max_chars"]:]
+
+
+def _new_turn(state: AgentState, response_content: str) -> Dict[str, Any]:
+    """Turno nuevo (pregunta original + respuesta) para el reductor add_messages."""
+    return {"chat_history": [
+        HumanMessage(content=state["input"]),
+        AIMessage(content=response_content)
+    ]}
+
+
+def _split_history(state: AgentState) -> Tuple[List[Any], List[Any]]:
+    """
+    Separa los turnos que deben pasar al resumen de los que quedan literales.
+
+    Returns:
+        Tuple: (mensajes a resumir (vacío si no toca), mensajes que quedan literales)
+    """
+    history = state["chat_history"]
+    raw_turns = HISTORY_CONFIG["raw_turns"]
+    if len(history) < 2 * (raw_turns + HISTORY_CONFIG["fold_every"]):
+        return [], history
+    cut = len(history) - 2 * raw_turns
+    return history[:cut], history[cut:]
+
+
+def _history_update(folded: List[Any], kept: List[Any], summary: str) -> Dict[str, Any]:
+    """
+    Actualización del estado para el reductor add_messages: la ventana literal
+    completa (los mensajes conservados mantienen su id, así que el
+    checkpointer no los vuelve a escribir) y el resumen nuevo.
+    """
+    print(f"🗜️  [HISTORY] {len(folded) // 2} turnos resumidos; quedan {len(kept) // 2} literales")
+    return {
+        "chat_history": [RemoveMessage(id=REMOVE_ALL_MESSAGES)] + kept,
+        "conversation_summary": summary[:HISTORY_CONFIG["summary_max_chars"]]
+    }
+
+
+def route_after_response(state: AgentState) -> str:
+    """Tras responder: resumir solo si el historial superó la ventana (cada fold_every turnos)."""
+    folded, _ = _split_history(state)
+    return "summarize" if folded else END
+
+
+# NODO 4: Resumen del historial (fuera de "respond": sus tokens no se emiten en /chat/stream)
+def summarize_history(state: AgentState) -> Dict[str, Any]:
+    """Integra en conversation_summary los turnos que salen de la ventana literal."""
+    folded, kept = _split_history(state)
+    previous = state.get("conversation_summary", "")
+    summary = None
+    try:
+        summary = llm.invoke(_build_summary_prompt(previous, folded)).content.strip()
+    except Exception as e:
+        print(f"⚠️ [HISTORY] Error al resumir ({e}), se usa el resumen extractivo")
+    return _history_update(folded, kept, summary or _fallback_summary(previous, folded))
+
+
+async def asummarize_history(state: AgentState) -> Dict[str, Any]:
+    """Versión asíncrona de summarize_history."""
+    folded, kept = _split_history(state)
+    previous = state.get("conversation_summary", "")
+    summary = None
+    try:
+        summary = (await llm.ainvoke(_build_summary_prompt(previous, folded))).content.strip()
+    except Exception as e:
+        print(f"⚠️ [HISTORY] Error al resumir ({e}), se usa el resumen extractivo")
+    return _history_update(folded, kept, summary or _fallback_summary(previous, folded))
+
+
+# NODO 3: Generador (Auditor Estricto)
+def generate_response(state: AgentState) -> Dict[str, Any]:
+    context = state["context"]
+    input_message = state["input"] # Usamos la original para responder
+    
+    if context == NO_RESULTS_CONTEXT:
+        return {**_new_turn(state, NO_RESULTS_ANSWER), "answer_cached": False}
+    
+    # Mismo modelo, consulta y contexto que un turno anterior: no se llama al LLM
+    cached = _cached_answer(state)
+    if cached is not None:
+        return {**_new_turn(state, cached), "answer_cached": True}
     
     try:
-        response = llm.invoke(system_prompt)
+        response = llm.invoke(_build_answer_prompt(context, input_message))
         response_content = response.content.strip()
     except Exception as e:
-        response_content = "Lo siento, hubo un error al procesar la respuesta."
+        response_content = ERROR_ANSWER
 
-    new_messages = [
-        HumanMessage(content=input_message),
-        AIMessage(content=response_content)
-    ]
+    _store_answer(state, response_content)
+    return {**_new_turn(state, response_content), "answer_cached": False}
+
+
+async def agenerate_response(state: AgentState) -> Dict[str, Any]:
+    """Versión asíncrona de generate_response."""
+    context = state["context"]
+    input_message = state["input"]
+    
+    if context == NO_RESULTS_CONTEXT:
+        return {**_new_turn(state, NO_RESULTS_ANSWER), "answer_cached": False}
+    
+    # SQLite en un hilo: no bloquea el event loop
+    cached = await asyncio.to_thread(_cached_answer, state)
+    if cached is not None:
+        return {**_new_turn(state, cached), "answer_cached": True}
     
-    return {"chat_history": current_chat_history + new_messages}
+    try:
+        response = await llm.ainvoke(_build_answer_prompt(context, input_message))
+        response_content = response.content.strip()
+    except Exception as e:
+        response_content = ERROR_ANSWER
+
+    await asyncio.to_thread(_store_answer, state, response_content)
+    return {**_new_turn(state, response_content), "answer_cached": False}
 
 
 # --- FLUJO DE TRABAJO (LangGraph) ---
 workflow = StateGraph(AgentState)
 
-workflow.add_node("contextualize", contextualize_query)
-workflow.add_node("search", run_agent)
-workflow.add_node("respond", generate_response)
+# RunnableLambda(func, afunc): LangGraph usa func en invoke() y afunc en ainvoke()
+workflow.add_node("contextualize", RunnableLambda(contextualize_query, afunc=acontextualize_query))
+workflow.add_node("search", RunnableLambda(run_agent, afunc=arun_agent))
+workflow.add_node("respond", RunnableLambda(generate_response, afunc=agenerate_response))
+workflow.add_node("summarize", RunnableLambda(summarize_history, afunc=asummarize_history))
 
 workflow.set_entry_point("contextualize")
 workflow.add_edge("contextualize", "search")
 workflow.add_edge("search", "respond")
-workflow.add_edge("respond", END)
+workflow.add_conditional_edges("respond", route_after_response, {"summarize": "summarize", END: END})
+workflow.add_edge("summarize", END)
 
 memory_mgr = get_memory_manager()
 saver = memory_mgr.get_saver()
@@ -169,12 +571,12 @@ if __name__ == "__main__":
     # 1. Pregunta de contexto
     msg1 = "¿De qué trata la tesis de David Torres?"
     print(f"\nUsuario: {msg1}")
-    res1 = app.invoke({"input": msg1, "chat_history": [], "context": ""}, config=config)
+    res1 = app.invoke({"input": msg1, "context": ""}, config=config)
     print(f"Agente: {res1['chat_history'][-1].content}")
     
     # 2. Pregunta de seguimiento (El problema de los tutores)
     msg2 = "¿Quiénes son sus tutores?"
     print(f"\nUsuario: {msg2}")
-    # Pasamos el historial previo
-    res2 = app.invoke({"input": msg2, "chat_history": res1['chat_history'], "context": ""}, config=config)
+    # El historial previo lo carga el checkpointer (no hace falta reenviarlo)
+    res2 = app.invoke({"input": msg2, "context": ""}, config=config)
     print(f"Agente: {res2['chat_history'][-1].content}")
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""
+answer_cache.py - Caché persistente de respuestas del LLM
+
+Este módulo encapsula:
+- AnswerCache: respuesta final de Gemma guardada en .cache/answers.db con
+  clave (modelo + plantilla del prompt, pregunta del usuario normalizada,
+  consulta de búsqueda normalizada, hash del contexto empaquetado)
+- TTL y desalojo LRU por número de entradas (SQLiteCache)
+- Invalidación al reconstruir el vectorstore: cada clave lleva como prefijo
+  la versión del índice (LocalVectorStore.version); al detectar una versión
+  nueva se borran de una vez las entradas de las anteriores
+
+Un acierto evita la llamada al LLM; /chat y /chat/stream lo indican con
+"cached": true.
+
+Objetivo: Responder al instante (y sin gastar cuota de la API) las preguntas
+que los estudiantes repiten sobre los mismos documentos.
+
+Uso:
+    python answer_cache.py           # estadísticas
+    python answer_cache.py --clear   # vaciar la caché
+    python answer_cache.py --check   # verificación de las claves (falla con AssertionError)
+"""
+
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from persistent_cache import CACHE_DIR, SQLiteCache, text_hash
+from rag_cache import QueryEmbeddingCache
+
+# --- CONFIGURACIÓN ---
+ANSWER_CACHE_CONFIG = {
+    "enabled": os.getenv("ANSWER_CACHE_ENABLED", "1") == "1",
+    "path": os.path.join(CACHE_DIR, "answers.db"),
+    "max_entries": 5_000,              # Respuestas guardadas (LRU)
+    "ttl_seconds": 7 * 24 * 3600       # Una semana
+}
+
+
+class AnswerCache:
+    """
+    Respuestas del LLM por (modelo, pregunta, consulta, hash del contexto).
+
+    El prompt se construye con la pregunta ORIGINAL y el contexto, así que
+    ambos forman parte de la clave: dos preguntas distintas con la misma
+    reescritura y el mismo contexto no comparten respuesta. Con el mismo
+    prompt (temperature=0) la respuesta guardada es la que el modelo
+    volvería a generar.
+    """
+
+    def __init__(
+        self,
+        path: str = ANSWER_CACHE_CONFIG["path"],
+        max_entries: int = ANSWER_CACHE_CONFIG["max_entries"],
+        ttl_seconds: float = ANSWER_CACHE_CONFIG["ttl_seconds"]
+    ):
+        """
+        Args:
+            path (str): Archivo SQLite de la caché
+            max_entries (int): Respuestas máximas
+            ttl_seconds (float): Vida de cada respuesta
+        """
+        self.store = SQLiteCache(path, max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self._version: Optional[str] = None
+        self._version_lock = threading.Lock()
+        self.purged = 0
+
+    @staticmethod
+    def key(model: str, question: str, query: str, context: str, version: Optional[str]) -> str:
+        """Clave: versión del vectorstore + hash de (modelo, pregunta y consulta normalizadas, hash del contexto)."""
+        parts = [
+            model,
+            QueryEmbeddingCache.normalize_query(question),
+            QueryEmbeddingCache.normalize_query(query),
+            text_hash(context)
+        ]
+        return f"{version or '-'}:{text_hash(json.dumps(parts, ensure_ascii=False))}"
+
+    def _sync_version(self, version: Optional[str]):
+        """Si el vectorstore cambió desde la última llamada, purga las respuestas de otras versiones."""
+        if version is None or version == self._version:
+            return
+        with self._version_lock:
+            if version == self._version:
+                return
+            deleted = self.store.retain_prefix(f"{version}:")
+            self._version = version
+        self.purged += deleted
+        if deleted:
+            print(f"🧹 [ANSWER CACHE] Vectorstore reconstruido: {deleted} respuestas invalidadas")
+
+    def get(self, model: str, question: str, query: str, context: str, version: Optional[str]) -> Optional[str]:
+        """Respuesta guardada para este prompt, o None."""
+        self._sync_version(version)
+        value = self.store.get(self.key(model, question, query, context, version))
+        return value.decode("utf-8") if value is not None else None
+
+    def put(self, model: str, question: str, query: str, context: str, version: Optional[str], answer: str):
+        """Guarda la respuesta generada para este prompt."""
+        self._sync_version(version)
+        self.store.put(self.key(model, question, query, context, version), answer.encode("utf-8"))
+
+    def clear(self):
+        """Vacía la caché."""
+        self.store.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores de uso, tamaño y respuestas invalidadas."""
+        return {**self.store.stats(), "version": self._version, "purged": self.purged}
+
+
+# --- INSTANCIA GLOBAL (Lazy Singleton) ---
+_answer_cache_instance = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    """Caché global de respuestas, o None si está desactivada (ANSWER_CACHE_ENABLED=0)."""
+    global _answer_cache_instance
+    if not ANSWER_CACHE_CONFIG["enabled"]:
+        return None
+    if _answer_cache_instance is None:
+        with _answer_cache_lock:
+            if _answer_cache_instance is None:
+                _answer_cache_instance = AnswerCache()
+    return _answer_cache_instance
+
+
+def check_answer_cache():
+    """
+    Verificación de las claves sobre una caché temporal (AssertionError si falla):
+    - dos preguntas distintas con la misma reescritura y el mismo contexto no comparten respuesta
+    - variaciones triviales de la misma pregunta sí aciertan
+    - una versión nueva del vectorstore invalida las respuestas anteriores
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = AnswerCache(path=os.path.join(directory, "answers.db"))
+        query, context = "tutores de la tesis de david torres", "[1] Tutores: Dr. C. Wilkie Delgado"
+        cache.put("modelo", "¿Quiénes son sus tutores?", query, context, "v1", "Wilkie Delgado")
+
+        assert cache.get("modelo", "¿Quién es el primer tutor?", query, context, "v1") is None, \
+            "otra pregunta con la misma reescritura y contexto reutilizó la respuesta"
+        assert cache.get("modelo", "  ¿quiénes son sus TUTORES? ", query, context, "v1") == "Wilkie Delgado"
+        assert cache.get("modelo", "¿Quiénes son sus tutores?", query, context + " ", "v1") is None
+        assert cache.get("otro-modelo", "¿Quiénes son sus tutores?", query, context, "v1") is None
+        assert cache.get("modelo", "¿Quiénes son sus tutores?", query, context, "v2") is None
+        assert cache.purged == 1
+        cache.store.close()
+    print("✅ AnswerCache: claves verificadas")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Caché persistente de respuestas del LLM")
+    parser.add_argument("--clear", action="store_true", help="Vaciar la caché")
+    parser.add_argument("--check", action="store_true", help="Verificar las claves de la caché")
+    args = parser.parse_args()
+
+    if args.check:
+        check_answer_cache()
+        raise SystemExit(0)
+
+    cache = AnswerCache()
+    if args.clear:
+        cache.clear()
+        print("🧹 Caché de respuestas vaciada")
+    print(cache.stats())
@@ -0,0 +1,1055 @@
+"""
+checkpointer.py - Checkpointer SQLite para LangGraph (síncrono + asíncrono)
+
+Este módulo encapsula:
+- Un SqliteSaver que también implementa la interfaz asíncrona de LangGraph
+- Ejecución de las operaciones SQLite en un executor dedicado
+- Compactación: por cada thread solo se conservan los últimos checkpoints
+  (los anteriores y sus escrituras pendientes se borran al guardar uno nuevo)
+- Historial como deltas: los mensajes de chat_history se guardan UNA vez en la
+  tabla messages (registro por thread) y cada checkpoint solo referencia sus
+  números de secuencia, así cada turno escribe únicamente sus mensajes nuevos
+- Caché LRU de threads activos: el último checkpoint de cada conversación
+  reciente queda en memoria (se actualiza en cada put), de modo que el turno
+  siguiente lo carga sin leer ni deserializar SQLite
+- Conexiones afinadas: un escritor (WAL, synchronous=NORMAL, mmap) y un pool
+  de conexiones de solo lectura por hilo; cada put() es UNA transacción
+- Retención: un job en segundo plano borra los threads inactivos más de un
+  TTL, hace checkpoint del WAL y libera páginas con incremental_vacuum
+
+Objetivo: Que el grafo pueda ejecutarse con app.ainvoke() sin bloquear el
+event loop de FastAPI, compartiendo la MISMA base de datos (checkpoints.db)
+que el flujo síncrono (app.invoke, scripts de prueba, get_last_state).
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    copy_checkpoint,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+# --- CONFIGURACIÓN ---
+CHECKPOINT_CONFIG = {
+    # Checkpoints conservados por thread. Cada turno genera uno por nodo del grafo
+    # (entrada + contextualize + search + respond); el estado vigente es el último.
+    "keep_last": 4,
+    # Canales de mensajes (con reductor add_messages) que se guardan como deltas
+    "message_channels": ("chat_history",)
+}
+
+# Valor que sustituye a la lista de mensajes dentro del checkpoint serializado
+MESSAGE_REF_KEY = "__message_seqs__"
+
+# Pragmas para nuestro patrón: muchos turnos pequeños (escrituras cortas y
+# frecuentes) y lecturas del último checkpoint desde varios hilos
+SQLITE_CONFIG = {
+    "busy_timeout_ms": 5000,                   # Esperar al escritor en lugar de fallar con "database is locked"
+    "synchronous": "NORMAL",                   # En WAL: sin fsync por commit (solo en los checkpoints del WAL)
+    "mmap_size": 256 * 1024 * 1024,            # Lecturas por mmap (sin copias al page cache de SQLite)
+    "cache_size_kib": 16 * 1024,               # Page cache por conexión
+    "wal_autocheckpoint": 1000,                # Páginas del WAL antes de un checkpoint automático
+    "journal_size_limit": 64 * 1024 * 1024     # Tras un checkpoint, el WAL se trunca a este tamaño
+}
+
+RETENTION_CONFIG = {
+    "thread_ttl_days": 30,       # Conversaciones sin actividad más de este tiempo se borran
+    "interval_seconds": 3600,    # Frecuencia del job de retención
+    "delete_batch": 200,         # Threads borrados por transacción (no bloquea al escritor mucho tiempo)
+    "vacuum_pages": 2000,        # Páginas libres devueltas al sistema por pasada (incremental_vacuum)
+    # Espera máxima del TRUNCATE del WAL: mientras espera a los lectores retiene el
+    # lock de escritura de SQLite, así que se rinde pronto y se reintenta en la próxima pasada
+    "wal_truncate_timeout_ms": 100,
+    "activity_resolution_seconds": 300  # La actividad de un thread se registra como mucho una vez por intervalo
+}
+
+HOT_THREAD_CONFIG = {
+    "max_threads": 512,              # Conversaciones con su último checkpoint en memoria
+    "max_bytes": 64 * 1024 * 1024,   # Tope de memoria estimada de la caché
+    # Con varios procesos escribiendo la misma base, cada acierto comprueba el
+    # checkpoint_id más reciente (consulta al índice, sin leer ni deserializar el blob)
+    "validate_hits": False
+}
+
+
+def _ensure_incremental_vacuum(conn: sqlite3.Connection, path: str):
+    """
+    Deja la base en auto_vacuum=INCREMENTAL (lo necesita incremental_vacuum).
+    En una base nueva basta el pragma antes de crear las tablas; una base
+    existente creada sin él se convierte UNA vez con VACUUM (reescribe el
+    archivo). Si otra conexión lo impide, se avisa y se reintenta al reabrir.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    empty = conn.execute("PRAGMA page_count").fetchone()[0] == 0
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    if empty:
+        return
+    try:
+        start = time.perf_counter()
+        conn.execute("VACUUM")
+        print(f"🧹 [CHECKPOINTER] {path} convertida a auto_vacuum=INCREMENTAL "
+              f"({time.perf_counter() - start:.2f}s)")
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ [CHECKPOINTER] {path} sigue sin auto_vacuum=INCREMENTAL ({e}): "
+              f"incremental_vacuum no liberará páginas hasta convertirla")
+
+
+def connect(path: str, readonly: bool = False) -> sqlite3.Connection:
+    """
+    Abre una conexión a la base de checkpoints con los pragmas de SQLITE_CONFIG.
+
+    Args:
+        path (str): Ruta de checkpoints.db
+        readonly (bool): Conexión de solo lectura (pool de lectores)
+    """
+    if readonly:
+        conn = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        _ensure_incremental_vacuum(conn, path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={SQLITE_CONFIG['synchronous']}")
+        conn.execute(f"PRAGMA wal_autocheckpoint={SQLITE_CONFIG['wal_autocheckpoint']}")
+        conn.execute(f"PRAGMA journal_size_limit={SQLITE_CONFIG['journal_size_limit']}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_CONFIG['busy_timeout_ms']}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_CONFIG['mmap_size']}")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CONFIG['cache_size_kib']}")
+    return conn
+
+
+def _estimate_bytes(value: Any) -> int:
+    """Tamaño aproximado en memoria de un valor del estado (recorre contenedores y mensajes)."""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_estimate_bytes(k) + _estimate_bytes(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(_estimate_bytes(item) for item in value)
+    if hasattr(value, "content"):  # Mensajes de LangChain
+        return sys.getsizeof(value) + _estimate_bytes(value.content) + 256
+    return sys.getsizeof(value)
+
+
+def _copy_tuple(checkpoint_tuple: CheckpointTuple) -> CheckpointTuple:
+    """Copia superficial: LangGraph puede modificar el checkpoint que recibe."""
+    return CheckpointTuple(
+        checkpoint_tuple.config,
+        copy_checkpoint(checkpoint_tuple.checkpoint),
+        dict(checkpoint_tuple.metadata),
+        checkpoint_tuple.parent_config,
+        list(checkpoint_tuple.pending_writes or [])
+    )
+
+
+class HotThreadCache:
+    """
+    LRU (thread_id, checkpoint_ns) -> último CheckpointTuple del thread.
+
+    Acotada por número de threads y por memoria estimada. El checkpointer la
+    mantiene coherente: cada put() guarda el nuevo checkpoint, put_writes()
+    invalida la entrada (las escrituras pendientes solo existen en SQLite) y
+    delete_thread()/migraciones la vacían.
+    """
+
+    def __init__(
+        self,
+        max_threads: int = HOT_THREAD_CONFIG["max_threads"],
+        max_bytes: int = HOT_THREAD_CONFIG["max_bytes"],
+        validate_hits: bool = HOT_THREAD_CONFIG["validate_hits"]
+    ):
+        """
+        Args:
+            max_threads (int): Entradas máximas
+            max_bytes (int): Memoria estimada máxima
+            validate_hits (bool): Verificar cada acierto contra la base (varios procesos)
+        """
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.validate_hits = validate_hits
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[CheckpointTuple, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(
+        self,
+        key: Tuple[str, str],
+        expected_id: Optional[str] = None,
+        validate: bool = False
+    ) -> Optional[CheckpointTuple]:
+        """
+        Último checkpoint del thread si está en caché (cuenta acierto/fallo).
+        Con validate, una entrada cuyo checkpoint no es expected_id se descarta
+        (obsoleta); expected_id None significa que el thread ya no existe en la
+        base (p. ej. lo borró la retención de otro worker).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and validate \
+                    and entry[0].config["configurable"]["checkpoint_id"] != expected_id:
+                del self._entries[key]
+                self._bytes -= entry[1]
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Tuple[str, str], checkpoint_tuple: CheckpointTuple):
+        """Guarda el checkpoint salvo que ya haya uno más reciente (los put pueden llegar desordenados)."""
+        size = _estimate_bytes(checkpoint_tuple.checkpoint.get("channel_values", {})) + 1024
+        if size > self.max_bytes:
+            return
+        new_id = checkpoint_tuple.config["configurable"]["checkpoint_id"]
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None:
+                if current[0].config["configurable"]["checkpoint_id"] > new_id:
+                    return
+                self._bytes -= current[1]
+            self._entries[key] = (checkpoint_tuple, size)
+            self._entries.move_to_end(key)
+            self._bytes += size
+            while len(self._entries) > self.max_threads or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key: Tuple[str, str], checkpoint_id: Optional[str] = None):
+        """Descarta la entrada (si se indica checkpoint_id, solo si es ese checkpoint)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if checkpoint_id is not None and entry[0].config["configurable"]["checkpoint_id"] != checkpoint_id:
+                return
+            del self._entries[key]
+            self._bytes -= entry[1]
+            self.invalidations += 1
+
+    def invalidate_thread(self, thread_id: str):
+        """Descarta todas las entradas de un thread (cualquier checkpoint_ns)."""
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == thread_id]
+        for key in keys:
+            self.invalidate(key)
+
+    def clear(self):
+        """Vacía la caché."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores de uso y memoria estimada."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_threads": self.max_threads,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+# Checkpointers abiertos en este proceso: tras un fork cada hijo reabre su conexión
+_open_savers: "weakref.WeakSet[ThreadedSqliteSaver]" = weakref.WeakSet()
+
+
+class ThreadedSqliteSaver(SqliteSaver):
+    """
+    SqliteSaver con soporte asíncrono.
+
+    El SqliteSaver original lanza NotImplementedError en aget_tuple/aput/...
+    Aquí cada operación asíncrona se delega a la versión síncrona dentro de un
+    executor propio, de modo que el event loop nunca espera a SQLite.
+
+    SQLite admite un único escritor; el SqliteSaver ya serializa el acceso a la
+    conexión con un lock, así que un executor de 1 hilo preserva el orden de
+    las escrituras sin perder rendimiento. Con db_path, las lecturas usan
+    conexiones de solo lectura por hilo (WAL: no esperan al escritor).
+    """
+
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        max_workers: int = 1,
+        keep_last: Optional[int] = CHECKPOINT_CONFIG["keep_last"],
+        hot_cache: Optional[HotThreadCache] = None,
+        db_path: Optional[str] = None,
+        **kwargs
+    ):
+        """
+        Inicializa el checkpointer.
+
+        Args:
+            conn (sqlite3.Connection): Conexión abierta con check_same_thread=False
+            max_workers (int): Hilos del executor dedicado a SQLite
+            keep_last (int): Checkpoints conservados por thread (None = sin compactar)
+            hot_cache (HotThreadCache): Caché del último checkpoint de los threads activos
+            db_path (str): Ruta de la base; activa el pool de lectores (no aplica a ":memory:")
+        """
+        super().__init__(conn, **kwargs)
+        self.keep_last = keep_last
+        self.hot_cache = hot_cache
+        self.db_path = db_path
+        self._concurrent_reads = db_path is not None and db_path != ":memory:"
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._activity_written: Dict[str, float] = {}  # thread_id -> último registro de actividad
+        self._max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="checkpointer"
+        )
+        _open_savers.add(self)
+
+    def _reopen_after_fork(self):
+        """
+        Proceso hijo: conexión de escritura, lectores, locks y executor nuevos
+        (los hilos del executor del padre no existen en el hijo). La conexión
+        heredada queda sin usar; no se cierra.
+        """
+        if self._concurrent_reads:
+            self.conn = connect(self.db_path)
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self._readers = []
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._max_workers,
+            thread_name_prefix="checkpointer"
+        )
+        if self.hot_cache is not None:
+            self.hot_cache._lock = threading.Lock()
+
+    def setup(self) -> None:
+        """Crea las tablas del SqliteSaver y el registro de mensajes."""
+        if self.is_setup:
+            return
+        super().setup()
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                seq INTEGER NOT NULL,
+                message_id TEXT NOT NULL,
+                type TEXT,
+                value BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, seq)
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_id
+                ON messages (thread_id, checkpoint_ns, message_id);
+            CREATE TABLE IF NOT EXISTS thread_activity (
+                thread_id TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_thread_activity_updated
+                ON thread_activity (updated_at);
+            """
+        )
+        # Threads anteriores a la tabla de actividad: cuentan como activos desde ahora
+        self.conn.execute(
+            "INSERT OR IGNORE INTO thread_activity (thread_id, updated_at) "
+            "SELECT DISTINCT thread_id, ? FROM checkpoints",
+            (time.time(),)
+        )
+        self.conn.commit()
+
+    # --- Conexiones ---
+
+    @contextmanager
+    def cursor(self, transaction: bool = True) -> Iterator[sqlite3.Cursor]:
+        """
+        Cursor para el SqliteSaver:
+        - dentro de _batch() (mismo hilo): la conexión de escritura, sin commit propio
+        - lecturas con pool activo: la conexión de solo lectura del hilo actual
+        - resto: la conexión de escritura con el lock (commit al salir)
+        """
+        if getattr(self._local, "batch_depth", 0) or getattr(self._local, "pinned", False):
+            cur = self.conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+            return
+
+        if not transaction and self._concurrent_reads:
+            if not self.is_setup:
+                with self.lock:
+                    self.setup()
+            cur = self._reader().cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+            return
+
+        with self.lock:
+            self.setup()
+            cur = self.conn.cursor()
+            try:
+                yield cur
+            finally:
+                if transaction:
+                    self.conn.commit()
+                cur.close()
+
+    def _reader(self) -> sqlite3.Connection:
+        """Conexión de solo lectura del hilo actual (se crea la primera vez)."""
+        conn = getattr(self._local, "reader", None)
+        if conn is None:
+            conn = connect(self.db_path, readonly=True)
+            self._local.reader = conn
+            with self.lock:
+                self._readers.append(conn)
+        return conn
+
+    @contextmanager
+    def _batch(self) -> Iterator[None]:
+        """
+        Agrupa varias operaciones del saver en UNA transacción (un solo commit).
+        Los cursores pedidos dentro del bloque, en el mismo hilo, reutilizan la
+        conexión de escritura sin volver a tomar el lock.
+        """
+        with self.lock:
+            self.setup()
+            self._local.batch_depth = getattr(self._local, "batch_depth", 0) + 1
+            try:
+                yield
+            except BaseException:
+                if self._local.batch_depth == 1:
+                    self.conn.rollback()
+                raise
+            else:
+                if self._local.batch_depth == 1:
+                    self.conn.commit()
+            finally:
+                self._local.batch_depth -= 1
+
+    # --- Historial como deltas ---
+
+    def _store_messages(self, thread_id: str, checkpoint_ns: str, messages: List[Any]) -> List[int]:
+        """
+        Agrega al registro los mensajes que aún no están (por id) y devuelve la
+        secuencia de cada mensaje de la lista. Los mensajes se consideran inmutables.
+        """
+        ids = [message.id for message in messages]
+        with self.cursor() as cur:
+            placeholders = ",".join("?" * len(ids))
+            cur.execute(
+                f"SELECT message_id, seq FROM messages WHERE thread_id = ? AND checkpoint_ns = ? "
+                f"AND message_id IN ({placeholders})",
+                (thread_id, checkpoint_ns, *ids)
+            )
+            seqs = dict(cur.fetchall())
+            new_messages = [m for m in messages if m.id not in seqs]
+            if new_messages:
+                cur.execute(
+                    "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE thread_id = ? AND checkpoint_ns = ?",
+                    (thread_id, checkpoint_ns)
+                )
+                next_seq = cur.fetchone()[0] + 1
+                rows = []
+                for seq, message in enumerate(new_messages, next_seq):
+                    seqs[message.id] = seq
+                    rows.append((thread_id, checkpoint_ns, seq, message.id, *self.serde.dumps_typed(message)))
+                cur.executemany(
+                    "INSERT INTO messages (thread_id, checkpoint_ns, seq, message_id, type, value) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+        return [seqs[message_id] for message_id in ids]
+
+    def _encode_messages(
+        self,
+        thread_id: str,
+        checkpoint_ns: str,
+        checkpoint: Checkpoint
+    ) -> Tuple[Checkpoint, Optional[int]]:
+        """
+        Sustituye las listas de mensajes del checkpoint por referencias al registro.
+
+        Returns:
+            Tuple: (checkpoint a serializar, secuencia más antigua referenciada o None)
+        """
+        values = checkpoint.get("channel_values", {})
+        encoded = {}
+        for channel in CHECKPOINT_CONFIG["message_channels"]:
+            messages = values.get(channel)
+            # Sin ids (p. ej. estado sin reductor) se guarda tal cual
+            if not isinstance(messages, list) or not messages or \
+                    any(getattr(m, "id", None) is None for m in messages):
+                continue
+            encoded[channel] = {MESSAGE_REF_KEY: self._store_messages(thread_id, checkpoint_ns, messages)}
+
+        if not encoded:
+            return checkpoint, None
+        floor = min(min(ref[MESSAGE_REF_KEY]) for ref in encoded.values())
+        return {**checkpoint, "channel_values": {**values, **encoded}}, floor
+
+    def _hydrate(self, checkpoint_tuple: Optional[CheckpointTuple]) -> Optional[CheckpointTuple]:
+        """Reconstruye las listas de mensajes referenciadas por el checkpoint."""
+        if checkpoint_tuple is None:
+            return None
+        values = checkpoint_tuple.checkpoint.get("channel_values", {})
+        refs = {
+            channel: values[channel][MESSAGE_REF_KEY]
+            for channel in CHECKPOINT_CONFIG["message_channels"]
+            if isinstance(values.get(channel), dict) and MESSAGE_REF_KEY in values[channel]
+        }
+        if not refs:
+            return checkpoint_tuple
+
+        configurable = checkpoint_tuple.config["configurable"]
+        wanted = [seq for seqs in refs.values() for seq in seqs]
+        with self.cursor(transaction=False) as cur:
+            cur.execute(
+                "SELECT seq, type, value FROM messages WHERE thread_id = ? AND checkpoint_ns = ? "
+                "AND seq BETWEEN ? AND ?",
+                (configurable["thread_id"], configurable.get("checkpoint_ns", ""), min(wanted), max(wanted))
+            )
+            by_seq = {seq: self.serde.loads_typed((type_, value)) for seq, type_, value in cur.fetchall()}
+
+        for channel, seqs in refs.items():
+            values[channel] = [by_seq[seq] for seq in seqs if seq in by_seq]
+        return checkpoint_tuple
+
+    @staticmethod
+    def _cache_key(config: RunnableConfig) -> Tuple[str, str]:
+        configurable = config["configurable"]
+        return str(configurable["thread_id"]), configurable.get("checkpoint_ns", "")
+
+    def _latest_checkpoint_id(self, key: Tuple[str, str]) -> Optional[str]:
+        """checkpoint_id más reciente del thread (solo el índice, sin leer el blob)."""
+        with self.cursor(transaction=False) as cur:
+            cur.execute(
+                "SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?",
+                key
+            )
+            return cur.fetchone()[0]
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        """
+        get_tuple() con las listas de mensajes reconstruidas. El último checkpoint
+        de un thread activo se sirve desde la caché (sin leer SQLite).
+        """
+        if self.hot_cache is None or get_checkpoint_id(config):
+            return self._hydrate(super().get_tuple(config))
+
+        key = self._cache_key(config)
+        validate = self.hot_cache.validate_hits
+        expected_id = self._latest_checkpoint_id(key) if validate else None
+        cached = self.hot_cache.get(key, expected_id, validate=validate)
+        if cached is not None:
+            return _copy_tuple(cached)
+
+        checkpoint_tuple = self._hydrate(super().get_tuple(config))
+        if checkpoint_tuple is not None:
+            self.hot_cache.put(key, _copy_tuple(checkpoint_tuple))
+        return checkpoint_tuple
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        """list() con las listas de mensajes reconstruidas."""
+        # Se materializa con la conexión de escritura y el lock: el SqliteSaver
+        # mezcla su cursor con otro de self.conn mientras itera
+        with self.lock:
+            self.setup()
+            self._local.pinned = True
+            try:
+                tuples = list(super().list(config, filter=filter, before=before, limit=limit))
+            finally:
+                self._local.pinned = False
+        for checkpoint_tuple in tuples:
+            yield self._hydrate(checkpoint_tuple)
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        """
+        Guarda el checkpoint (mensajes como deltas), borra los antiguos del mismo
+        thread y registra la actividad, todo en una sola transacción.
+        """
+        configurable = config["configurable"]
+        with self._batch():
+            encoded, floor = self._encode_messages(
+                str(configurable["thread_id"]), configurable.get("checkpoint_ns", ""), checkpoint
+            )
+            if floor is not None:
+                # Secuencia más antigua que necesita este checkpoint (permite podar el registro)
+                metadata = {**metadata, "history_floor": floor}
+            next_config = super().put(config, encoded, metadata, new_versions)
+            if self.keep_last:
+                self.prune_thread(*self._cache_key(next_config), self.keep_last)
+            self._touch_thread(str(configurable["thread_id"]))
+
+        if self.hot_cache is not None:
+            # El checkpoint recién guardado es el último del thread: el próximo turno no lee SQLite
+            parent_config = (
+                {"configurable": {**next_config["configurable"], "checkpoint_id": configurable["checkpoint_id"]}}
+                if configurable.get("checkpoint_id") else None
+            )
+            self.hot_cache.put(self._cache_key(next_config), CheckpointTuple(
+                next_config,
+                copy_checkpoint(checkpoint),
+                get_checkpoint_metadata(config, metadata),
+                parent_config,
+                []
+            ))
+        return next_config
+
+    def _touch_thread(self, thread_id: str):
+        """Registra la actividad del thread (para el TTL), como mucho una vez por intervalo."""
+        now = time.time()
+        if now - self._activity_written.get(thread_id, 0.0) < RETENTION_CONFIG["activity_resolution_seconds"]:
+            return
+        if len(self._activity_written) > 100_000:
+            self._activity_written.clear()
+        self._activity_written[thread_id] = now
+        self.conn.execute(
+            "INSERT INTO thread_activity (thread_id, updated_at) VALUES (?, ?) "
+            "ON CONFLICT(thread_id) DO UPDATE SET updated_at = excluded.updated_at",
+            (thread_id, now)
+        )
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        """put_writes() que invalida la caché del checkpoint afectado."""
+        super().put_writes(config, writes, task_id, task_path)
+        if self.hot_cache is not None:
+            self.hot_cache.invalidate(self._cache_key(config), config["configurable"]["checkpoint_id"])
+
+    def prune_thread(self, thread_id: str, checkpoint_ns: str = "", keep_last: int = CHECKPOINT_CONFIG["keep_last"]) -> int:
+        """
+        Borra los checkpoints de un thread salvo los keep_last más recientes, y los
+        mensajes del registro que ya no referencia ningún checkpoint conservado
+        (los que salieron de la ventana al resumir el historial).
+        Los checkpoint_id (uuid6) crecen con el tiempo: el orden lexicográfico es cronológico.
+
+        Returns:
+            int: Checkpoints borrados
+        """
+        with self.cursor() as cur:
+            cur.execute(
+                "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                "ORDER BY checkpoint_id DESC LIMIT -1 OFFSET ?",
+                (thread_id, checkpoint_ns, keep_last)
+            )
+            stale = [(thread_id, checkpoint_ns, row[0]) for row in cur.fetchall()]
+            if stale:
+                cur.executemany(
+                    "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    stale
+                )
+                cur.executemany(
+                    "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    stale
+                )
+                cur.execute(
+                    "SELECT MIN(json_extract(CAST(metadata AS TEXT), '$.history_floor')) FROM checkpoints "
+                    "WHERE thread_id = ? AND checkpoint_ns = ?",
+                    (thread_id, checkpoint_ns)
+                )
+                floor = cur.fetchone()[0]
+                if floor is not None:
+                    cur.execute(
+                        "DELETE FROM messages WHERE thread_id = ? AND checkpoint_ns = ? AND seq < ?",
+                        (thread_id, checkpoint_ns, floor)
+                    )
+        return len(stale)
+
+    def prune_all(self, keep_last: int = CHECKPOINT_CONFIG["keep_last"]) -> int:
+        """Compacta todos los threads (bases creadas antes de la compactación automática)."""
+        with self.cursor(transaction=False) as cur:
+            cur.execute("SELECT DISTINCT thread_id, checkpoint_ns FROM checkpoints")
+            threads = cur.fetchall()
+        return sum(self.prune_thread(thread_id, ns, keep_last) for thread_id, ns in threads)
+
+    def migrate_messages(self) -> int:
+        """
+        Migra los checkpoints guardados con el historial completo (antes de los
+        deltas): asigna ids estables a sus mensajes, los pasa al registro y
+        reescribe el checkpoint con referencias. Es idempotente.
+
+        Returns:
+            int: Checkpoints reescritos
+        """
+        with self.cursor(transaction=False) as cur:
+            cur.execute("SELECT thread_id, checkpoint_ns, checkpoint_id, type, checkpoint, metadata FROM checkpoints")
+            rows = cur.fetchall()
+
+        migrated = 0
+        for thread_id, checkpoint_ns, checkpoint_id, type_, blob, metadata in rows:
+            checkpoint = self.serde.loads_typed((type_, blob))
+            values = checkpoint.get("channel_values", {})
+            changed = False
+            for channel in CHECKPOINT_CONFIG["message_channels"]:
+                messages = values.get(channel)
+                if not isinstance(messages, list) or not messages:
+                    continue
+                # Id determinista (thread + contenido + ocurrencia): el mismo mensaje
+                # repetido en varios checkpoints del thread se guarda una sola vez
+                seen: Dict[Tuple[str, str], int] = {}
+                for message in messages:
+                    if message.id is None:
+                        key = (message.type, str(message.content))
+                        seen[key] = seen.get(key, 0) + 1
+                        message.id = str(uuid.uuid5(
+                            uuid.NAMESPACE_URL, f"{thread_id}|{checkpoint_ns}|{seen[key]}|{key[0]}|{key[1]}"
+                        ))
+                        changed = True
+            if not changed:
+                continue
+
+            checkpoint, floor = self._encode_messages(thread_id, checkpoint_ns, checkpoint)
+            metadata = json.loads(metadata) if metadata is not None else {}
+            if floor is not None:
+                metadata["history_floor"] = floor
+            new_type, new_blob = self.serde.dumps_typed(checkpoint)
+            with self.cursor() as cur:
+                cur.execute(
+                    "UPDATE checkpoints SET type = ?, checkpoint = ?, metadata = ? "
+                    "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (new_type, new_blob, json.dumps(metadata, ensure_ascii=False).encode("utf-8", "ignore"),
+                     thread_id, checkpoint_ns, checkpoint_id)
+                )
+            migrated += 1
+        if migrated and self.hot_cache is not None:
+            self.hot_cache.clear()
+        return migrated
+
+    def delete_thread(self, thread_id: str) -> None:
+        """Borra checkpoints, escrituras, mensajes y actividad del thread."""
+        self.delete_threads([str(thread_id)])
+
+    def delete_threads(self, thread_ids: Sequence[str]) -> None:
+        """Borra varios threads en una sola transacción."""
+        rows = [(thread_id,) for thread_id in thread_ids]
+        with self._batch():
+            for table in ("checkpoints", "writes", "messages", "thread_activity"):
+                self.conn.executemany(f"DELETE FROM {table} WHERE thread_id = ?", rows)
+        for thread_id in thread_ids:
+            self._activity_written.pop(thread_id, None)
+            if self.hot_cache is not None:
+                self.hot_cache.invalidate_thread(thread_id)
+
+    # --- Retención ---
+
+    def expire_idle_threads(
+        self,
+        ttl_seconds: float,
+        batch_size: int = RETENTION_CONFIG["delete_batch"]
+    ) -> int:
+        """
+        Borra los threads sin actividad desde hace más de ttl_seconds, por lotes
+        (cada lote es una transacción corta: los turnos en curso no esperan mucho).
+
+        Returns:
+            int: Threads borrados
+        """
+        cutoff = time.time() - ttl_seconds
+        removed = 0
+        while True:
+            with self.cursor(transaction=False) as cur:
+                cur.execute(
+                    "SELECT thread_id FROM thread_activity WHERE updated_at < ? LIMIT ?",
+                    (cutoff, batch_size)
+                )
+                thread_ids = [row[0] for row in cur.fetchall()]
+            if not thread_ids:
+                return removed
+            self.delete_threads(thread_ids)
+            removed += len(thread_ids)
+
+    def checkpoint_wal(self) -> Tuple[int, int, int]:
+        """
+        Vuelca el WAL a la base y lo trunca. El paso PASSIVE (bajo el lock del
+        escritor, no espera a nadie) informa del tamaño del WAL y vuelca lo que
+        puede. El TRUNCATE se ejecuta FUERA del lock con una conexión propia y
+        un busy_timeout corto (wal_truncate_timeout_ms): si un lector lo impide
+        devuelve busy=1 en lugar de frenar los put() durante segundos.
+
+        Returns:
+            Tuple: (busy, páginas en el WAL, páginas volcadas)
+        """
+        with self.lock:
+            _, wal_pages, checkpointed = self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        if not self._concurrent_reads:
+            return 0, wal_pages, checkpointed  # ":memory:" o sin ruta: no hay WAL que truncar
+        conn = sqlite3.connect(self.db_path, timeout=RETENTION_CONFIG["wal_truncate_timeout_ms"] / 1000)
+        try:
+            busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+        finally:
+            conn.close()
+        return busy, wal_pages, checkpointed
+
+    def incremental_vacuum(self, pages: int = RETENTION_CONFIG["vacuum_pages"]) -> int:
+        """
+        Devuelve al sistema hasta `pages` páginas libres (requiere auto_vacuum=INCREMENTAL).
+
+        Returns:
+            int: Páginas liberadas
+        """
+        with self.lock:
+            before = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # executescript ejecuta el pragma hasta el final (execute() libera solo una página por paso)
+            self.conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+            return before - self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    async def _run(self, func, *args, **kwargs):
+        """Ejecuta una operación síncrona del saver en el executor dedicado."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        """Versión asíncrona de get_tuple()."""
+        return await self._run(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        """Versión asíncrona de list() (materializa el resultado en el executor)."""
+        tuples = await self._run(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint_tuple in tuples:
+            yield checkpoint_tuple
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        """Versión asíncrona de put()."""
+        return await self._run(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        """Versión asíncrona de put_writes()."""
+        await self._run(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        """Versión asíncrona de delete_thread()."""
+        await self._run(self.delete_thread, thread_id)
+
+    def close(self):
+        """Libera el executor y el pool de lectores (la conexión de escritura la cierra su propietario)."""
+        self._executor.shutdown(wait=True)
+        with self.lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers.clear()
+
+
+def _reopen_savers_after_fork():
+    for saver in list(_open_savers):
+        saver._reopen_after_fork()
+
+
+os.register_at_fork(after_in_child=_reopen_savers_after_fork)
+
+
+class RetentionJob:
+    """
+    Job en segundo plano que mantiene acotada checkpoints.db:
+    borra threads inactivos (TTL), hace checkpoint del WAL y ejecuta
+    incremental_vacuum. Cada pasada es corta y por lotes.
+    """
+
+    def __init__(
+        self,
+        saver: ThreadedSqliteSaver,
+        ttl_days: float = RETENTION_CONFIG["thread_ttl_days"],
+        interval_seconds: float = RETENTION_CONFIG["interval_seconds"],
+        vacuum_pages: int = RETENTION_CONFIG["vacuum_pages"]
+    ):
+        """
+        Args:
+            saver (ThreadedSqliteSaver): Checkpointer a mantener
+            ttl_days (float): Días sin actividad antes de borrar un thread
+            interval_seconds (float): Segundos entre pasadas
+            vacuum_pages (int): Páginas liberadas como máximo por pasada
+        """
+        self.saver = saver
+        self.ttl_seconds = ttl_days * 86400
+        self.interval_seconds = interval_seconds
+        self.vacuum_pages = vacuum_pages
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_run: Dict[str, Any] = {}
+
+    def run_once(self) -> Dict[str, Any]:
+        """Una pasada de mantenimiento (también se puede llamar a mano)."""
+        start = time.perf_counter()
+        expired = self.saver.expire_idle_threads(self.ttl_seconds)
+        freed = self.saver.incremental_vacuum(self.vacuum_pages)
+        busy, wal_pages, checkpointed = self.saver.checkpoint_wal()
+        self.last_run = {
+            "expired_threads": expired,
+            "wal_pages": wal_pages,
+            "wal_checkpointed": checkpointed,
+            "wal_busy": bool(busy),
+            "freed_pages": freed,
+            "seconds": round(time.perf_counter() - start, 3)
+        }
+        print(f"🧹 [RETENTION] {expired} threads inactivos borrados, WAL {checkpointed}/{wal_pages} páginas, "
+              f"{freed} páginas liberadas ({self.last_run['seconds']}s)")
+        return self.last_run
+
+    def _loop(self):
+        while not self._stop.wait(self.interval_seconds):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"⚠️ [RETENTION] Error en la pasada de mantenimiento: {e}")
+
+    def start(self):
+        """Arranca el job (idempotente)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="checkpoint-retention", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Detiene el job."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    # Benchmark: bytes escritos en el WAL y latencia por turno (historial completo vs deltas)
+    # python checkpointer.py --turns 50 --chars 800
+    import argparse
+    import os
+    import tempfile
+    from typing import Annotated, List, TypedDict
+
+    from langchain_core.messages import AIMessage, HumanMessage
+    from langgraph.graph import END, StateGraph
+    from langgraph.graph.message import add_messages
+
+    parser = argparse.ArgumentParser(description="Bytes por turno en checkpoints.db")
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--chars", type=int, default=800, help="Longitud de cada respuesta")
+    args = parser.parse_args()
+
+    class FullState(TypedDict):
+        input: str
+        chat_history: List[Any]
+
+    class DeltaState(TypedDict):
+        input: str
+        chat_history: Annotated[List[Any], add_messages]
+
+    def turn_messages(state):
+        n = len(state.get("chat_history", [])) // 2
+        return [HumanMessage(content=state["input"]), AIMessage(content=f"Respuesta {n} " + "x" * args.chars)]
+
+    def build(state_type, node, saver):
+        graph = StateGraph(state_type)
+        graph.add_node("respond", node)
+        graph.set_entry_point("respond")
+        graph.add_edge("respond", END)
+        return graph.compile(checkpointer=saver)
+
+    variants = {
+        # Lista sin reductor y SqliteSaver sin ajustes: cada checkpoint guarda el historial entero
+        "completo": (FullState, lambda s: {"chat_history": s.get("chat_history", []) + turn_messages(s)},
+                     lambda path: SqliteSaver(sqlite3.connect(path, check_same_thread=False))),
+        "deltas": (DeltaState, lambda s: {"chat_history": turn_messages(s)},
+                   lambda path: ThreadedSqliteSaver(connect(path), keep_last=None, db_path=path)),
+        "deltas+poda": (DeltaState, lambda s: {"chat_history": turn_messages(s)},
+                        lambda path: ThreadedSqliteSaver(connect(path), db_path=path)),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"\n{'variante':<13}{'turno 1':>10}{'turno ' + str(args.turns // 2):>12}"
+              f"{'turno ' + str(args.turns):>12}{'WAL MB':>9}{'DB final MB':>13}{'p99 ms':>9}")
+        for name, (state_type, node, make_saver) in variants.items():
+            path = os.path.join(tmp, f"{name}.db")
+            saver = make_saver(path)
+            conn = saver.conn
+            saver.setup()
+            conn.execute("PRAGMA wal_autocheckpoint=0")  # El WAL solo crece: su tamaño = bytes escritos
+            app = build(state_type, node, saver)
+            config = {"configurable": {"thread_id": "bench"}}
+
+            per_turn = []
+            latencies = []
+            previous = os.path.getsize(path + "-wal")
+            for turn in range(args.turns):
+                # Solo se envía la pregunta: el historial lo carga el checkpointer
+                start = time.perf_counter()
+                app.invoke({"input": f"Pregunta {turn}"}, config=config)
+                latencies.append((time.perf_counter() - start) * 1000)
+                size = os.path.getsize(path + "-wal")
+                per_turn.append(size - previous)
+                previous = size
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.close()
+
+            middle = per_turn[args.turns // 2 - 1]
+            print(f"{name:<13}{per_turn[0]:>10,}{middle:>12,}{per_turn[-1]:>12,}"
+                  f"{sum(per_turn) / 1e6:>9.2f}{os.path.getsize(path) / 1e6:>13.2f}"
+                  f"{sorted(latencies)[int(len(latencies) * 0.99) - 1]:>9.2f}")
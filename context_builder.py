@@ -0,0 +1,244 @@
+"""
+context_builder.py - Construcción del contexto para el LLM con presupuesto de tokens
+
+Este módulo encapsula:
+- Eliminación de fragmentos duplicados (exactos y casi idénticos)
+- Fusión de fragmentos contiguos del mismo documento (chunk_index consecutivo),
+  quitando el texto repetido por chunk_overlap
+- Empaquetado por prioridad (orden de recuperación) hasta un presupuesto de tokens
+- Presentación final ordenada por página (la portada primero)
+- Registro de cuántos tokens ahorra cada paso
+
+Objetivo: Enviar al modelo (Gemma 4B) menos texto redundante sin perder los
+fragmentos más relevantes.
+"""
+
+import hashlib
+import re
+from typing import Any, Dict, List, Set, Tuple
+
+from langchain_core.documents import Document
+
+# --- CONFIGURACIÓN ---
+CONTEXT_BUDGET_CONFIG = {
+    "max_tokens": 3000,                # Presupuesto de contexto
+    "chars_per_token": 4,              # Estimación (sin tokenizador local de Gemma)
+    "near_duplicate_threshold": 0.85,  # Jaccard de shingles a partir del cual se descarta
+    "shingle_size": 5,                 # Palabras por shingle
+    "max_overlap_chars": 400,          # Mayor solapamiento buscado entre fragmentos contiguos
+    "min_overlap_chars": 20            # Solapamientos más cortos se ignoran (coincidencias casuales)
+}
+
+
+def estimate_tokens(text: str, chars_per_token: int = CONTEXT_BUDGET_CONFIG["chars_per_token"]) -> int:
+    """Estimación rápida de tokens por número de caracteres."""
+    return (len(text) + chars_per_token - 1) // chars_per_token
+
+
+def _clean(text: str) -> str:
+    """Mismo limpiado que RAGManager.format_context (saltos de línea -> espacios)."""
+    return text.replace("\n", " ").strip()
+
+
+def _shingles(text: str, size: int) -> Set[str]:
+    """Conjunto de n-gramas de palabras (para detectar casi duplicados)."""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _overlap_length(left: str, right: str, max_chars: int, min_chars: int) -> int:
+    """
+    Longitud del mayor sufijo de left que es prefijo de right
+    (el texto que RecursiveCharacterTextSplitter repite entre fragmentos).
+    """
+    tail = left[-max_chars:]
+    probe = right[:min_chars]
+    if len(probe) < min_chars:
+        return 0
+
+    position = tail.find(probe)
+    while position != -1:
+        candidate = len(tail) - position
+        if right.startswith(tail[position:]):
+            return candidate
+        position = tail.find(probe, position + 1)
+    return 0
+
+
+def _page_label(pages: List[Any]) -> str:
+    """'3' o '3-4' para fragmentos fusionados que cruzan páginas."""
+    numeric = sorted({page for page in pages if isinstance(page, int)})
+    if not numeric:
+        return str(pages[0]) if pages else "?"
+    return str(numeric[0]) if numeric[0] == numeric[-1] else f"{numeric[0]}-{numeric[-1]}"
+
+
+def _merge_adjacent(
+    fragments: List[Dict[str, Any]],
+    max_overlap: int,
+    min_overlap: int
+) -> List[Dict[str, Any]]:
+    """
+    Fusiona fragmentos del mismo documento con chunk_index consecutivo.
+    Cada grupo conserva la MEJOR prioridad de sus miembros.
+    """
+    merged: List[Dict[str, Any]] = []
+    mergeable = [f for f in fragments if isinstance(f["chunk_index"], int)]
+    others = [f for f in fragments if not isinstance(f["chunk_index"], int)]
+
+    mergeable.sort(key=lambda f: (str(f["source"]), f["chunk_index"]))
+    for fragment in mergeable:
+        previous = merged[-1] if merged else None
+        if (
+            previous is not None
+            and previous["source"] == fragment["source"]
+            and fragment["chunk_index"] == previous["last_chunk"] + 1
+        ):
+            overlap = _overlap_length(previous["text"], fragment["text"], max_overlap, min_overlap)
+            separator = "" if overlap else " "
+            previous["text"] = previous["text"] + separator + fragment["text"][overlap:]
+            previous["last_chunk"] = fragment["chunk_index"]
+            previous["priority"] = min(previous["priority"], fragment["priority"])
+            previous["pages"].extend(fragment["pages"])
+            previous["docs"].extend(fragment["docs"])
+        else:
+            merged.append({**fragment, "last_chunk": fragment["chunk_index"]})
+
+    return merged + others
+
+
+def build_context(
+    docs: List[Document],
+    max_tokens: int = CONTEXT_BUDGET_CONFIG["max_tokens"],
+    near_duplicate_threshold: float = CONTEXT_BUDGET_CONFIG["near_duplicate_threshold"],
+    verbose: bool = True
+) -> Tuple[str, List[Document], Dict[str, int]]:
+    """
+    Construye el contexto numerado para el LLM.
+
+    Pasos (cada uno registra los tokens que ahorra):
+    1. Duplicados exactos
+    2. Fusión de fragmentos contiguos (sin el solapamiento repetido)
+    3. Casi duplicados (Jaccard de shingles >= umbral), conservando el de mayor prioridad
+    4. Empaquetado por prioridad hasta max_tokens
+    5. Presentación ordenada por página
+
+    Args:
+        docs (List[Document]): Fragmentos en orden de prioridad (el de la búsqueda)
+        max_tokens (int): Presupuesto de tokens del contexto
+        near_duplicate_threshold (float): Umbral de casi duplicado
+        verbose (bool): Imprimir el resumen de ahorro
+
+    Returns:
+        Tuple[str, List[Document], Dict[str, int]]:
+            (contexto, documentos incluidos en orden de presentación, tokens tras cada paso)
+    """
+    config = CONTEXT_BUDGET_CONFIG
+    if not docs:
+        return "", [], {}
+
+    # Fragmentos de trabajo en orden de prioridad
+    fragments = []
+    for rank, doc in enumerate(docs):
+        fragments.append({
+            "text": _clean(doc.page_content),
+            "source": doc.metadata.get("source"),
+            "chunk_index": doc.metadata.get("chunk_index"),
+            "pages": [doc.metadata.get("page", "?")],
+            "priority": rank,
+            "docs": [doc],
+        })
+
+    def total_tokens(items: List[Dict[str, Any]]) -> int:
+        return sum(estimate_tokens(item["text"]) for item in items)
+
+    steps = {"entrada": total_tokens(fragments)}
+
+    # 1. Duplicados exactos (mismo texto, p. ej. el mismo PDF ingerido dos veces)
+    seen_hashes = set()
+    unique = []
+    for fragment in fragments:
+        digest = hashlib.sha1(fragment["text"].encode("utf-8")).hexdigest()
+        if digest not in seen_hashes:
+            seen_hashes.add(digest)
+            unique.append(fragment)
+    fragments = unique
+    steps["duplicados"] = total_tokens(fragments)
+
+    # 2. Fusión de contiguos
+    fragments = _merge_adjacent(fragments, config["max_overlap_chars"], config["min_overlap_chars"])
+    steps["fusion"] = total_tokens(fragments)
+
+    # 3. Casi duplicados, recorriendo por prioridad
+    fragments.sort(key=lambda f: f["priority"])
+    kept: List[Dict[str, Any]] = []
+    kept_shingles: List[Set[str]] = []
+    for fragment in fragments:
+        shingles = _shingles(fragment["text"], config["shingle_size"])
+        is_duplicate = any(
+            len(shingles & other) / len(shingles | other) >= near_duplicate_threshold
+            for other in kept_shingles
+        )
+        if not is_duplicate:
+            kept.append(fragment)
+            kept_shingles.append(shingles)
+    fragments = kept
+    steps["casi_duplicados"] = total_tokens(fragments)
+
+    # 4. Empaquetado por prioridad; lo que no cabe se salta (puede caber uno menor)
+    packed = []
+    used = 0
+    for fragment in fragments:
+        cost = estimate_tokens(fragment["text"]) + 10  # + cabecera "FRAGMENTO [i] (Pág x)"
+        if used + cost <= max_tokens:
+            packed.append(fragment)
+            used += cost
+    if not packed and fragments:
+        # Un único fragmento mayor que el presupuesto: se recorta
+        first = fragments[0]
+        first["text"] = first["text"][:max_tokens * config["chars_per_token"]]
+        packed.append(first)
+    steps["presupuesto"] = total_tokens(packed)
+
+    # 5. Presentación por página (los datos formales de la portada primero)
+    packed.sort(key=lambda f: (min((p for p in f["pages"] if isinstance(p, int)), default=999), f["priority"]))
+
+    blocks = []
+    included_docs = []
+    for i, fragment in enumerate(packed, 1):
+        blocks.append(f"FRAGMENTO [{i}] (Pág {_page_label(fragment['pages'])}):\n{fragment['text']}")
+        included_docs.extend(fragment["docs"])
+
+    if verbose:
+        _log_savings(steps, len(docs), len(packed))
+
+    return "\n\n".join(blocks), included_docs, steps
+
+
+def _log_savings(steps: Dict[str, int], docs_in: int, fragments_out: int):
+    """Imprime los tokens ahorrados por cada paso."""
+    names = list(steps.keys())
+    details = ", ".join(
+        f"{name} -{steps[prev] - steps[name]}"
+        for prev, name in zip(names, names[1:])
+    )
+    print(f"📦 [CONTEXT] {docs_in} fragmentos -> {fragments_out} | "
+          f"~{steps['entrada']} -> ~{steps[names[-1]]} tokens ({details})")
+
+
+if __name__ == "__main__":
+    # Demo: contexto de una consulta real antes y después del empaquetado
+    import sys
+    from rag_manager import get_rag_manager
+
+    query = " ".join(sys.argv[1:]) or "¿Quiénes son los tutores de la tesis?"
+    rag_mgr = get_rag_manager()
+    docs = rag_mgr.search(query, k=25)
+
+    raw = rag_mgr.format_context(docs)
+    context, packed_docs, _ = build_context(docs)
+    print(f"\nSin empaquetar: {len(raw)} caracteres (~{estimate_tokens(raw)} tokens)")
+    print(f"Empaquetado:    {len(context)} caracteres (~{estimate_tokens(context)} tokens), "
+          f"{len(packed_docs)}/{len(docs)} fragmentos originales")
@@ -0,0 +1,375 @@
+"""
+faiss_index.py - Construcción y evaluación de índices FAISS
+
+Este módulo encapsula:
+- Especificaciones de índice (Flat exacto, HNSW, IVF) como diccionarios simples
+- Construcción del índice a partir de la matriz de embeddings
+- Persistencia de la especificación junto al índice (index_spec.json)
+- Lectura del índice con memory-mapping (los vectores no se copian a RAM)
+- Herramienta de evaluación: recall@k frente a búsqueda exacta y latencias p50/p99
+
+Objetivo: Que el coste de búsqueda no crezca linealmente con el corpus cuando
+se ingiera el archivo completo de la universidad.
+
+Uso de la herramienta de evaluación:
+    python faiss_index.py --k 10 --queries 200
+"""
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+
+# --- CONFIGURACIÓN ---
+INDEX_SPEC_FILE = "index_spec.json"
+
+# Parámetros por defecto de cada tipo de índice
+DEFAULT_INDEX_PARAMS = {
+    "flat": {},                                               # Exacto (fuerza bruta)
+    "hnsw": {"M": 32, "ef_construction": 200, "ef_search": 64},
+    "ivf": {"nlist": 256, "nprobe": 16},
+}
+
+DEFAULT_INDEX_SPEC = {"type": "flat"}
+
+# Configuraciones comparadas por la herramienta de evaluación
+BENCHMARK_SPECS = [
+    {"type": "flat"},
+    {"type": "hnsw", "M": 16, "ef_search": 32},
+    {"type": "hnsw", "M": 32, "ef_search": 64},
+    {"type": "hnsw", "M": 32, "ef_search": 128},
+    {"type": "ivf", "nlist": 64, "nprobe": 4},
+    {"type": "ivf", "nlist": 64, "nprobe": 16},
+    {"type": "ivf", "nlist": 256, "nprobe": 16},
+]
+
+
+def normalize_index_spec(spec: Optional[Union[str, Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    Completa una especificación de índice con sus valores por defecto.
+
+    Acepta None (Flat), un nombre ("hnsw") o un diccionario parcial
+    ({"type": "ivf", "nlist": 1024}).
+
+    Args:
+        spec: Especificación a normalizar
+
+    Returns:
+        Dict[str, Any]: Especificación completa
+    """
+    if spec is None:
+        spec = DEFAULT_INDEX_SPEC
+    if isinstance(spec, str):
+        spec = {"type": spec}
+
+    index_type = spec.get("type", "flat").lower()
+    if index_type not in DEFAULT_INDEX_PARAMS:
+        raise ValueError(f"Tipo de índice desconocido: '{index_type}' (usa flat, hnsw o ivf)")
+
+    normalized = {"type": index_type, **DEFAULT_INDEX_PARAMS[index_type]}
+    normalized.update({key: value for key, value in spec.items() if key != "type"})
+    return normalized
+
+
+def describe_index_spec(spec: Dict[str, Any]) -> str:
+    """Descripción corta de una especificación (para logs y tablas)."""
+    spec = normalize_index_spec(spec)
+    params = ", ".join(f"{key}={value}" for key, value in spec.items() if key != "type")
+    return f"{spec['type'].upper()}({params})" if params else spec["type"].upper()
+
+
+def apply_search_params(index: faiss.Index, spec: Dict[str, Any]):
+    """
+    Aplica los parámetros de búsqueda (efSearch / nprobe) de la especificación.
+    Son parámetros de tiempo de consulta: se pueden cambiar sin reconstruir.
+    """
+    spec = normalize_index_spec(spec)
+    params = faiss.ParameterSpace()
+
+    if spec["type"] == "hnsw":
+        params.set_index_parameter(index, "efSearch", int(spec["ef_search"]))
+    elif spec["type"] == "ivf":
+        params.set_index_parameter(index, "nprobe", int(spec["nprobe"]))
+        # Reconstrucción por id (búsqueda filtrada exacta; ids no consecutivos -> hashtable)
+        faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.Hashtable)
+
+
+def search_parameters(spec: Dict[str, Any], selector: faiss.IDSelector) -> faiss.SearchParameters:
+    """
+    Parámetros de una búsqueda filtrada: el selector de ids más los parámetros
+    de consulta de la especificación (SearchParameters reemplaza a los del índice,
+    así que efSearch / nprobe deben repetirse aquí).
+    """
+    spec = normalize_index_spec(spec)
+    if spec["type"] == "hnsw":
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=int(spec["ef_search"]))
+    if spec["type"] == "ivf":
+        return faiss.SearchParametersIVF(sel=selector, nprobe=int(spec["nprobe"]))
+    return faiss.SearchParameters(sel=selector)
+
+
+def build_index(
+    vectors: np.ndarray,
+    spec: Optional[Dict[str, Any]] = None,
+    ids: Optional[np.ndarray] = None
+) -> faiss.Index:
+    """
+    Construye un índice FAISS (métrica L2, igual que FAISS.from_documents).
+
+    Los vectores se guardan con ids explícitos (los ids de los fragmentos en el
+    docstore): Flat y HNSW van envueltos en IndexIDMap2, IVF los admite de serie.
+
+    Args:
+        vectors (np.ndarray): Matriz (n, dim) de embeddings
+        spec: Especificación del índice (ver normalize_index_spec)
+        ids (np.ndarray): Id de cada vector (por defecto 0..n-1)
+
+    Returns:
+        faiss.Index: Índice con todos los vectores añadidos
+    """
+    spec = normalize_index_spec(spec)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    ids = np.arange(n, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+
+    if spec["type"] == "flat":
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+
+    elif spec["type"] == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dim, int(spec["M"]))
+        hnsw.hnsw.efConstruction = int(spec["ef_construction"])
+        index = faiss.IndexIDMap2(hnsw)
+
+    else:
+        nlist = int(spec["nlist"])
+        if n < nlist:
+            # No se pueden entrenar más centroides que vectores
+            nlist = max(1, n)
+            print(f"   ⚠️  Solo hay {n} vectores: nlist reducido a {nlist}")
+        elif n < 39 * nlist:
+            print(f"   ⚠️  {n} vectores es poco para entrenar {nlist} listas (FAISS recomienda >= {39 * nlist})")
+        spec["nlist"] = nlist
+        index = faiss.index_factory(dim, f"IVF{nlist},Flat")
+        index.train(vectors)
+
+    index.add_with_ids(vectors, ids)
+    apply_search_params(index, spec)
+    return index
+
+
+def read_index(path: str, spec: Optional[Dict[str, Any]] = None, mmap: bool = True) -> faiss.Index:
+    """
+    Lee un índice desde disco, por defecto con memory-mapping.
+
+    Con mmap los vectores no se copian a la RAM del proceso: el sistema
+    operativo los carga bajo demanda y las páginas se comparten entre todos
+    los workers que abren el mismo archivo. El índice queda en SOLO LECTURA.
+
+    Args:
+        path (str): Ruta de index.faiss
+        spec: Especificación del índice (decide el modo de mapeo)
+        mmap (bool): False para leerlo entero en memoria (p. ej. para modificarlo)
+
+    Returns:
+        faiss.Index: Índice con los parámetros de búsqueda aplicados
+    """
+    spec = normalize_index_spec(spec)
+    index = None
+
+    if mmap:
+        # IVF: listas invertidas mapeadas; Flat/HNSW: códigos planos mapeados sin copia
+        flag = faiss.IO_FLAG_MMAP if spec["type"] == "ivf" else getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+        if flag is not None:
+            try:
+                index = faiss.read_index(path, flag)
+            except RuntimeError as e:
+                print(f"   ⚠️  No se pudo mapear el índice ({e}); se carga en memoria")
+
+    if index is None:
+        index = faiss.read_index(path)
+
+    apply_search_params(index, spec)
+    return index
+
+
+def save_index_spec(db_path: str, spec: Dict[str, Any], index: faiss.Index, generation: Optional[str] = None):
+    """
+    Guarda la especificación del índice junto a la base de datos
+    (temporal + os.replace: un lector nunca ve el JSON a medio escribir).
+
+    Args:
+        db_path (str): Carpeta del vectorstore
+        spec: Especificación usada al construir
+        index (faiss.Index): Índice construido (para registrar tamaño y dimensión)
+        generation (str): Generación del vectorstore (la misma que guarda docstore.db)
+    """
+    payload = {
+        **normalize_index_spec(spec),
+        "dim": index.d,
+        "ntotal": index.ntotal,
+        "built_at": datetime.now().isoformat(),
+        "generation": generation,
+    }
+    path = os.path.join(db_path, INDEX_SPEC_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def load_index_spec_and_generation(db_path: str) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    Lee la especificación guardada y la generación del vectorstore en una
+    sola lectura. Los índices creados antes de existir index_spec.json son
+    Flat y no tienen generación.
+    """
+    path = os.path.join(db_path, INDEX_SPEC_FILE)
+    if not os.path.exists(path):
+        return normalize_index_spec(DEFAULT_INDEX_SPEC), None
+
+    with open(path, encoding="utf-8") as f:
+        payload = json.load(f)
+    generation = payload.get("generation")
+    payload = {key: value for key, value in payload.items()
+               if key not in ("dim", "ntotal", "built_at", "generation")}
+    return normalize_index_spec(payload), generation
+
+
+def load_index_spec(db_path: str) -> Dict[str, Any]:
+    """Lee la especificación guardada (ver load_index_spec_and_generation)."""
+    return load_index_spec_and_generation(db_path)[0]
+
+
+def index_ids(index: faiss.Index) -> np.ndarray:
+    """Ids almacenados en un índice (sin leer los vectores)."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        invlists = ivf.invlists
+        return np.concatenate([
+            faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+            for l in range(invlists.nlist)
+        ] or [np.empty(0, dtype=np.int64)])
+
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map)
+
+    # Índice sin ids (formato anterior): el id es la posición
+    return np.arange(index.ntotal, dtype=np.int64)
+
+
+def extract_vectors(index: faiss.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Recupera los ids y la matriz de vectores almacenados en un índice.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (ids, vectores) alineados por fila
+    """
+    ids = index_ids(index)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return ids, index.reconstruct_batch(ids)
+
+    if isinstance(index, faiss.IndexIDMap):
+        return ids, faiss.downcast_index(index.index).reconstruct_n(0, index.ntotal)
+
+    return ids, index.reconstruct_n(0, index.ntotal)
+
+
+# --- HERRAMIENTA DE EVALUACIÓN ---
+
+def evaluate_index_specs(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    specs: Optional[List[Dict[str, Any]]] = None,
+    k: int = 10
+) -> List[Dict[str, Any]]:
+    """
+    Compara configuraciones de índice frente a la búsqueda exacta.
+
+    Para cada especificación mide:
+    - build_seconds: tiempo de construcción
+    - recall@k: fracción de los k vecinos exactos que devuelve el índice
+    - p50_ms / p99_ms: latencia por consulta individual (como en producción)
+
+    Args:
+        vectors (np.ndarray): Corpus (n, dim)
+        queries (np.ndarray): Consultas (q, dim)
+        specs: Configuraciones a comparar (por defecto BENCHMARK_SPECS)
+        k (int): Vecinos a recuperar
+
+    Returns:
+        List[Dict[str, Any]]: Una fila de resultados por especificación
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    k = min(k, len(vectors))
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    results = []
+    for spec in specs or BENCHMARK_SPECS:
+        spec = normalize_index_spec(spec)
+
+        start = time.perf_counter()
+        index = build_index(vectors, dict(spec))
+        build_seconds = time.perf_counter() - start
+
+        latencies = []
+        found = np.empty_like(truth)
+        for i in range(len(queries)):
+            start = time.perf_counter()
+            _, ids = index.search(queries[i:i + 1], k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found[i] = ids[0]
+
+        hits = sum(len(set(found[i]) & set(truth[i])) for i in range(len(queries)))
+        results.append({
+            "spec": describe_index_spec(spec),
+            "build_seconds": round(build_seconds, 3),
+            f"recall@{k}": round(hits / (len(queries) * k), 4),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 4),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 4),
+        })
+
+    return results
+
+
+def print_evaluation(results: List[Dict[str, Any]]):
+    """Imprime los resultados de evaluate_index_specs como tabla."""
+    if not results:
+        return
+    headers = list(results[0].keys())
+    widths = [max(len(h), *(len(str(row[h])) for row in results)) for h in headers]
+
+    print(" | ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    print("-+-".join("-" * w for w in widths))
+    for row in results:
+        print(" | ".join(str(row[h]).ljust(w) for h, w in zip(headers, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evalúa recall@k y latencia de configuraciones FAISS")
+    parser.add_argument("--db-path", default="vectorstore_faiss", help="Carpeta del vectorstore")
+    parser.add_argument("--k", type=int, default=10, help="Vecinos a recuperar")
+    parser.add_argument("--queries", type=int, default=200, help="Consultas muestreadas del corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("\n=== Evaluación de índices FAISS ===\n")
+
+    _, corpus = extract_vectors(faiss.read_index(os.path.join(args.db_path, "index.faiss")))
+    print(f"📚 Corpus: {corpus.shape[0]} vectores de dimensión {corpus.shape[1]}")
+
+    # Consultas: vectores del corpus con ruido (simulan preguntas cercanas a un fragmento)
+    rng = np.random.default_rng(args.seed)
+    sample = corpus[rng.choice(len(corpus), size=min(args.queries, len(corpus)), replace=False)]
+    sample = sample + rng.normal(scale=0.05, size=sample.shape).astype(np.float32)
+
+    print_evaluation(evaluate_index_specs(corpus, sample, k=args.k))
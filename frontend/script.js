@@ -8,6 +8,8 @@ document.addEventListener("DOMContentLoaded", () => {
 
   // URL de tu API de FastAPI
   const API_URL = "http://127.0.0.1:8000/chat";
+  // Endpoint SSE: la respuesta llega token a token
+  const STREAM_URL = "http://127.0.0.1:8000/chat/stream";
 
   // NUEVO: Variable para guardar el thread_id de la sesión actual
   let currentThreadId = null;
@@ -22,46 +24,7 @@ document.addEventListener("DOMContentLoaded", () => {
     );
 
     if (sender === "bot") {
-      // **ETAPA 2.4: Parsear respuesta para separar contenido de fuentes**
-      const parts = text.split("FUENTES CONSULTADAS:");
-      const responseText = parts[0].trim();
-      const sourcesText = parts[1] ? parts[1].trim() : null;
-
-      // Formatear respuesta principal
-      let content = responseText.replace(/\n/g, "<br>");
-
-      // Agregar sección de fuentes si existen
-      if (sourcesText) {
-        // Parsear líneas de fuentes (formato: "- [Documento] (página X)")
-        const sourceLines = sourcesText
-          .split("\n")
-          .filter((line) => line.trim().startsWith("-"))
-          .map((line) => line.trim());
-
-        content += `
-          <div class="sources-section">
-            <h4>📚 FUENTES CONSULTADAS:</h4>
-            <ul class="sources-list">
-              ${sourceLines
-                .map((source) => {
-                  // Remover el guion inicial
-                  const cleanSource = source.substring(1).trim();
-                  return `<li>${cleanSource}</li>`;
-                })
-                .join("")}
-            </ul>
-          </div>
-        `;
-      } else {
-        // Si no hay fuentes, indicar que es conocimiento general
-        content += `
-          <div class="sources-section">
-            <p class="general-knowledge">📖 Respuesta basada en conocimiento general</p>
-          </div>
-        `;
-      }
-
-      messageDiv.innerHTML = content;
+      renderBotMessage(messageDiv, text);
     } else {
       // Mensaje del usuario sin procesar
       let content = text.replace(/\n/g, "<br>");
@@ -70,6 +33,116 @@ document.addEventListener("DOMContentLoaded", () => {
 
     chatMessages.appendChild(messageDiv);
     chatMessages.scrollTop = chatMessages.scrollHeight; // Scroll automático
+    return messageDiv;
+  }
+
+  // Renderiza el texto del bot (respuesta + sección de fuentes) en un div
+  function renderBotMessage(messageDiv, text) {
+    // **ETAPA 2.4: Parsear respuesta para separar contenido de fuentes**
+    const parts = text.split("FUENTES CONSULTADAS:");
+    const responseText = parts[0].trim();
+    const sourcesText = parts[1] ? parts[1].trim() : null;
+
+    // Formatear respuesta principal
+    let content = responseText.replace(/\n/g, "<br>");
+
+    // Agregar sección de fuentes si existen
+    if (sourcesText) {
+      // Parsear líneas de fuentes (formato: "- [Documento] (página X)")
+      const sourceLines = sourcesText
+        .split("\n")
+        .filter((line) => line.trim().startsWith("-"))
+        .map((line) => line.trim());
+
+      content += `
+        <div class="sources-section">
+          <h4>📚 FUENTES CONSULTADAS:</h4>
+          <ul class="sources-list">
+            ${sourceLines
+              .map((source) => {
+                // Remover el guion inicial
+                const cleanSource = source.substring(1).trim();
+                return `<li>${cleanSource}</li>`;
+              })
+              .join("")}
+          </ul>
+        </div>
+      `;
+    } else {
+      // Si no hay fuentes, indicar que es conocimiento general
+      content += `
+        <div class="sources-section">
+          <p class="general-knowledge">📖 Respuesta basada en conocimiento general</p>
+        </div>
+      `;
+    }
+
+    messageDiv.innerHTML = content;
+  }
+
+  // Lee la respuesta SSE de /chat/stream y va pintando los tokens.
+  // Al final (evento "sources"/"done") se re-renderiza con la sección de fuentes.
+  async function streamChat(message) {
+    const response = await fetch(STREAM_URL, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({
+        user_input: message,
+        thread_id: currentThreadId,
+      }),
+    });
+
+    if (!response.ok || !response.body) {
+      throw new Error(`HTTP ${response.status}`);
+    }
+
+    const botDiv = addMessage("", "bot");
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let answer = "";
+    let sources = "";
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      // Los eventos SSE se separan por una línea en blanco
+      let separator;
+      while ((separator = buffer.indexOf("\n\n")) !== -1) {
+        const rawEvent = buffer.slice(0, separator);
+        buffer = buffer.slice(separator + 2);
+
+        let eventName = "message";
+        let dataLine = "";
+        rawEvent.split("\n").forEach((line) => {
+          if (line.startsWith("event:")) eventName = line.slice(6).trim();
+          if (line.startsWith("data:")) dataLine += line.slice(5).trim();
+        });
+        const data = dataLine ? JSON.parse(dataLine) : {};
+
+        if (eventName === "start") {
+          if (data.thread_id && !currentThreadId) {
+            saveSessionId(data.thread_id);
+          }
+          apiStatusSpan.textContent = "Escribiendo...";
+        } else if (eventName === "token") {
+          answer += data.text;
+          botDiv.innerHTML = answer.replace(/\n/g, "<br>");
+          chatMessages.scrollTop = chatMessages.scrollHeight;
+        } else if (eventName === "sources") {
+          sources = data.text;
+        } else if (eventName === "done") {
+          renderBotMessage(botDiv, `${answer}\n${sources}`);
+          chatMessages.scrollTop = chatMessages.scrollHeight;
+        } else if (eventName === "error") {
+          botDiv.innerHTML = `❌ Error del Agente: ${data.response}`;
+        }
+      }
+    }
   }
 
   // Función para mostrar/ocultar el spinner
@@ -133,6 +206,20 @@ document.addEventListener("DOMContentLoaded", () => {
     userInput.value = "";
     toggleLoading(true);
 
+    try {
+      await streamChat(message);
+    } catch (streamError) {
+      // Fallback: endpoint clásico (respuesta completa en JSON)
+      console.warn("Streaming no disponible, usando /chat:", streamError);
+      await sendClassic(message);
+    } finally {
+      toggleLoading(false);
+      checkApiStatus(); // Re-chequea el estado después de la interacción
+    }
+  });
+
+  // Envío clásico a /chat (respuesta completa en un único JSON)
+  async function sendClassic(message) {
     try {
       const response = await fetch(API_URL, {
         method: "POST",
@@ -163,9 +250,6 @@ document.addEventListener("DOMContentLoaded", () => {
         "❌ Error de conexión. Asegúrate de que FastAPI esté corriendo en http://127.0.0.1:8000.",
         "bot"
       );
-    } finally {
-      toggleLoading(false);
-      checkApiStatus(); // Re-chequea el estado después de la interacción
     }
-  });
+  }
 });
@@ -5,12 +5,15 @@ NOTA: Este script ahora es una interfaz simplificada hacia ingest_pdf.py
       para mantener compatibilidad hacia atrás.
 
 Uso:
-    python ingest_data.py
+    python ingest_data.py                           # PDF_PATH
+    python ingest_data.py --dir data/ --workers 4   # Carpeta completa en paralelo
+    python ingest_data.py --dir data/ --full        # Reconstruir el índice desde cero
 """
 
+import argparse
 import os
 from dotenv import load_dotenv
-from ingest_pdf import ingest_pdf_simple
+from ingest_pdf import DIRECTORY_INGEST_CONFIG, PDFIngestor, ingest_pdf_simple
 
 # Cargar variables de entorno
 load_dotenv()
@@ -19,6 +22,16 @@ load_dotenv()
 PDF_PATH = "./data/info_prueba.pdf"
 DB_FAISS_PATH = "vectorstore_faiss"
 
+# Tipo de índice FAISS. None = Flat (exacto, suficiente para pocos documentos).
+# Para el archivo completo: {"type": "hnsw", "M": 32, "ef_search": 64}
+#                       o   {"type": "ivf", "nlist": 256, "nprobe": 16}
+# Compara configuraciones con: python faiss_index.py
+INDEX_SPEC = None
+
+# Ingesta incremental: solo se vectorizan los fragmentos nuevos o modificados.
+# False = reconstruir todo el índice (necesario, p. ej., al cambiar INDEX_SPEC)
+INCREMENTAL = True
+
 
 def create_vector_db():
     """
@@ -27,11 +40,46 @@ def create_vector_db():
     Esta función mantiene compatibilidad con el código anterior.
     Internamente usa la clase PDFIngestor para la ingesta.
     """
-    success = ingest_pdf_simple(PDF_PATH, DB_FAISS_PATH)
+    success = ingest_pdf_simple(PDF_PATH, DB_FAISS_PATH, INDEX_SPEC, incremental=INCREMENTAL)
     
     if not success:
         print(f"\n❌ La ingesta falló. Verifica que el archivo exista en: {PDF_PATH}")
 
 
+def create_vector_db_from_directory(
+    dir_path: str,
+    workers: int = DIRECTORY_INGEST_CONFIG["workers"],
+    incremental: bool = INCREMENTAL
+):
+    """
+    Ingesta todos los PDF de una carpeta en un único índice.
+    
+    Args:
+        dir_path (str): Carpeta con los PDF
+        workers (int): Procesos de parseo en paralelo
+        incremental (bool): Omitir archivos sin cambios y conservar el resto del índice
+    """
+    ingestor = PDFIngestor(db_path=DB_FAISS_PATH, index_spec=INDEX_SPEC)
+    report = ingestor.ingest_directory(dir_path, workers=workers, incremental=incremental)
+    
+    failed = [row["file"] for row in report if row["status"].startswith("error")]
+    if failed:
+        print(f"\n⚠️  {len(failed)} archivo(s) no se pudieron ingerir")
+
+
 if __name__ == "__main__":
-    create_vector_db()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Ingesta de PDFs en la base de datos vectorial")
+    parser.add_argument("--dir", help="Carpeta de PDFs a ingerir (por defecto: solo PDF_PATH)")
+    parser.add_argument("--workers", type=int, default=DIRECTORY_INGEST_CONFIG["workers"],
+                        help="Procesos de parseo en paralelo")
+    parser.add_argument("--full", action="store_true",
+                        help="Reconstruir el índice completo en lugar de actualizarlo")
+    args = parser.parse_args()
+    
+    if args.full:
+        INCREMENTAL = False
+    
+    if args.dir:
+        create_vector_db_from_directory(args.dir, args.workers, incremental=INCREMENTAL)
+    else:
+        create_vector_db()
\ No newline at end of file
@@ -4,30 +4,90 @@ ingest_pdf.py - Ingesta de documentos PDF
 Este módulo encapsula la lógica para:
 - Cargar archivos PDF
 - Fragmentar y procesar contenido
-- Crear bases de datos vectoriales FAISS
+- Crear bases de datos vectoriales FAISS (índice + docstore SQLite)
 - Gestionar metadatos de documentos
+- Ingesta incremental: añadir/reemplazar un PDF sin re-vectorizar el resto
+- Ingesta de carpetas completas: parseo en paralelo (pool de procesos) y
+  una única etapa de embeddings que escribe un solo índice
 
 Objetivo: Modularizar la ingesta para soportar múltiples formatos (OCR, imágenes, etc.)
 """
 
+import contextlib
+import io
+import multiprocessing
 import os
-from typing import List, Optional
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
 from dotenv import load_dotenv
 from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import FAISS
 from langchain_core.documents import Document
 
+from faiss_index import describe_index_spec, normalize_index_spec
+from vectorstore import LocalVectorStore
+
 from ingest_utils import (
     load_embeddings,
     split_documents,
     add_chunk_metadata,
     add_document_summary,
-    validate_file
+    validate_file,
+    compute_file_hash,
+    CHUNK_CONFIG
 )
+from vectorstore import content_hash
 
 # --- CONFIGURACIÓN ---
 load_dotenv()
 
+DIRECTORY_INGEST_CONFIG = {
+    "workers": max(1, (os.cpu_count() or 2) - 1),  # Procesos de parseo
+    "embedding_batch_size": 256                    # Fragmentos por llamada al encoder
+}
+
+
+def _parse_pdf_worker(pdf_path: str, chunk_size: int, chunk_overlap: int) -> Dict[str, Any]:
+    """
+    Tarea de un proceso del pool: carga y fragmenta UN PDF.
+
+    Solo hace trabajo de CPU (PyPDF + splitter); los resúmenes (red) y los
+    embeddings (modelo) se hacen en el proceso principal.
+
+    Returns:
+        Dict: pdf_path, pages, chunks (List[Document]), parse_seconds, error
+    """
+    start = time.perf_counter()
+    try:
+        # Los mensajes de progreso por archivo se silencian: el informe final los resume
+        with contextlib.redirect_stdout(io.StringIO()):
+            pages = PyPDFLoader(pdf_path).load()
+            chunks = add_chunk_metadata(split_documents(pages, chunk_size, chunk_overlap))
+        return {
+            "pdf_path": pdf_path,
+            "pages": len(pages),
+            "chunks": chunks,
+            "parse_seconds": time.perf_counter() - start,
+            "error": None,
+        }
+    except Exception as e:
+        return {
+            "pdf_path": pdf_path,
+            "pages": 0,
+            "chunks": [],
+            "parse_seconds": time.perf_counter() - start,
+            "error": str(e),
+        }
+
+
+def find_pdfs(dir_path: str) -> List[str]:
+    """Lista (recursiva y ordenada) de los PDF de una carpeta."""
+    pdfs = []
+    for root, _, files in os.walk(dir_path):
+        pdfs.extend(os.path.join(root, name) for name in files if name.lower().endswith(".pdf"))
+    return sorted(pdfs)
+
 
 class PDFIngestor:
     """
@@ -39,14 +99,17 @@ class PDFIngestor:
     - Crear base de datos vectorial
     """
     
-    def __init__(self, db_path: str = "vectorstore_faiss"):
+    def __init__(self, db_path: str = "vectorstore_faiss", index_spec: Optional[Dict[str, Any]] = None):
         """
         Inicializa el ingestor PDF.
         
         Args:
             db_path (str): Ruta donde se guardará la base de datos FAISS
+            index_spec (Dict): Tipo de índice FAISS, p. ej. {"type": "hnsw", "M": 32, "ef_search": 64}
+                               o {"type": "ivf", "nlist": 256, "nprobe": 16}. None = Flat (exacto)
         """
         self.db_path = db_path
+        self.index_spec = normalize_index_spec(index_spec)
         self.embeddings = None
     
     def load_pdf(self, pdf_path: str) -> Optional[List[Document]]:
@@ -115,23 +178,35 @@ class PDFIngestor:
             print(f"❌ ERROR al procesar documentos: {e}")
             return None
     
-    def create_vectorstore(self, documents: List[Document]) -> Optional[FAISS]:
+    def embed_documents(self, documents: List[Document]) -> np.ndarray:
         """
-        Crea una base de datos vectorial FAISS.
+        Vectoriza los fragmentos (carga el modelo de embeddings si hace falta).
+        
+        Returns:
+            np.ndarray: Matriz (len(documents), dim) en float32
+        """
+        if not self.embeddings:
+            self.embeddings = load_embeddings()
+        return np.asarray(
+            self.embeddings.embed_documents([doc.page_content for doc in documents]),
+            dtype=np.float32
+        )
+    
+    def create_vectorstore(self, documents: List[Document]) -> Optional[LocalVectorStore]:
+        """
+        Crea una base de datos vectorial FAISS con el tipo de índice configurado.
         
         Args:
             documents (List[Document]): Documentos a vectorizar
             
         Returns:
-            Optional[FAISS]: Vectorstore creado o None si falla
+            Optional[LocalVectorStore]: Vectorstore creado o None si falla
         """
         try:
-            # Cargar embeddings si no están cargados
-            if not self.embeddings:
-                self.embeddings = load_embeddings()
-            
-            print("💾 Creando base de datos vectorial FAISS...")
-            vectorstore = FAISS.from_documents(documents, self.embeddings)
+            print(f"💾 Creando base de datos vectorial FAISS ({describe_index_spec(self.index_spec)})...")
+            vectors = self.embed_documents(documents)
+            # El id de cada vector en FAISS es el id del fragmento en docstore.db
+            vectorstore = LocalVectorStore.build(documents, vectors, self.index_spec)
             print(f"   ✅ Base de datos creada con {len(documents)} fragmentos")
             
             return vectorstore
@@ -140,19 +215,20 @@ class PDFIngestor:
             print(f"❌ ERROR al crear vectorstore: {e}")
             return None
     
-    def save_vectorstore(self, vectorstore: FAISS) -> bool:
+    def save_vectorstore(self, vectorstore: LocalVectorStore) -> bool:
         """
-        Guarda la base de datos vectorial en disco.
+        Guarda la base de datos vectorial en disco
+        (index.faiss + docstore.db + index_spec.json).
         
         Args:
-            vectorstore (FAISS): Base de datos a guardar
+            vectorstore (LocalVectorStore): Base de datos a guardar
             
         Returns:
             bool: True si se guardó correctamente
         """
         try:
             print(f"💾 Guardando base de datos en '{self.db_path}'...")
-            vectorstore.save_local(self.db_path)
+            vectorstore.save(self.db_path)
             print(f"✅ ¡ÉXITO! Base de datos guardada correctamente")
             return True
             
@@ -160,11 +236,96 @@ class PDFIngestor:
             print(f"❌ ERROR al guardar base de datos: {e}")
             return False
     
-    def ingest_pdf(
+    def update_vectorstore(
         self,
         pdf_path: str,
         chunk_size: int = 1000,
         chunk_overlap: int = 200
+    ) -> bool:
+        """
+        Ingesta incremental de un PDF sobre el vectorstore existente.
+        
+        1. Si el hash del archivo coincide con el ya ingerido, no se hace nada
+           (ni siquiera se parsea el PDF)
+        2. Si la fuente existía con otro contenido, se eliminan los fragmentos
+           que ya no aparecen y se conservan (sin re-vectorizar) los idénticos
+        3. Se descartan los fragmentos cuyo contenido ya está indexado
+        4. Solo los fragmentos nuevos se vectorizan y se añaden al índice
+        
+        La fuente se identifica por metadata["source"] (la ruta del PDF tal
+        como la recibe PyPDFLoader).
+        
+        Args:
+            pdf_path (str): Ruta del PDF
+            chunk_size (int): Tamaño de fragmento
+            chunk_overlap (int): Superposición
+            
+        Returns:
+            bool: True si el vectorstore quedó actualizado
+        """
+        if not LocalVectorStore.exists(self.db_path):
+            print("ℹ️  No hay base de datos previa: se crea desde cero")
+            return self.ingest_pdf(pdf_path, chunk_size, chunk_overlap)
+        
+        if not validate_file(pdf_path, "PDF"):
+            return False
+        
+        try:
+            vectorstore = LocalVectorStore.load(self.db_path, writable=True)
+        except Exception as e:
+            print(f"❌ ERROR al abrir la base de datos existente: {e}")
+            return False
+        
+        if vectorstore.index_spec["type"] != self.index_spec["type"]:
+            print(f"⚠️  Se conserva el índice existente ({describe_index_spec(vectorstore.index_spec)}); "
+                  f"para cambiarlo, re-ingiere sin modo incremental")
+        
+        # Paso 1: ¿Cambió el archivo?
+        file_hash = compute_file_hash(pdf_path)
+        if vectorstore.source_hash(pdf_path) == file_hash:
+            print(f"⏭️  Sin cambios desde la última ingesta: {pdf_path}")
+            return True
+        
+        # Paso 2: Cargar y procesar (fragmentar, metadatos, resúmenes)
+        documents = self.load_pdf(pdf_path)
+        if not documents:
+            return False
+        processed_docs = self.process_documents(documents, chunk_size, chunk_overlap)
+        if not processed_docs:
+            return False
+        
+        try:
+            # Paso 3: Sincronizar con la versión anterior de la fuente
+            new_docs, kept, removed = vectorstore.update_source(pdf_path, processed_docs)
+            if removed:
+                print(f"🗑️  Eliminados {removed} fragmentos de la versión anterior")
+            if kept:
+                print(f"♻️  {kept} fragmentos sin cambios conservados")
+            
+            # Paso 4: Vectorizar solo lo que no está indexado
+            duplicates = len(processed_docs) - kept - len(new_docs)
+            if duplicates:
+                print(f"♻️  {duplicates} fragmentos duplicados omitidos (hash de contenido)")
+            
+            if new_docs:
+                print(f"💾 Vectorizando {len(new_docs)} fragmentos nuevos...")
+                vectorstore.add_documents(new_docs, self.embed_documents(new_docs))
+            
+            vectorstore.record_source(pdf_path, file_hash, duplicates)
+            print(f"   ✅ Índice actualizado: {vectorstore.ntotal} vectores en total")
+            
+        except Exception as e:
+            print(f"❌ ERROR al actualizar vectorstore: {e}")
+            return False
+        
+        return self.save_vectorstore(vectorstore)
+    
+    def ingest_pdf(
+        self,
+        pdf_path: str,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 200,
+        incremental: bool = False
     ) -> bool:
         """
         Pipeline completo de ingesta de PDF.
@@ -183,6 +344,8 @@ class PDFIngestor:
             pdf_path (str): Ruta del PDF
             chunk_size (int): Tamaño de fragmento
             chunk_overlap (int): Superposición
+            incremental (bool): Actualizar el vectorstore existente en lugar de
+                                sobrescribirlo (ver update_vectorstore)
             
         Returns:
             bool: True si todo fue exitoso
@@ -191,6 +354,9 @@ class PDFIngestor:
         print(f"INGESTA DE PDF: {pdf_path}")
         print(f"{'='*60}\n")
         
+        if incremental:
+            return self.update_vectorstore(pdf_path, chunk_size, chunk_overlap)
+        
         # Paso 1: Cargar PDF
         documents = self.load_pdf(pdf_path)
         if not documents:
@@ -205,6 +371,8 @@ class PDFIngestor:
         vectorstore = self.create_vectorstore(processed_docs)
         if not vectorstore:
             return False
+        # Registrar el archivo para que una ingesta incremental posterior lo omita
+        vectorstore.record_source(pdf_path, compute_file_hash(pdf_path))
         
         # Paso 4: Guardar
         success = self.save_vectorstore(vectorstore)
@@ -212,9 +380,176 @@ class PDFIngestor:
         return success
 
 
+    def ingest_directory(
+        self,
+        dir_path: str,
+        workers: int = DIRECTORY_INGEST_CONFIG["workers"],
+        incremental: bool = True,
+        chunk_size: int = CHUNK_CONFIG["chunk_size"],
+        chunk_overlap: int = CHUNK_CONFIG["chunk_overlap"],
+        batch_size: int = DIRECTORY_INGEST_CONFIG["embedding_batch_size"],
+        add_summaries: bool = True
+    ) -> List[Dict[str, Any]]:
+        """
+        Ingesta de todos los PDF de una carpeta.
+        
+        Pipeline:
+        1. (incremental) Se omiten los archivos cuyo hash no cambió
+        2. Un pool de procesos parsea y fragmenta los PDF en paralelo
+        3. A medida que cada archivo termina: resumen + deduplicación, y sus
+           fragmentos nuevos pasan a la cola de la etapa de embeddings
+        4. La etapa de embeddings (un solo modelo, proceso principal) vectoriza
+           por lotes de batch_size mientras el pool sigue parseando
+        5. Se escribe UN índice con todo (se guarda una sola vez)
+        
+        Args:
+            dir_path (str): Carpeta con los PDF (se recorre recursivamente)
+            workers (int): Procesos de parseo
+            incremental (bool): Actualizar el vectorstore existente (False = reconstruir)
+            chunk_size (int): Tamaño de fragmento
+            chunk_overlap (int): Superposición
+            batch_size (int): Fragmentos por llamada al encoder
+            add_summaries (bool): Generar el resumen de cada documento
+            
+        Returns:
+            List[Dict]: Informe por archivo (estado, páginas, fragmentos, tiempos)
+        """
+        print(f"\n{'='*60}")
+        print(f"INGESTA DE CARPETA: {dir_path} ({workers} procesos)")
+        print(f"{'='*60}\n")
+        
+        run_start = time.perf_counter()
+        pdfs = find_pdfs(dir_path)
+        if not pdfs:
+            print(f"❌ No se encontraron PDF en {dir_path}")
+            return []
+        
+        vectorstore = None
+        if incremental and LocalVectorStore.exists(self.db_path):
+            vectorstore = LocalVectorStore.load(self.db_path, writable=True)
+        
+        report = {pdf: {"file": pdf, "status": "pendiente", "pages": 0, "chunks": 0, "new_chunks": 0,
+                        "hash_seconds": 0.0, "parse_seconds": 0.0, "summary_seconds": 0.0}
+                  for pdf in pdfs}
+        
+        # Paso 1: hash de cada archivo (barato frente a parsear)
+        file_hashes = {}
+        to_parse = []
+        for pdf in pdfs:
+            start = time.perf_counter()
+            file_hashes[pdf] = compute_file_hash(pdf)
+            report[pdf]["hash_seconds"] = time.perf_counter() - start
+            if vectorstore is not None and vectorstore.source_hash(pdf) == file_hashes[pdf]:
+                report[pdf]["status"] = "sin cambios"
+            else:
+                to_parse.append(pdf)
+        
+        print(f"📂 {len(pdfs)} PDF encontrados, {len(to_parse)} por procesar")
+        
+        pending_docs: List[Document] = []
+        embedded: List[Tuple[List[Document], np.ndarray]] = []
+        seen_hashes = set()
+        duplicates_by_source = {}
+        embed_seconds = 0.0
+        
+        def flush(force: bool = False):
+            """Etapa de embeddings: vectoriza la cola por lotes."""
+            nonlocal pending_docs, embed_seconds
+            while pending_docs and (force or len(pending_docs) >= batch_size):
+                batch, pending_docs = pending_docs[:batch_size], pending_docs[batch_size:]
+                start = time.perf_counter()
+                embedded.append((batch, self.embed_documents(batch)))
+                embed_seconds += time.perf_counter() - start
+        
+        if to_parse:
+            # "spawn": los procesos no heredan el modelo de embeddings ni clientes de red
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=context) as pool:
+                futures = [
+                    pool.submit(_parse_pdf_worker, pdf, chunk_size, chunk_overlap)
+                    for pdf in to_parse
+                ]
+                for future in as_completed(futures):
+                    result = future.result()
+                    pdf = result["pdf_path"]
+                    entry = report[pdf]
+                    entry.update(pages=result["pages"], parse_seconds=result["parse_seconds"])
+                    
+                    if result["error"] or not result["chunks"]:
+                        entry["status"] = f"error: {result['error'] or 'sin texto'}"
+                        print(f"   ❌ {os.path.basename(pdf)}: {entry['status']}")
+                        continue
+                    
+                    chunks = result["chunks"]
+                    if add_summaries:
+                        start = time.perf_counter()
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            chunks = add_document_summary(chunks, use_ai_summary=True)
+                        entry["summary_seconds"] = time.perf_counter() - start
+                    
+                    kept = 0
+                    if vectorstore is not None:
+                        candidates, kept, _ = vectorstore.update_source(pdf, chunks)
+                    else:
+                        candidates = chunks
+                    
+                    # Deduplicación también entre archivos de esta misma ejecución
+                    new_docs = []
+                    for doc in candidates:
+                        doc_hash = content_hash(doc.page_content)
+                        if doc_hash not in seen_hashes:
+                            seen_hashes.add(doc_hash)
+                            new_docs.append(doc)
+                    
+                    entry.update(status="ok", chunks=len(chunks), new_chunks=len(new_docs))
+                    duplicates_by_source[pdf] = len(chunks) - kept - len(new_docs)
+                    print(f"   ✅ {os.path.basename(pdf)}: {len(chunks)} fragmentos "
+                          f"({len(new_docs)} nuevos) en {result['parse_seconds']:.2f}s")
+                    
+                    pending_docs.extend(new_docs)
+                    flush()
+        
+        flush(force=True)
+        
+        # Paso 5: un solo índice para todo
+        documents = [doc for batch, _ in embedded for doc in batch]
+        if documents:
+            vectors = np.vstack([batch_vectors for _, batch_vectors in embedded])
+            if vectorstore is None:
+                print(f"💾 Creando índice ({describe_index_spec(self.index_spec)}) con {len(documents)} fragmentos...")
+                vectorstore = LocalVectorStore.build(documents, vectors, self.index_spec)
+            else:
+                vectorstore.add_documents(documents, vectors)
+        
+        parsed_ok = [pdf for pdf in to_parse if report[pdf]["status"] == "ok"]
+        if vectorstore is not None and parsed_ok:
+            for pdf in parsed_ok:
+                vectorstore.record_source(pdf, file_hashes[pdf], duplicates_by_source[pdf])
+            self.save_vectorstore(vectorstore)
+        
+        print_ingest_report(list(report.values()), embed_seconds, time.perf_counter() - run_start)
+        return list(report.values())
+
+
+def print_ingest_report(rows: List[Dict[str, Any]], embed_seconds: float, total_seconds: float):
+    """Imprime el informe de tiempos por archivo de ingest_directory."""
+    print(f"\n{'ARCHIVO':<40} {'ESTADO':<14} {'PÁG':>5} {'FRAG':>6} {'NUEVOS':>7} "
+          f"{'HASH s':>7} {'PARSEO s':>9} {'RESUMEN s':>10}")
+    for row in rows:
+        name = os.path.basename(row["file"])
+        name = name if len(name) <= 40 else name[:37] + "..."
+        print(f"{name:<40} {row['status'][:14]:<14} {row['pages']:>5} {row['chunks']:>6} "
+              f"{row['new_chunks']:>7} {row['hash_seconds']:>7.3f} {row['parse_seconds']:>9.2f} "
+              f"{row['summary_seconds']:>10.2f}")
+    new_chunks = sum(row["new_chunks"] for row in rows)
+    print(f"\n⏱️  Embeddings: {new_chunks} fragmentos en {embed_seconds:.2f}s | Total: {total_seconds:.2f}s")
+
+
 def ingest_pdf_simple(
     pdf_path: str,
-    db_path: str = "vectorstore_faiss"
+    db_path: str = "vectorstore_faiss",
+    index_spec: Optional[Dict[str, Any]] = None,
+    incremental: bool = False
 ) -> bool:
     """
     Función simplificada para ingesta de PDF.
@@ -224,12 +559,14 @@ def ingest_pdf_simple(
     Args:
         pdf_path (str): Ruta del PDF
         db_path (str): Ruta de la base de datos FAISS
+        index_spec (Dict): Tipo de índice FAISS (None = Flat)
+        incremental (bool): Añadir/reemplazar el PDF en el vectorstore existente
         
     Returns:
         bool: True si exitoso
     """
-    ingestor = PDFIngestor(db_path=db_path)
-    return ingestor.ingest_pdf(pdf_path)
+    ingestor = PDFIngestor(db_path=db_path, index_spec=index_spec)
+    return ingestor.ingest_pdf(pdf_path, incremental=incremental)
 
 
 if __name__ == "__main__":
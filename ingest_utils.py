@@ -2,21 +2,36 @@
 ingest_utils.py - Utilidades para ingesta de documentos
 
 Este módulo contiene funciones auxiliares reutilizables para:
-- Cargar embeddings
+- Cargar embeddings (con caché persistente por hash de texto)
+- Resúmenes de documento (caché persistente, generación concurrente, LLM
+  intercambiable por un stub local para trabajar sin conexión)
 - Crear bases de datos vectoriales
 - Validar archivos
 - Configuración de parámetros
 """
 
+import hashlib
 import os
-from typing import Dict, List
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional, Union
 from datetime import datetime
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
+from langchain_core.messages import AIMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
 
+from persistent_cache import (
+    CachedEmbeddings,
+    SQLiteCache,
+    CACHE_DIR,
+    EMBEDDING_CACHE_CONFIG,
+    text_hash
+)
+
 # Cargar configuración
 load_dotenv()
 
@@ -29,20 +44,42 @@ CHUNK_CONFIG = {
     "chunk_overlap": 200     # Superposición entre fragmentos
 }
 
+# Resúmenes de documento
+SUMMARY_MODEL = "gemini-robotics-er-1.5-preview"
+SUMMARY_CONFIG = {
+    "llm": os.getenv("SUMMARY_LLM", "gemini"),          # "gemini" o "stub" (sin conexión)
+    "cache_path": os.path.join(CACHE_DIR, "summaries.db"),
+    "max_workers": 4,                                   # Resúmenes simultáneos (llamadas de red)
+    "input_chars": 5000                                 # Texto del documento enviado al LLM
+}
+
 
-def load_embeddings(model_name: str = EMBEDDING_MODEL) -> HuggingFaceEmbeddings:
+def load_embeddings(
+    model_name: str = EMBEDDING_MODEL,
+    use_cache: bool = True,
+    cache_path: str = EMBEDDING_CACHE_CONFIG["path"]
+) -> Union[CachedEmbeddings, HuggingFaceEmbeddings]:
     """
     Carga el modelo de embeddings.
     
+    Por defecto lo envuelve en una caché persistente (modelo, sha256 del texto):
+    re-ingerir fragmentos idénticos o repetir consultas no vuelve a ejecutar el encoder.
+    
     Args:
         model_name (str): Nombre del modelo de HuggingFace a usar
+        use_cache (bool): Envolver el modelo en CachedEmbeddings
+        cache_path (str): Archivo SQLite de la caché
         
     Returns:
-        HuggingFaceEmbeddings: Modelo de embeddings inicializado
+        CachedEmbeddings | HuggingFaceEmbeddings: Modelo de embeddings inicializado
     """
     try:
         print(f"🧠 Cargando embeddings: {model_name}")
         embeddings = HuggingFaceEmbeddings(model_name=model_name)
+        if use_cache:
+            cache = SQLiteCache(cache_path, max_entries=EMBEDDING_CACHE_CONFIG["max_entries"])
+            embeddings = CachedEmbeddings(embeddings, model_name, cache)
+            print(f"   💾 Caché de embeddings: {cache_path} ({len(cache)} vectores)")
         print("   ✅ Embeddings cargados correctamente")
         return embeddings
     except Exception as e:
@@ -161,7 +198,177 @@ def add_chunk_metadata(
     return documents
 
 
-def generate_document_summary(text: str, max_length: int = 500) -> str:
+class ExtractiveSummaryLLM:
+    """
+    LLM "stub" para ejecuciones sin conexión: devuelve las primeras frases
+    del documento. Expone invoke() como un chat model de LangChain.
+    """
+    
+    model = "extractive-stub"
+    
+    def invoke(self, prompt: str) -> AIMessage:
+        text = prompt.split("DOCUMENTO:\n", 1)[-1]
+        match = re.search(r"máximo (\d+) caracteres", prompt)
+        max_length = int(match.group(1)) if match else 500
+        sentences = re.split(r"(?<=[.!?])\s+", re.sub(r"\s+", " ", text).strip())
+        
+        summary = ""
+        for sentence in sentences:
+            if len(summary) + len(sentence) + 1 > max_length:
+                break
+            summary = f"{summary} {sentence}".strip()
+        return AIMessage(content=summary or text[:max_length])
+
+
+_summary_llm = None
+_summary_cache = None
+_summary_lock = threading.Lock()
+
+
+def get_summary_llm() -> Any:
+    """
+    Cliente LLM de resúmenes (uno por proceso, reutilizado entre llamadas).
+    SUMMARY_LLM=stub en el entorno usa ExtractiveSummaryLLM.
+    """
+    global _summary_llm
+    if _summary_llm is None:
+        with _summary_lock:
+            if _summary_llm is None:
+                if SUMMARY_CONFIG["llm"] == "stub":
+                    _summary_llm = ExtractiveSummaryLLM()
+                else:
+                    # Temperatura baja para resúmenes consistentes
+                    _summary_llm = ChatGoogleGenerativeAI(model=SUMMARY_MODEL, temperature=0.0)
+    return _summary_llm
+
+
+def set_summary_llm(llm: Any):
+    """Sustituye el LLM de resúmenes (p. ej. ExtractiveSummaryLLM() o un modelo local)."""
+    global _summary_llm
+    with _summary_lock:
+        _summary_llm = llm
+
+
+def get_summary_cache() -> SQLiteCache:
+    """Caché persistente de resúmenes (lazy)."""
+    global _summary_cache
+    if _summary_cache is None:
+        with _summary_lock:
+            if _summary_cache is None:
+                _summary_cache = SQLiteCache(SUMMARY_CONFIG["cache_path"])
+    return _summary_cache
+
+
+def _summary_model_name(llm: Any) -> str:
+    """Nombre del modelo (parte de la clave de caché)."""
+    return getattr(llm, "model", None) or getattr(llm, "model_name", None) or type(llm).__name__
+
+
+def _summary_cache_key(llm: Any, text: str, max_length: int) -> str:
+    """Clave: (modelo, longitud pedida, hash del texto que realmente ve el LLM)."""
+    return f"{_summary_model_name(llm)}:{max_length}:{text_hash(text[:SUMMARY_CONFIG['input_chars']])}"
+
+
+def _summarize_with_llm(llm: Any, text: str, max_length: int) -> str:
+    """Llama al LLM (lanza excepción si falla)."""
+    # Prompt para generar resumen académico AMPLIO del documento
+    summary_prompt = (
+        f"Resume el siguiente documento en máximo {max_length} caracteres. "
+        f"Incluye los temas PRINCIPALES, estructura general y puntos clave. "
+        f"Sé comprensivo pero mantén el rigor académico. "
+        f"Responde SOLO con el resumen, sin explicaciones adicionales.\n\n"
+        f"DOCUMENTO:\n{text[:SUMMARY_CONFIG['input_chars']]}"  # Usar más contenido para resumen más completo
+    )
+    
+    summary = llm.invoke(summary_prompt).content.strip()
+    
+    # Garantizar que no exceda max_length
+    if len(summary) > max_length:
+        summary = summary[:max_length-3] + "..."
+    
+    return summary
+
+
+def _simple_summary(text: str, max_length: int) -> str:
+    """Resumen simple: primeros max_length caracteres."""
+    return text[:max_length] + "..." if len(text) > max_length else text
+
+
+def generate_document_summaries(
+    texts: List[str],
+    max_length: int = 500,
+    llm: Optional[Any] = None,
+    max_workers: int = SUMMARY_CONFIG["max_workers"]
+) -> List[str]:
+    """
+    Genera el resumen de varios documentos.
+    
+    1. Busca cada uno en la caché persistente (modelo + hash de los primeros 5000 caracteres)
+    2. Los que faltan se generan en paralelo (max_workers hilos, un único cliente)
+    3. Solo se cachean los resúmenes generados por el LLM (no los de respaldo)
+    
+    Args:
+        texts (List[str]): Texto completo de cada documento
+        max_length (int): Longitud máxima de cada resumen
+        llm: Modelo a usar (por defecto get_summary_llm())
+        max_workers (int): Llamadas simultáneas al LLM
+        
+    Returns:
+        List[str]: Resúmenes en el mismo orden que texts
+    """
+    summaries: List[Optional[str]] = [None] * len(texts)
+    pending = []
+    for i, text in enumerate(texts):
+        # Si el texto es muy corto, devolverlo tal cual
+        if len(text) < 300:
+            summaries[i] = text
+        else:
+            pending.append(i)
+    
+    if not pending:
+        return summaries
+    
+    llm = llm or get_summary_llm()
+    cache = get_summary_cache()
+    keys = {i: _summary_cache_key(llm, texts[i], max_length) for i in pending}
+    cached = cache.get_many(keys.values())
+    
+    misses = []
+    for i in pending:
+        if keys[i] in cached:
+            summaries[i] = cached[keys[i]].decode("utf-8")
+        else:
+            misses.append(i)
+    
+    if len(pending) > len(misses):
+        print(f"   ⚡ {len(pending) - len(misses)} resumen(es) recuperado(s) de la caché")
+    
+    def summarize(i: int) -> Optional[str]:
+        try:
+            return _summarize_with_llm(llm, texts[i], max_length)
+        except Exception as e:
+            # Si falla la generación de resumen, se usa un resumen simple
+            print(f"   ⚠️  Error generando resumen con IA: {e}")
+            print(f"      Usando resumen simple en su lugar")
+            return None
+    
+    if misses:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(misses)))) as pool:
+            generated = list(pool.map(summarize, misses))
+        
+        to_cache = []
+        for i, summary in zip(misses, generated):
+            if summary is None:
+                summaries[i] = _simple_summary(texts[i], max_length)
+            else:
+                summaries[i] = summary
+                to_cache.append((keys[i], summary.encode("utf-8")))
+        cache.put_many(to_cache)
+    
+    return summaries
+
+
+def generate_document_summary(text: str, max_length: int = 500, llm: Optional[Any] = None) -> str:
     """
     Genera un resumen amplio del DOCUMENTO COMPLETO usando Gemini.
     
@@ -173,46 +380,18 @@ def generate_document_summary(text: str, max_length: int = 500) -> str:
     Args:
         text (str): Texto completo del documento a resumir
         max_length (int): Longitud máxima del resumen
+        llm: Modelo a usar (por defecto get_summary_llm())
         
     Returns:
         str: Resumen amplio del documento (máximo max_length caracteres)
     """
-    try:
-        # Si el texto es muy corto, devolverlo tal cual
-        if len(text) < 300:
-            return text
-        
-        # Inicializar el LLM con temperatura baja para resúmenes consistentes
-        llm = ChatGoogleGenerativeAI(model="gemini-robotics-er-1.5-preview", temperature=0.0)
-        
-        # Prompt para generar resumen académico AMPLIO del documento
-        summary_prompt = (
-            f"Resume el siguiente documento en máximo {max_length} caracteres. "
-            f"Incluye los temas PRINCIPALES, estructura general y puntos clave. "
-            f"Sé comprensivo pero mantén el rigor académico. "
-            f"Responde SOLO con el resumen, sin explicaciones adicionales.\n\n"
-            f"DOCUMENTO:\n{text[:5000]}"  # Usar más contenido para resumen más completo
-        )
-        
-        # Generar resumen
-        summary = llm.invoke(summary_prompt).content.strip()
-        
-        # Garantizar que no exceda max_length
-        if len(summary) > max_length:
-            summary = summary[:max_length-3] + "..."
-        
-        return summary
-        
-    except Exception as e:
-        # Si falla la generación de resumen, devolver un resumen simple
-        print(f"   ⚠️  Error generando resumen con IA: {e}")
-        print(f"      Usando resumen simple en su lugar")
-        return text[:max_length] + "..." if len(text) > max_length else text
+    return generate_document_summaries([text], max_length, llm)[0]
 
 
 def add_document_summary(
     documents: List[Document],
-    use_ai_summary: bool = True
+    use_ai_summary: bool = True,
+    llm: Optional[Any] = None
 ) -> List[Document]:
     """
     Agrega UN RESUMEN AMPLIO por documento a todos sus fragmentos.
@@ -228,9 +407,13 @@ def add_document_summary(
     
     Esto es más eficiente que hacer 100+ resúmenes.
     
+    Los resúmenes con IA se cachean en disco y los que faltan se generan
+    en paralelo (ver generate_document_summaries).
+    
     Args:
         documents (List[Document]): Documentos (fragmentos) a procesar
         use_ai_summary (bool): Si usar Gemini para resumen o resumen simple
+        llm: Modelo de resúmenes (por defecto get_summary_llm())
         
     Returns:
         List[Document]: Documentos con resumen del documento agregado
@@ -245,20 +428,19 @@ def add_document_summary(
             docs_by_source[source] = []
         docs_by_source[source].append(doc)
     
+    # Concatenar todo el contenido de cada documento
+    sources = list(docs_by_source.keys())
+    full_texts = ["\n".join([doc.page_content for doc in docs_by_source[source]]) for source in sources]
+    
     # Generar un resumen por documento
-    document_summaries = {}
-    for source, docs in docs_by_source.items():
-        # Concatenar todo el contenido del documento
-        full_text = "\n".join([doc.page_content for doc in docs])
-        
-        # Generar resumen amplio
-        if use_ai_summary:
-            summary = generate_document_summary(full_text, max_length=500)
-        else:
-            # Resumen simple: primeros 500 caracteres
-            summary = full_text[:500] + "..." if len(full_text) > 500 else full_text
-        
-        document_summaries[source] = summary
+    if use_ai_summary:
+        summaries = generate_document_summaries(full_texts, max_length=500, llm=llm)
+    else:
+        # Resumen simple: primeros 500 caracteres
+        summaries = [_simple_summary(full_text, 500) for full_text in full_texts]
+    
+    document_summaries = dict(zip(sources, summaries))
+    for source in sources:
         print(f"   ✅ Resumen generado para: {os.path.basename(source)}")
     
     # Agregar el resumen del documento a TODOS sus fragmentos
@@ -302,6 +484,27 @@ def validate_file(file_path: str, file_type: str = "PDF") -> bool:
     return True
 
 
+
+def compute_file_hash(file_path: str, block_size: int = 1 << 20) -> str:
+    """
+    Calcula el hash SHA-256 de un archivo (leído por bloques).
+    
+    Permite saber si un PDF cambió desde la última ingesta sin parsearlo.
+    
+    Args:
+        file_path (str): Ruta del archivo
+        block_size (int): Bytes leídos por iteración
+        
+    Returns:
+        str: Hash hexadecimal
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 if __name__ == "__main__":
     print("\n=== Prueba de ingest_utils ===\n")
     
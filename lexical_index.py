@@ -0,0 +1,190 @@
+"""
+lexical_index.py - Búsqueda léxica BM25 y fusión híbrida de rankings
+
+Este módulo encapsula:
+- Tokenización para el índice invertido (minúsculas, sin tildes, sin stopwords)
+- Puntuación BM25 a partir de postings (término -> fragmento, frecuencia)
+- Fusión de rankings por Reciprocal Rank Fusion (RRF)
+
+El índice invertido vive en docstore.db (tabla postings de ChunkStore) y se
+mantiene en la misma transacción que los fragmentos, así que la ingesta
+(completa o incremental) lo construye sin pasos adicionales.
+
+Objetivo: Encontrar por coincidencia exacta lo que MiniLM confunde
+(nombres de tutores y autores, títulos de tesis) para poder usar un k menor.
+"""
+
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+# --- CONFIGURACIÓN ---
+BM25_CONFIG = {
+    "k1": 1.5,        # Saturación de la frecuencia del término
+    "b": 0.75,        # Normalización por longitud del fragmento
+    "min_token_length": 2
+}
+
+HYBRID_SEARCH_CONFIG = {
+    "enabled": True,
+    "rrf_k": 60,        # Constante de RRF (valor estándar de la literatura)
+    "lexical_k": 50,    # Candidatos BM25 por consulta
+    "min_fetch_k": 20   # Candidatos vectoriales mínimos por consulta
+}
+
+# Palabras vacías del español (más frecuentes en el corpus de tesis)
+STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes como con contra cual cuales
+cuando de del desde donde durante e el ella ellas ellos en entre era es esa esas ese
+eso esos esta estas este esto estos fue fueron ha han hasta hay la las le les lo los
+mas me mi mis muy ni no nos o os otra otras otro otros para pero poco por porque que
+quien quienes se sea ser si sin sobre son su sus tambien te tiene tienen todo todos
+tu tus un una unas uno unos y ya
+""".split())
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9ñ]+")
+
+
+def normalize_text(text: str) -> str:
+    """Minúsculas y sin tildes (conserva la ñ)."""
+    text = text.lower().replace("ñ", "\0")
+    text = "".join(
+        c for c in unicodedata.normalize("NFD", text)
+        if unicodedata.category(c) != "Mn"
+    )
+    return text.replace("\0", "ñ")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Términos indexables de un texto.
+
+    Ejemplo: "Tutores: Dr. C. Wilkie Delgado" -> ["tutores", "dr", "wilkie", "delgado"]
+    """
+    min_length = BM25_CONFIG["min_token_length"]
+    return [
+        token for token in TOKEN_PATTERN.findall(normalize_text(text))
+        if len(token) >= min_length and token not in STOPWORDS
+    ]
+
+
+def term_frequencies(text: str) -> Tuple[Dict[str, int], int]:
+    """Frecuencia de cada término y longitud (en términos) del texto."""
+    tokens = tokenize(text)
+    return dict(Counter(tokens)), len(tokens)
+
+
+def bm25_scores(
+    postings: Iterable[Tuple[int, str, int, int]],
+    document_frequencies: Dict[str, int],
+    total_documents: int,
+    average_length: float,
+    k1: float = BM25_CONFIG["k1"],
+    b: float = BM25_CONFIG["b"]
+) -> Dict[int, float]:
+    """
+    Puntuación BM25 de cada fragmento que contiene algún término de la consulta.
+
+    Args:
+        postings: Filas (chunk_id, término, tf, longitud del fragmento)
+        document_frequencies: Término -> número de fragmentos que lo contienen
+        total_documents: Fragmentos en el índice
+        average_length: Longitud media de los fragmentos (en términos)
+
+    Returns:
+        Dict[int, float]: chunk_id -> puntuación
+    """
+    idf = {
+        term: math.log(1 + (total_documents - df + 0.5) / (df + 0.5))
+        for term, df in document_frequencies.items()
+    }
+    average_length = average_length or 1.0
+
+    scores: Dict[int, float] = {}
+    for chunk_id, term, tf, length in postings:
+        norm = tf + k1 * (1 - b + b * length / average_length)
+        scores[chunk_id] = scores.get(chunk_id, 0.0) + idf[term] * tf * (k1 + 1) / norm
+    return scores
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[int]],
+    k: int,
+    rrf_k: int = HYBRID_SEARCH_CONFIG["rrf_k"]
+) -> List[int]:
+    """
+    Fusiona varios rankings de ids: score(d) = sum(1 / (rrf_k + posición)).
+
+    No necesita calibrar las escalas de BM25 y de distancia L2 entre sí;
+    solo usa las posiciones. Los empates se resuelven por el primer ranking.
+
+    Returns:
+        List[int]: Los k ids con mayor puntuación fusionada
+    """
+    scores: Dict[int, float] = {}
+    first_seen: Dict[int, int] = {}
+    for ranking in rankings:
+        for position, chunk_id in enumerate(ranking, 1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (rrf_k + position)
+            first_seen.setdefault(chunk_id, len(first_seen))
+
+    ordered = sorted(scores, key=lambda chunk_id: (-scores[chunk_id], first_seen[chunk_id]))
+    return ordered[:k]
+
+
+# Consultas de ejemplo con un texto que DEBE aparecer en algún fragmento recuperado
+EXAMPLE_EVAL_SET = [
+    ("¿Quiénes son los tutores de la tesis?", "Wilkie Delgado"),
+    ("¿Quién es el autor del trabajo de diploma?", "David Torres"),
+    ("Miriela Escobedo Nicot", "Miriela Escobedo"),
+    ("¿Qué hace la clase StreamlitStreamingHandler?", "StreamlitStreamingHandler"),
+    ("Narraciones y Leyendas de Santiago de Cuba", "Narraciones y Leyendas"),
+    ("Ocaña-Fernández inteligencia artificial en la educación", "Ocaña"),
+    ("¿Cómo se configura el almacén vectorial?", "almacén vectorial con FAISS"),
+]
+
+
+def evaluate_hit_rate(rag_mgr, eval_set, ks: Sequence[int] = (3, 5, 10, 25)) -> Dict[str, Dict[int, float]]:
+    """
+    Tasa de acierto@k por modo de búsqueda: fracción de consultas cuyo texto
+    esperado aparece en alguno de los k fragmentos devueltos.
+    """
+    results = {}
+    for mode in ("mmr", "hybrid"):
+        results[mode] = {}
+        for k in ks:
+            found = rag_mgr.search_many([query for query, _ in eval_set], k=k, mode=mode)
+            hits = sum(
+                any(normalize_text(expected) in normalize_text(doc.page_content) for doc in docs)
+                for (_, expected), docs in zip(eval_set, found)
+            )
+            results[mode][k] = hits / len(eval_set)
+    return results
+
+
+if __name__ == "__main__":
+    # Evaluación: python lexical_index.py [--labels archivo.jsonl]
+    # (una línea por consulta: {"query": "...", "expected": "texto esperado"})
+    import argparse
+    import json
+    from rag_manager import get_rag_manager
+
+    parser = argparse.ArgumentParser(description="Acierto@k: MMR vs búsqueda híbrida")
+    parser.add_argument("--labels", help="Archivo JSONL con consultas y texto esperado")
+    args = parser.parse_args()
+
+    eval_set = EXAMPLE_EVAL_SET
+    if args.labels:
+        with open(args.labels, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        eval_set = [(row["query"], row["expected"]) for row in rows]
+
+    rag_mgr = get_rag_manager()
+    rag_mgr.retrieval_cache.clear()
+    report = evaluate_hit_rate(rag_mgr, eval_set)
+
+    print(f"\n{'modo':<8}" + "".join(f"{f'@{k}':>8}" for k in report["mmr"]))
+    for mode, by_k in report.items():
+        print(f"{mode:<8}" + "".join(f"{rate:>8.2f}" for rate in by_k.values()))
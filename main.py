@@ -1,12 +1,19 @@
+import argparse
+import asyncio
+import json
+import os
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from langchain_core.messages import AIMessageChunk
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
 
 # Importamos la lógica del agente que ya funciona
 from agent_brain import app # 'app' es el grafo compilado de LangGraph
 from memory_manager import get_memory_manager
+from reranker import get_reranker
 
 # --- 1. CONFIGURACIÓN DE FASTAPI ---
 app_fastapi = FastAPI(
@@ -33,6 +40,32 @@ app_fastapi.add_middleware(
 )
 
 
+@app_fastapi.on_event("startup")
+async def warm_up_reranker():
+    """Empieza a cargar el cross-encoder en segundo plano (las primeras consultas no esperan)."""
+    reranker = get_reranker()
+    if reranker is not None:
+        reranker.is_ready()
+
+
+@app_fastapi.on_event("startup")
+async def start_checkpoint_retention():
+    """Job de mantenimiento de checkpoints.db (TTL de threads, WAL, incremental_vacuum)."""
+    # Con varios workers (prefork_server.py) basta con uno: el worker 0
+    if os.getenv("WORKER_ID", "0") == "0":
+        get_memory_manager().start_retention_job()
+
+
+@app_fastapi.get("/memory/stats")
+async def memory_stats() -> Dict[str, Any]:
+    """Caché de conversaciones activas (tasa de acierto, memoria) y última pasada de retención."""
+    memory_mgr = get_memory_manager()
+    return {
+        "hot_threads": memory_mgr.cache_stats(),
+        "retention": memory_mgr.retention_job.last_run if memory_mgr.retention_job else None
+    }
+
+
 # --- 3. MODELO DE DATOS (Lo que envía el usuario) ---
 from typing import Optional
 
@@ -43,14 +76,14 @@ class ChatRequest(BaseModel):
 
 # --- 4. RUTA PRINCIPAL DE CHAT ---
 
-@app_fastapi.post("/chat")
-def run_chat(request: ChatRequest) -> Dict[str, Any]:
-    """
-    Endpoint para enviar una pregunta al Agente LangGraph con memoria persistente.
-    Soporta thread_id para mantener conversaciones entre sesiones.
+async def _prepare_turn(request: ChatRequest) -> Tuple[str, Dict[str, Any], Dict[str, Any]]:
     """
+    Resuelve el thread_id y construye el estado inicial del turno.
+    Compartido por /chat y /chat/stream.
     
-    user_prompt = request.user_input
+    Returns:
+        Tuple: (thread_id, config, initial_state)
+    """
     memory_mgr = get_memory_manager()
     
     # Crear o usar sesión existente
@@ -62,29 +95,31 @@ def run_chat(request: ChatRequest) -> Dict[str, Any]:
     # Obtener configuración para el thread
     config = memory_mgr.get_config_for_thread(thread_id)
     
-    # CRÍTICO: Recuperar el estado anterior del checkpointer
-    # Esto permite tener el chat_history del thread anterior
-    last_state = memory_mgr.get_last_state(thread_id)
+    # El historial (acotado) y el resumen del thread viven en su checkpoint:
+    # LangGraph los carga al invocar y chat_history usa un reductor de suma,
+    # así que solo se envía la pregunta nueva (no se reenvía el historial)
+    initial_state = {
+        "input": request.user_input,
+        "context": ""
+    }
     
-    # Mezclar estado anterior con estado nuevo
-    if last_state:
-        # Hay conversación anterior, mantener el historial
-        initial_state = {
-            "input": user_prompt, 
-            "chat_history": last_state.get("chat_history", []),
-            "context": ""
-        }
-    else:
-        # Primera vez o nuevo thread, empezar vacío
-        initial_state = {
-            "input": user_prompt, 
-            "chat_history": [],
-            "context": ""
-        }
+    return thread_id, config, initial_state
+
+
+@app_fastapi.post("/chat")
+async def run_chat(request: ChatRequest) -> Dict[str, Any]:
+    """
+    Endpoint para enviar una pregunta al Agente LangGraph con memoria persistente.
+    Soporta thread_id para mantener conversaciones entre sesiones.
+    
+    Es async: el grafo se ejecuta con app.ainvoke(), así que mientras Gemini
+    responde el worker de uvicorn puede atender otras conversaciones.
+    """
+    thread_id, config, initial_state = await _prepare_turn(request)
     
     try:
         # Invoca el agente de LangGraph CON CONFIG para memoria persistente
-        final_state = app.invoke(initial_state, config=config)
+        final_state = await app.ainvoke(initial_state, config=config)
         
         # Extrae la respuesta del agente (es el último elemento del historial)
         agent_response = final_state['chat_history'][-1].content
@@ -93,7 +128,8 @@ def run_chat(request: ChatRequest) -> Dict[str, Any]:
             "status": "success",
             "response": agent_response,
             "thread_id": thread_id,  # ← Devolver para que frontend lo guarde
-            "agent_used_tool": True if final_state['context'] else False
+            "agent_used_tool": True if final_state['context'] else False,
+            "cached": bool(final_state.get("answer_cached"))  # Respuesta de answer_cache.py (sin LLM)
         }
 
     except Exception as e:
@@ -105,9 +141,120 @@ def run_chat(request: ChatRequest) -> Dict[str, Any]:
             "error_detail": str(e)
         }
 
+
+# --- 4.1 RUTA DE CHAT EN STREAMING (Server-Sent Events) ---
+
+# Referencias a las tareas del grafo en curso (evita que el GC las cancele)
+_background_tasks = set()
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    """Formatea un evento SSE con payload JSON."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _run_graph_streaming(initial_state: Dict[str, Any], config: Dict[str, Any], queue: asyncio.Queue):
+    """
+    Ejecuta el grafo completo y publica en la cola los tokens del nodo
+    'respond' a medida que Gemini los emite.
+    
+    Corre como tarea independiente: si el cliente se desconecta a mitad del
+    stream, el grafo igualmente termina y el checkpointer guarda el estado final.
+    """
+    final_state = None
+    try:
+        async for mode, chunk in app.astream(initial_state, config=config, stream_mode=["messages", "values"]):
+            if mode == "messages":
+                message, metadata = chunk
+                # Solo tokens del generador (no los del reescritor, los del nodo summarize ni los mensajes del historial)
+                if isinstance(message, AIMessageChunk) and metadata.get("langgraph_node") == "respond" and message.content:
+                    await queue.put(("token", message.content))
+            else:
+                final_state = chunk
+        await queue.put(("final", final_state))
+    except Exception as e:
+        print(f"Error durante la ejecución del agente (stream): {e}")
+        await queue.put(("error", str(e)))
+
+
+@app_fastapi.post("/chat/stream")
+async def run_chat_stream(request: ChatRequest) -> StreamingResponse:
+    """
+    Igual que /chat pero envía la respuesta token a token (SSE).
+    
+    Eventos emitidos:
+    - start:   {"thread_id"}  (inmediato, para que el frontend guarde la sesión)
+    - token:   {"text"}       (fragmentos de la respuesta de Gemini)
+    - sources: {"text"}       (bloque FUENTES CONSULTADAS, al final)
+    - done:    {"thread_id", "response", "agent_used_tool", "cached"}
+    - error:   {"response", "error_detail"}
+    """
+    thread_id, config, initial_state = await _prepare_turn(request)
+    
+    async def event_stream():
+        yield _sse("start", {"thread_id": thread_id})
+        
+        queue: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(_run_graph_streaming(initial_state, config, queue))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        
+        streamed = []
+        while True:
+            kind, payload = await queue.get()
+            
+            if kind == "token":
+                streamed.append(payload)
+                yield _sse("token", {"text": payload})
+            
+            elif kind == "final":
+                agent_response = payload['chat_history'][-1].content
+                # Respuestas sin LLM ([SIN RESULTADOS] o cacheadas) se envían enteras
+                if not streamed:
+                    yield _sse("token", {"text": agent_response})
+                elif "".join(streamed).strip() != agent_response:
+                    # Contrato del stream: los tokens concatenados SON la respuesta
+                    # (solo se reenvían tokens del nodo 'respond', no los del resumen)
+                    print("⚠️ [STREAM] Los tokens enviados no coinciden con la respuesta final")
+                if payload.get("sources"):
+                    yield _sse("sources", {"text": payload["sources"]})
+                yield _sse("done", {
+                    "thread_id": thread_id,
+                    "response": agent_response,
+                    "agent_used_tool": True if payload['context'] else False,
+                    "cached": bool(payload.get("answer_cached"))
+                })
+                break
+            
+            else:
+                yield _sse("error", {
+                    "response": "Lo siento, ocurrió un error en el servidor. Intente de nuevo.",
+                    "error_detail": payload
+                })
+                break
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # --- 5. FUNCIÓN PARA CORRER EL SERVIDOR ---
 
 if __name__ == "__main__":
-    print("Iniciando servidor FastAPI...")
-    uvicorn.run(app_fastapi, host="0.0.0.0", port=8000)
-    print("Servidor detenido.")
\ No newline at end of file
+    # python main.py               -> un proceso
+    # python main.py --workers 4   -> precarga + fork de 4 workers (prefork_server.py)
+    parser = argparse.ArgumentParser(description="Servidor FastAPI del chatbot")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")),
+                        help="Procesos de servidor (0 = uno por núcleo)")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    workers = args.workers or os.cpu_count() or 1
+
+    if workers > 1:
+        from prefork_server import serve
+        serve(app_fastapi, workers=workers, port=args.port)
+    else:
+        print("Iniciando servidor FastAPI...")
+        uvicorn.run(app_fastapi, host="0.0.0.0", port=args.port)
+        print("Servidor detenido.")
\ No newline at end of file
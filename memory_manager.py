@@ -3,10 +3,10 @@ memory_manager.py - Gestor centralizado de memoria conversacional con SqliteSave
 Mantiene conversaciones persistentes por sesión usando LangGraph checkpointer.
 """
 
-from langgraph.checkpoint.sqlite import SqliteSaver
-import sqlite3
 import uuid
 
+from checkpointer import HotThreadCache, RetentionJob, ThreadedSqliteSaver, connect
+
 class MemoryManager:
     """Gestor de memoria para conversaciones persistentes."""
     
@@ -19,13 +19,23 @@ class MemoryManager:
         Args:
             db_path: Ruta al archivo SQLite de checkpoints
         """
-        # Crear conexión a SQLite
+        # Conexión de escritura con los pragmas de SQLITE_CONFIG (WAL, synchronous=NORMAL, mmap)
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn = connect(self.db_path)
+        
+        # Caché LRU del último estado de los threads activos: un turno de una
+        # conversación en curso no vuelve a leer ni deserializar su checkpoint
+        self.hot_cache = HotThreadCache()
         
-        # Crear el SqliteSaver con la conexión
-        self.saver = SqliteSaver(self.conn)
-        self.session_counter = 0
+        # Crear el checkpointer (SqliteSaver con soporte async) con la conexión
+        # Con db_path las lecturas usan un pool de conexiones de solo lectura por hilo
+        self.saver = ThreadedSqliteSaver(conn, hot_cache=self.hot_cache, db_path=self.db_path)
+        self.retention_job = None
+    
+    @property
+    def conn(self):
+        """Conexión de escritura (la del checkpointer; se reabre en cada proceso hijo tras un fork)."""
+        return self.saver.conn
     
     @staticmethod
     def get_instance():
@@ -44,9 +54,8 @@ class MemoryManager:
         Returns:
             thread_id: Identificador único de la sesión
         """
-        thread_id = f"user_{user_id}_{self.session_counter}"
-        self.session_counter += 1
-        return thread_id
+        # uuid4: único entre procesos (varios workers) y entre reinicios del servidor
+        return f"user_{user_id}_{uuid.uuid4().hex}"
     
     def get_config_for_thread(self, thread_id: str) -> dict:
         """
@@ -85,12 +94,79 @@ class MemoryManager:
             print(f"Error recuperando estado anterior: {e}")
             return None
     
+    async def aget_last_state(self, thread_id: str):
+        """
+        Versión asíncrona de get_last_state() para endpoints async.
+        La lectura de SQLite se ejecuta fuera del event loop.
+        
+        Args:
+            thread_id: Identificador del thread
+            
+        Returns:
+            dict: Último estado guardado o None si no existe
+        """
+        try:
+            config = {"configurable": {"thread_id": thread_id}}
+            checkpoint_tuple = await self.saver.aget_tuple(config)
+            
+            if checkpoint_tuple is not None:
+                return checkpoint_tuple.checkpoint.get("channel_values", {})
+            return None
+        except Exception as e:
+            print(f"Error recuperando estado anterior: {e}")
+            return None
+    
+    def cache_stats(self) -> dict:
+        """
+        Estadísticas de la caché de threads activos.
+        
+        Returns:
+            dict: entradas, memoria estimada (bytes), aciertos, fallos y tasa de acierto
+        """
+        return self.hot_cache.stats()
+    
+    def start_retention_job(self) -> RetentionJob:
+        """
+        Arranca (una vez) el job de retención: borra threads inactivos más del
+        TTL, hace checkpoint del WAL e incremental_vacuum (RETENTION_CONFIG).
+        
+        Returns:
+            RetentionJob: El job en ejecución
+        """
+        if self.retention_job is None:
+            self.retention_job = RetentionJob(self.saver)
+        self.retention_job.start()
+        return self.retention_job
+    
+    def compact(self, keep_last: int = None) -> int:
+        """
+        Compacta la base de checkpoints: deja los últimos keep_last checkpoints
+        de cada thread, migra los que guardaban el historial completo al
+        registro de mensajes (deltas) y devuelve el espacio al sistema (VACUUM).
+        
+        Args:
+            keep_last: Checkpoints por thread (default: el del checkpointer)
+            
+        Returns:
+            int: Checkpoints borrados
+        """
+        removed = self.saver.prune_all(keep_last or self.saver.keep_last)
+        migrated = self.saver.migrate_messages()
+        if migrated:
+            print(f"📨 {migrated} checkpoints migrados a historial por deltas")
+        with self.saver.lock:
+            # VACUUM también convierte las bases antiguas a auto_vacuum incremental
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.conn.execute("VACUUM")
+        return removed
+    
     def get_saver(self):
         """
-        Obtiene el SqliteSaver para compilar el workflow.
+        Obtiene el checkpointer para compilar el workflow.
+        Sirve tanto para app.invoke() como para app.ainvoke().
         
         Returns:
-            SqliteSaver: Checkpointer para LangGraph
+            ThreadedSqliteSaver: Checkpointer para LangGraph
         """
         return self.saver
 
@@ -98,3 +174,14 @@ class MemoryManager:
 def get_memory_manager() -> MemoryManager:
     """Función de conveniencia para obtener el MemoryManager singleton."""
     return MemoryManager.get_instance()
+
+
+if __name__ == "__main__":
+    # Compactación y migración manual: python memory_manager.py [ruta.db]
+    import os
+    import sys
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "checkpoints.db"
+    size_before = os.path.getsize(path)
+    removed = MemoryManager(path).compact()
+    print(f"🗜️  {removed} checkpoints borrados; {size_before / 1e6:.1f} MB -> {os.path.getsize(path) / 1e6:.1f} MB")
@@ -0,0 +1,163 @@
+"""
+mmr.py - Maximal Marginal Relevance vectorizado
+
+Este módulo encapsula:
+- mmr_select: selección MMR greedy sobre vectores ya normalizados
+  * similitudes candidato-consulta y candidato-candidato en UNA operación NumPy
+  * máxima similitud con los ya seleccionados actualizada de forma incremental
+    (un np.maximum por iteración, sin bucles Python sobre los candidatos)
+- normalize_rows: normalización L2 por filas (coseno = producto punto)
+- Herramienta de verificación y micro-benchmark frente a la implementación
+  de LangChain (maximal_marginal_relevance + reconstrucción vector a vector)
+
+Objetivo: Que la selección MMR deje de ser el paso más caro de la búsqueda
+cuando fetch_k crece.
+
+Uso de la herramienta:
+    python mmr.py --corpus 20000 --queries 200 --k 25 --fetch-k 75
+    python mmr.py --check   # solo la verificación (falla con AssertionError)
+"""
+
+from typing import List
+
+import numpy as np
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Normaliza cada fila a norma 1 (las filas nulas se dejan en cero)."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def mmr_select(
+    query_vec: np.ndarray,
+    candidates: np.ndarray,
+    k: int,
+    lambda_mult: float
+) -> List[int]:
+    """
+    Selección MMR: score(i) = λ·sim(q, i) - (1-λ)·max_{j seleccionado} sim(i, j).
+
+    Mismo resultado que langchain maximal_marginal_relevance (coseno, empates
+    resueltos por el índice menor), pero con el trabajo por iteración reducido
+    a operaciones vectorizadas.
+
+    Args:
+        query_vec (np.ndarray): Consulta normalizada (dim,)
+        candidates (np.ndarray): Candidatos normalizados (n, dim)
+        k (int): Elementos a seleccionar
+        lambda_mult (float): Relevancia (1.0) vs diversidad (0.0)
+
+    Returns:
+        List[int]: Posiciones seleccionadas dentro de candidates, en orden de selección
+    """
+    n = len(candidates)
+    k = min(k, n)
+    if k <= 0:
+        return []
+
+    similarity_to_query = candidates @ query_vec
+    first = int(np.argmax(similarity_to_query))
+    selected = [first]
+    if k == 1:
+        return selected
+
+    pairwise = candidates @ candidates.T  # (n, n) en una sola operación
+    relevance = lambda_mult * similarity_to_query
+    max_similarity = pairwise[first].copy()
+    available = np.ones(n, dtype=bool)
+    available[first] = False
+
+    for _ in range(k - 1):
+        scores = relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        chosen = int(np.argmax(scores))
+        selected.append(chosen)
+        available[chosen] = False
+        np.maximum(max_similarity, pairwise[chosen], out=max_similarity)
+
+    return selected
+
+
+def check_matches_langchain(cases: int = 200, dim: int = 64, seed: int = 0):
+    """
+    Verificación (AssertionError si falla): mmr_select elige exactamente lo
+    mismo, en el mismo orden, que langchain maximal_marginal_relevance sobre
+    candidatos aleatorios, con λ extremos, k mayor que los candidatos y
+    candidatos duplicados.
+    """
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+    rng = np.random.default_rng(seed)
+    for case in range(cases):
+        n = int(rng.integers(1, 60))
+        candidates = rng.standard_normal((n, dim)).astype(np.float32)
+        if case % 4 == 0 and n > 1:
+            candidates[n // 2] = candidates[0]  # Duplicado exacto
+        query = rng.standard_normal(dim).astype(np.float32)
+        k = int(rng.integers(1, 70))
+        lambda_mult = float(rng.choice([0.0, 0.25, 0.5, 0.6, 1.0]))
+
+        expected = maximal_marginal_relevance(query, candidates, lambda_mult=lambda_mult, k=k)
+        got = mmr_select(normalize_rows(query), normalize_rows(candidates), k, lambda_mult)
+        assert got == expected, (
+            f"caso {case} (n={n}, k={k}, λ={lambda_mult}): vectorizado {got} != LangChain {expected}"
+        )
+    print(f"✅ mmr_select: {cases} casos idénticos a LangChain")
+
+
+if __name__ == "__main__":
+    # Verificación (mismas selecciones que LangChain) y micro-benchmark
+    import argparse
+    import time
+
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+    from faiss_index import build_index
+
+    parser = argparse.ArgumentParser(description="MMR vectorizado vs LangChain")
+    parser.add_argument("--corpus", type=int, default=20000, help="Vectores sintéticos en el índice")
+    parser.add_argument("--dim", type=int, default=384, help="Dimensión (MiniLM = 384)")
+    parser.add_argument("--queries", type=int, default=200, help="Consultas de prueba")
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--fetch-k", type=int, default=75)
+    parser.add_argument("--lambda-mult", type=float, default=0.6)
+    parser.add_argument("--check", action="store_true", help="Solo verificar frente a LangChain (falla con AssertionError)")
+    args = parser.parse_args()
+
+    if args.check:
+        check_matches_langchain()
+        raise SystemExit(0)
+
+    rng = np.random.default_rng(42)
+    corpus = rng.standard_normal((args.corpus, args.dim)).astype(np.float32)
+    queries = rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    index = build_index(corpus, {"type": "flat"})
+    _, candidate_ids = index.search(queries, args.fetch_k)
+    resident = normalize_rows(corpus)  # Matriz residente (ids = filas en este benchmark)
+
+    def legacy(query, ids):
+        # Camino anterior: reconstrucción vector a vector + MMR de LangChain
+        vectors = np.vstack([index.reconstruct(int(i)) for i in ids])
+        return maximal_marginal_relevance(query, vectors, lambda_mult=args.lambda_mult, k=args.k)
+
+    def vectorized(query, ids):
+        return mmr_select(normalize_rows(query), resident[ids], args.k, args.lambda_mult)
+
+    timings = {}
+    outputs = {}
+    for name, fn in (("langchain", legacy), ("vectorizado", vectorized)):
+        start = time.perf_counter()
+        outputs[name] = [fn(query, ids) for query, ids in zip(queries, candidate_ids)]
+        timings[name] = (time.perf_counter() - start) / args.queries * 1000
+
+    identical = sum(a == b for a, b in zip(outputs["langchain"], outputs["vectorizado"]))
+    print(f"\nCorpus {args.corpus}x{args.dim}, k={args.k}, fetch_k={args.fetch_k}, λ={args.lambda_mult}")
+    print(f"Selecciones idénticas: {identical}/{args.queries}")
+    for name, ms in timings.items():
+        print(f"  {name:<12} {ms:8.3f} ms/consulta")
+    print(f"  Aceleración: {timings['langchain'] / timings['vectorizado']:.1f}x")
+    if identical != args.queries:
+        raise SystemExit(f"❌ {args.queries - identical} selección(es) distintas de LangChain")
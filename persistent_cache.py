@@ -0,0 +1,305 @@
+"""
+persistent_cache.py - Cachés persistentes en disco (SQLite)
+
+Este módulo encapsula:
+- SQLiteCache: almacén clave -> bytes con TTL opcional y desalojo LRU por tamaño
+- CachedEmbeddings: envoltorio de cualquier modelo de embeddings de LangChain
+  que guarda cada vector (float32) con clave (modelo, sha256 del texto)
+- Contadores de aciertos/fallos y de textos realmente enviados al encoder
+
+Objetivo: Que re-ingerir un corpus sin cambios (o con otro chunk_size que
+produce muchos fragmentos idénticos) casi no ejecute el encoder, y que las
+consultas repetidas entre reinicios del servidor no se vuelvan a vectorizar.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# --- CONFIGURACIÓN ---
+CACHE_DIR = ".cache"
+
+EMBEDDING_CACHE_CONFIG = {
+    "path": os.path.join(CACHE_DIR, "embeddings.db"),
+    "max_entries": 200_000  # ~300 MB con MiniLM (384 floats por vector)
+}
+
+
+# Cachés abiertas en este proceso: tras un fork cada hijo reabre su conexión
+# (una conexión SQLite no debe usarse a ambos lados de un fork)
+_open_caches: "weakref.WeakSet[SQLiteCache]" = weakref.WeakSet()
+
+
+def text_hash(text: str) -> str:
+    """Hash SHA-256 de un texto (parte de las claves de caché)."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SQLiteCache:
+    """
+    Caché clave -> bytes en un archivo SQLite.
+
+    - TTL opcional: las entradas más antiguas que ttl_seconds se ignoran y se purgan
+    - max_entries opcional: al superarlo se borran las menos usadas (accessed_at)
+    - LRU de grano grueso: un acierto solo escribe accessed_at si tiene más de
+      touch_interval segundos, y la purga corre cada evict_every escrituras
+      (los aciertos repetidos no se convierten en escrituras serializadas en el WAL)
+    - Segura entre hilos (una conexión protegida por lock) y entre procesos
+      (SQLite serializa a los escritores)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+        touch_interval: float = 300.0,
+        evict_every: int = 256
+    ):
+        """
+        Abre (o crea) la caché.
+
+        Args:
+            path (str): Archivo SQLite (se crea la carpeta si no existe)
+            max_entries (int): Entradas máximas (None = sin límite; se puede
+                               exceder en hasta evict_every entre purgas)
+            ttl_seconds (float): Vida de cada entrada (None = sin caducidad)
+            touch_interval (float): Antigüedad mínima de accessed_at para reescribirlo en un acierto
+            evict_every (int): Entradas escritas entre dos purgas
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.touch_interval = touch_interval
+        self.evict_every = evict_every
+        self._written_since_evict = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        _open_caches.add(self)
+        with self._lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed_at)")
+            self.conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _min_created_at(self, now: float) -> float:
+        """Marca de tiempo mínima para que una entrada siga vigente."""
+        return now - self.ttl_seconds if self.ttl_seconds is not None else float("-inf")
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        """
+        Busca varias claves a la vez.
+
+        Returns:
+            Dict[str, bytes]: Solo las claves encontradas (y vigentes)
+        """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+
+        now = time.time()
+        found = {}
+        stale = []
+        with self._lock:
+            # Por lotes: SQLite limita el número de parámetros por consulta
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT key, value, accessed_at FROM cache WHERE key IN ({placeholders}) AND created_at >= ?",
+                    batch + [self._min_created_at(now)]
+                ).fetchall()
+                found.update((key, value) for key, value, _ in rows)
+                stale.extend(key for key, _, accessed_at in rows if accessed_at < now - self.touch_interval)
+
+            # Solo se escribe si algún acierto tiene el accessed_at desactualizado
+            if stale:
+                self.conn.executemany(
+                    "UPDATE cache SET accessed_at = ? WHERE key = ?",
+                    [(now, key) for key in stale]
+                )
+                self.conn.commit()
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Devuelve el valor de una clave o None."""
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]]):
+        """Guarda varias entradas en una sola transacción."""
+        now = time.time()
+        rows = [(key, sqlite3.Binary(value), now, now) for key, value in items]
+        if not rows:
+            return
+
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", rows)
+            self._written_since_evict += len(rows)
+            if self._written_since_evict >= self.evict_every:
+                self._evict(now)
+                self._written_since_evict = 0
+            self.conn.commit()
+
+    def put(self, key: str, value: bytes):
+        """Guarda una entrada."""
+        self.put_many([(key, value)])
+
+    def _evict(self, now: float):
+        """Purga entradas caducadas y, si sobra, las menos usadas (con el lock tomado)."""
+        if self.ttl_seconds is not None:
+            self.conn.execute("DELETE FROM cache WHERE created_at < ?", (self._min_created_at(now),))
+
+        if self.max_entries is not None:
+            excess = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.conn.execute(
+                    "DELETE FROM cache WHERE key IN "
+                    "(SELECT key FROM cache ORDER BY accessed_at ASC LIMIT ?)",
+                    (excess,)
+                )
+
+    def delete(self, key: str):
+        """Elimina una entrada."""
+        with self._lock:
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def retain_prefix(self, prefix: str) -> int:
+        """
+        Borra las entradas cuya clave NO empieza por prefix
+        (p. ej. las de una versión anterior de los datos).
+
+        Returns:
+            int: Entradas borradas
+        """
+        with self._lock:
+            deleted = self.conn.execute(
+                "DELETE FROM cache WHERE substr(key, 1, ?) != ?", (len(prefix), prefix)
+            ).rowcount
+            self.conn.commit()
+        return deleted
+
+    def clear(self):
+        """Vacía la caché."""
+        with self._lock:
+            self.conn.execute("DELETE FROM cache")
+            self.conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self) -> Dict[str, object]:
+        """Contadores de uso y tamaño."""
+        total = self.hits + self.misses
+        return {
+            "path": self.path,
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def close(self):
+        """Cierra la conexión."""
+        with self._lock:
+            self.conn.close()
+
+    def _reopen_after_fork(self):
+        """Proceso hijo: conexión y lock nuevos (la heredada queda sin usar, no se cierra)."""
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+
+
+def _reopen_caches_after_fork():
+    for cache in list(_open_caches):
+        cache._reopen_after_fork()
+
+
+os.register_at_fork(after_in_child=_reopen_caches_after_fork)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings con caché persistente: clave = (modelo, sha256 del texto).
+
+    Solo los textos que no están en caché llegan al modelo, en UN lote
+    (deduplicado). all-MiniLM-L6-v2 vectoriza igual consultas y documentos,
+    así que ingesta y búsqueda comparten entradas.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache: SQLiteCache):
+        """
+        Args:
+            embeddings (Embeddings): Modelo real (p. ej. HuggingFaceEmbeddings)
+            model_name (str): Nombre del modelo (parte de la clave)
+            cache (SQLiteCache): Almacén de vectores
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache
+        self.encoded_texts = 0  # Textos enviados realmente al encoder
+        self._lock = threading.Lock()
+
+    def _key(self, text: str) -> str:
+        return f"{self.model_name}:{text_hash(text)}"
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Vectoriza textos reutilizando los vectores cacheados."""
+        keys = [self._key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        # Textos pendientes, deduplicados por clave
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in pending:
+                pending[key] = text
+
+        computed = {}
+        if pending:
+            vectors = self.embeddings.embed_documents(list(pending.values()))
+            computed = {
+                key: np.asarray(vector, dtype=np.float32)
+                for key, vector in zip(pending.keys(), vectors)
+            }
+            self.cache.put_many((key, vector.tobytes()) for key, vector in computed.items())
+            with self._lock:
+                self.encoded_texts += len(pending)
+
+        return [
+            (computed[key] if key in computed else np.frombuffer(cached[key], dtype=np.float32)).tolist()
+            for key in keys
+        ]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Vectoriza una consulta (misma caché que los documentos)."""
+        return self.embed_documents([text])[0]
+
+    def stats(self) -> Dict[str, object]:
+        """Estadísticas de la caché y llamadas al encoder."""
+        return {**self.cache.stats(), "model": self.model_name, "encoded_texts": self.encoded_texts}
@@ -0,0 +1,224 @@
+"""
+prefork_server.py - Servidor multi-proceso con precarga antes del fork
+
+Este módulo encapsula:
+- Precarga en el proceso padre del modelo de embeddings, el índice FAISS,
+  el docstore, el checkpointer y (si está activo) el cross-encoder
+- gc.freeze() antes del fork: el recolector de los hijos no recorre (ni
+  ensucia) los objetos precargados, así sus páginas siguen compartidas
+  copy-on-write
+- Un socket de escucha compartido por N workers de uvicorn (fork), con
+  reinicio automático de los workers que mueren
+- Comprobación al arrancar cada worker: tras una búsqueda de calentamiento se
+  mide en /proc/self/smaps_rollup cuánta memoria sigue compartida
+
+Las conexiones SQLite, executors y locks heredados se reabren en cada hijo
+mediante os.register_at_fork (persistent_cache, vectorstore, checkpointer,
+agent_brain).
+
+Objetivo: Usar todos los núcleos de la máquina sin cargar N copias del
+modelo y del índice.
+
+Uso:
+    python main.py --workers 4
+"""
+
+import gc
+import os
+import signal
+import socket
+import time
+from typing import Any, Dict, Optional
+
+import uvicorn
+
+# --- CONFIGURACIÓN ---
+PREFORK_CONFIG = {
+    "workers": int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    "host": "0.0.0.0",
+    "port": 8000,
+    "backlog": 2048,
+    "min_shared_fraction": 0.5,   # Fracción de la precarga que debe seguir compartida en cada worker
+    "restart_delay_seconds": 1.0  # Espera antes de reemplazar un worker que murió
+}
+
+SMAPS_FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty")
+
+
+def memory_usage() -> Dict[str, int]:
+    """
+    Memoria del proceso actual en bytes según /proc/self/smaps_rollup
+    (Rss, Pss, Shared_*, Private_*). Diccionario vacío fuera de Linux.
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            lines = f.readlines()
+    except OSError:
+        return {}
+    usage = {}
+    for line in lines:
+        name, _, rest = line.partition(":")
+        if name in SMAPS_FIELDS:
+            usage[name] = int(rest.split()[0]) * 1024
+    usage["Shared"] = usage.get("Shared_Clean", 0) + usage.get("Shared_Dirty", 0)
+    return usage
+
+
+def preload() -> int:
+    """
+    Carga en el proceso padre todo lo que comparten los workers y congela el GC.
+
+    No se ejecuta inferencia: los pools de hilos de torch/OpenMP no sobreviven
+    a un fork, así que el primer cálculo ocurre ya en cada worker.
+
+    Returns:
+        int: Bytes residentes añadidos por la precarga (0 si no se pueden medir)
+    """
+    from memory_manager import get_memory_manager
+    from rag_manager import get_rag_manager
+    from reranker import get_reranker
+
+    before = memory_usage().get("Rss", 0)
+    print("📦 [PREFORK] Precargando modelo de embeddings, índice y docstore...")
+    get_rag_manager()
+    get_memory_manager()
+    reranker = get_reranker()
+    if reranker is not None:
+        reranker.warm_up()
+
+    # Los objetos precargados pasan a la generación permanente del GC
+    gc.collect()
+    gc.freeze()
+    preloaded = memory_usage().get("Rss", 0) - before
+    print(f"   ✅ Precarga lista ({preloaded / 1e6:.0f} MB), {gc.get_freeze_count()} objetos congelados")
+    return preloaded
+
+
+def _limit_threads(workers: int):
+    """Reparte los núcleos entre workers (torch y FAISS usan pools de hilos propios)."""
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    import faiss
+    faiss.omp_set_num_threads(threads)
+
+
+def check_shared_memory(worker_id: int, preloaded_bytes: int) -> Optional[bool]:
+    """
+    Tras una búsqueda de calentamiento, verifica que la precarga siga
+    compartida con el padre (y no copiada en la memoria privada del worker).
+
+    Returns:
+        bool | None: True si se comparte lo esperado, None si no se puede medir
+    """
+    from rag_manager import get_rag_manager
+
+    get_rag_manager().search("calentamiento del worker", k=1)
+    usage = memory_usage()
+    if not usage or preloaded_bytes <= 0:
+        print(f"ℹ️  [WORKER {worker_id}] Sin /proc/self/smaps_rollup: no se verifica la memoria compartida")
+        return None
+
+    shared_ok = usage["Shared"] >= PREFORK_CONFIG["min_shared_fraction"] * preloaded_bytes
+    print(f"{'🧠' if shared_ok else '⚠️'} [WORKER {worker_id}] pid {os.getpid()}: "
+          f"compartida {usage['Shared'] / 1e6:.0f} MB, privada {usage.get('Private_Dirty', 0) / 1e6:.0f} MB, "
+          f"Pss {usage.get('Pss', 0) / 1e6:.0f} MB (precarga {preloaded_bytes / 1e6:.0f} MB)")
+    if not shared_ok:
+        print(f"⚠️ [WORKER {worker_id}] Menos del {PREFORK_CONFIG['min_shared_fraction']:.0%} de la precarga "
+              "sigue compartida: algo la está copiando en cada worker")
+    return shared_ok
+
+
+def _run_worker(app: Any, sock: socket.socket, worker_id: int, workers: int, preloaded_bytes: int):
+    """Cuerpo del proceso hijo: ajusta el proceso, comprueba la memoria y sirve."""
+    from memory_manager import get_memory_manager
+
+    os.environ["WORKER_ID"] = str(worker_id)  # main.py arranca la retención solo en el worker 0
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _limit_threads(workers)
+    if workers > 1:
+        # Los turnos de un thread pueden llegar a cualquier worker: validar la caché contra la base
+        get_memory_manager().hot_cache.validate_hits = True
+
+    check_shared_memory(worker_id, preloaded_bytes)
+    config = uvicorn.Config(app, log_level="info")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def serve(
+    app: Any,
+    workers: int = PREFORK_CONFIG["workers"],
+    host: str = PREFORK_CONFIG["host"],
+    port: int = PREFORK_CONFIG["port"]
+):
+    """
+    Precarga, abre el socket y lanza `workers` procesos de uvicorn (fork).
+    El padre solo supervisa: reemplaza los workers que mueren y reenvía
+    SIGINT/SIGTERM para un apagado ordenado.
+
+    Args:
+        app: Aplicación ASGI (main.app_fastapi)
+        workers (int): Procesos de servidor
+        host (str): Interfaz de escucha
+        port (int): Puerto
+    """
+    preloaded_bytes = preload()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(PREFORK_CONFIG["backlog"])
+    sock.set_inheritable(True)
+
+    children: Dict[int, int] = {}  # pid -> worker_id
+    stopping = False
+
+    def spawn(worker_id: int):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                _run_worker(app, sock, worker_id, workers, preloaded_bytes)
+            except BaseException as e:
+                print(f"❌ [WORKER {worker_id}] {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        children[pid] = worker_id
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    print(f"🚀 [PREFORK] {workers} workers en http://{host}:{port}")
+    for worker_id in range(workers):
+        spawn(worker_id)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker_id = children.pop(pid, None)
+        if worker_id is None or stopping:
+            continue
+        print(f"⚠️ [PREFORK] Worker {worker_id} (pid {pid}) terminó con estado {status}; se reemplaza")
+        time.sleep(PREFORK_CONFIG["restart_delay_seconds"])
+        spawn(worker_id)
+
+    sock.close()
+    print("Servidor detenido.")
@@ -0,0 +1,268 @@
+"""
+query_gate.py - Filtro local previo a la reescritura de preguntas
+
+Este módulo encapsula:
+- Heurísticas en español para detectar si una pregunta depende del historial
+  (pronombres, demostrativos, conectores de continuación, elipsis)
+- Comprobación opcional por similitud de embeddings con el último turno
+- Contadores de decisiones (cuántas reescrituras se omiten y por qué)
+- Evaluación offline contra un conjunto etiquetado (JSONL)
+
+Objetivo: Ahorrar la llamada al LLM de reescritura (contextualize_query)
+cuando la pregunta ya es independiente.
+
+Uso (evaluación):
+    python query_gate.py                      # Conjunto de ejemplo incluido
+    python query_gate.py --labels gate.jsonl  # {"question", "history", "needs_rewrite"}
+"""
+
+import argparse
+import json
+import re
+import threading
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.messages import HumanMessage
+
+# --- CONFIGURACIÓN ---
+QUERY_GATE_CONFIG = {
+    "min_standalone_words": 4,      # Preguntas más cortas se consideran elípticas
+    "similarity_threshold": 0.5,    # Coseno con la pregunta anterior a partir del cual se reescribe
+}
+
+# Palabras que remiten a algo ya mencionado (comparadas en minúsculas, CON tildes:
+# "él" no es el artículo "el" y "está" no es el demostrativo "esta")
+REFERENCE_WORDS = {
+    "su", "sus", "suyo", "suya", "suyos", "suyas",
+    "él", "ella", "ellos", "ellas", "le", "les",
+    "este", "esta", "esto", "estos", "estas",
+    "ese", "esa", "eso", "esos", "esas",
+    "aquel", "aquella", "aquello", "aquellos", "aquellas",
+    "dicho", "dicha", "dichos", "dichas", "mencionado", "mencionada",
+    "anterior", "anteriores", "mismo", "misma", "ahí", "allí", "ahi", "alli",
+}
+
+# Comienzos típicos de una pregunta de seguimiento
+CONTINUATION_PREFIXES = (
+    "y ", "y?", "tambien", "ademas", "entonces", "pero ", "o sea",
+    "que mas", "algo mas", "y que", "y el", "y la", "y los", "y las",
+    "otro", "otra", "el otro", "la otra", "lo mismo", "mas sobre", "y sobre",
+    "amplia", "explica mejor", "profundiza", "continua", "sigue",
+)
+
+# Verbo con pronombre enclítico: "explícalo", "dímelo", "descríbela"
+# (sílaba tónica con tilde + terminación verbal -a/-e + pronombre; "título" no encaja)
+ENCLITIC_PATTERN = re.compile(r"\b\w*[áéíóú][a-zñ]{0,3}[ae](?:me|te|se|nos)?(?:lo|la|los|las|le|les)\b", re.IGNORECASE)
+# Nombre propio en mitad de la frase, título entre comillas o número (año, capítulo...)
+EXPLICIT_ENTITY_PATTERN = re.compile(r"(?<![¿¡.!?]\s)(?<!^)\b[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+|[\"“«'][^\"”»']{3,}[\"”»']|\b\d+\b")
+
+
+def _strip_accents(text: str) -> str:
+    """Minúsculas y sin tildes (para comparar con las listas de palabras)."""
+    normalized = unicodedata.normalize("NFD", text.lower())
+    return "".join(char for char in normalized if unicodedata.category(char) != "Mn")
+
+
+def _last_user_message(chat_history: Sequence[Any]) -> Optional[str]:
+    """Texto de la última pregunta del usuario en el historial."""
+    for message in reversed(chat_history):
+        if isinstance(message, HumanMessage):
+            return message.content
+        if isinstance(message, str):
+            return message
+    return None
+
+
+class StandaloneQueryGate:
+    """
+    Decide si una pregunta necesita reescribirse con el historial.
+
+    Orden de decisión:
+    1. Referencias explícitas (pronombres, demostrativos, enclíticos,
+       conectores de continuación) -> reescribir
+    2. Pregunta muy corta (elipsis: "¿y el tutor?") -> reescribir
+    3. Entidad explícita (nombre propio, título, número) -> independiente
+    4. Con embed_fn: similitud con la pregunta anterior >= umbral -> reescribir
+       (sigue el mismo tema de forma implícita); si no -> independiente
+    5. Sin embed_fn -> independiente
+    """
+
+    def __init__(
+        self,
+        embed_fn: Optional[Callable[[List[str]], np.ndarray]] = None,
+        min_standalone_words: int = QUERY_GATE_CONFIG["min_standalone_words"],
+        similarity_threshold: float = QUERY_GATE_CONFIG["similarity_threshold"]
+    ):
+        """
+        Args:
+            embed_fn: Función textos -> matriz de embeddings (opcional)
+            min_standalone_words (int): Palabras mínimas de una pregunta independiente
+            similarity_threshold (float): Coseno a partir del cual se considera continuación
+        """
+        self.embed_fn = embed_fn
+        self.min_standalone_words = min_standalone_words
+        self.similarity_threshold = similarity_threshold
+
+        self._lock = threading.Lock()
+        self.total = 0
+        self.skipped = 0
+        self.reasons: Dict[str, int] = {}
+
+    def _heuristic(self, question: str) -> Tuple[Optional[bool], str]:
+        """Decisión por reglas: (True/False/None si no concluye, motivo)."""
+        plain = _strip_accents(question).strip(" ¿?¡!.")
+        words = re.findall(r"\w+", question.lower())
+
+        for word in words:
+            if word in REFERENCE_WORDS:
+                return True, f"referencia '{word}'"
+        if ENCLITIC_PATTERN.search(question):
+            return True, "pronombre enclítico"
+        if plain.startswith(CONTINUATION_PREFIXES):
+            return True, "conector de continuación"
+        if len(words) < self.min_standalone_words:
+            return True, "pregunta corta"
+        if EXPLICIT_ENTITY_PATTERN.search(question.strip(" ¿?¡!")):
+            return False, "entidad explícita"
+        return None, ""
+
+    def decide(self, question: str, chat_history: Sequence[Any]) -> Tuple[bool, str]:
+        """
+        Decide sin actualizar contadores.
+
+        Returns:
+            Tuple[bool, str]: (necesita reescritura, motivo)
+        """
+        if not chat_history:
+            return False, "sin historial"
+
+        needs_rewrite, reason = self._heuristic(question)
+        if needs_rewrite is not None:
+            return needs_rewrite, reason
+
+        previous = _last_user_message(chat_history)
+        if self.embed_fn is None or not previous:
+            return False, "sin referencias"
+
+        vectors = np.asarray(self.embed_fn([question, previous]), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1)
+        similarity = float(vectors[0] @ vectors[1] / (norms[0] * norms[1])) if norms.all() else 0.0
+        if similarity >= self.similarity_threshold:
+            return True, f"mismo tema (sim={similarity:.2f})"
+        return False, f"tema nuevo (sim={similarity:.2f})"
+
+    def needs_rewrite(self, question: str, chat_history: Sequence[Any]) -> Tuple[bool, str]:
+        """decide() + contadores."""
+        needs_rewrite, reason = self.decide(question, chat_history)
+
+        # Motivo sin el detalle (palabra o similitud) para agrupar en las estadísticas
+        reason_key = reason.split(" (")[0].split(" '")[0]
+        with self._lock:
+            self.total += 1
+            if not needs_rewrite:
+                self.skipped += 1
+            self.reasons[reason_key] = self.reasons.get(reason_key, 0) + 1
+        return needs_rewrite, reason
+
+    def stats(self) -> Dict[str, Any]:
+        """Cuántas reescrituras se omitieron y por qué motivo se decidió."""
+        with self._lock:
+            return {
+                "decisions": self.total,
+                "skipped": self.skipped,
+                "skip_rate": round(self.skipped / self.total, 4) if self.total else 0.0,
+                "reasons": dict(self.reasons),
+            }
+
+
+# --- EVALUACIÓN OFFLINE ---
+# Conjunto de ejemplo: history = preguntas previas del usuario
+EXAMPLE_LABELED_SET = [
+    {"history": ["¿De qué trata la tesis de David Torres?"], "question": "¿Quiénes son sus tutores?", "needs_rewrite": True},
+    {"history": ["¿De qué trata la tesis de David Torres?"], "question": "¿Y el año?", "needs_rewrite": True},
+    {"history": ["¿De qué trata la tesis de David Torres?"], "question": "Explícalo con más detalle", "needs_rewrite": True},
+    {"history": ["¿Quién es el autor del trabajo de diploma?"], "question": "¿Qué metodología usa ese trabajo?", "needs_rewrite": True},
+    {"history": ["¿Cuáles son los objetivos de la investigación?"], "question": "¿Y las conclusiones?", "needs_rewrite": True},
+    {"history": ["¿Cuáles son los objetivos de la investigación?"], "question": "Además, ¿qué resultados obtuvo?", "needs_rewrite": True},
+    {"history": ["¿Qué es el aprendizaje automático según el documento?"], "question": "¿Cuál es la diferencia con el anterior?", "needs_rewrite": True},
+    {"history": ["¿De qué trata la tesis de David Torres?"], "question": "¿Cuál es el título de la tesis de María Pérez?", "needs_rewrite": False},
+    {"history": ["¿Quiénes son los tutores?"], "question": "¿Qué institución otorgó el título en 2023?", "needs_rewrite": False},
+    {"history": ["¿De qué trata la tesis?"], "question": "¿Qué algoritmos de clasificación se comparan en el capítulo 3?", "needs_rewrite": False},
+    {"history": ["¿Cuál es el objetivo general?"], "question": "¿Qué herramientas de software se utilizaron para implementar el sistema de Gestión Universitaria?", "needs_rewrite": False},
+    {"history": ["¿Quién es el autor?"], "question": "¿Qué dice el documento sobre la Universidad de Camagüey?", "needs_rewrite": False},
+]
+
+
+def load_labeled_set(path: str) -> List[Dict[str, Any]]:
+    """
+    Lee un conjunto etiquetado en JSONL. Cada línea:
+    {"question": str, "history": [str, ...], "needs_rewrite": bool}
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate_gate(gate: StandaloneQueryGate, examples: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Compara las decisiones del gate con las etiquetas.
+
+    Lo importante es el recall de "necesita reescritura": un falso negativo
+    (omitir una reescritura necesaria) hace que la búsqueda use una pregunta
+    incompleta; un falso positivo solo cuesta una llamada al LLM.
+
+    Returns:
+        Dict: accuracy, precision, recall, skip_rate y lista de errores
+    """
+    tp = fp = tn = fn = 0
+    errors = []
+    for example in examples:
+        history = [HumanMessage(content=text) for text in example.get("history", [])]
+        predicted, reason = gate.decide(example["question"], history)
+        expected = bool(example["needs_rewrite"])
+
+        if predicted and expected:
+            tp += 1
+        elif predicted and not expected:
+            fp += 1
+        elif not predicted and expected:
+            fn += 1
+        else:
+            tn += 1
+        if predicted != expected:
+            errors.append({"question": example["question"], "expected": expected, "reason": reason})
+
+    total = len(examples)
+    return {
+        "examples": total,
+        "accuracy": round((tp + tn) / total, 4) if total else 0.0,
+        "precision": round(tp / (tp + fp), 4) if tp + fp else 0.0,
+        "recall": round(tp / (tp + fn), 4) if tp + fn else 0.0,
+        "skip_rate": round((tn + fn) / total, 4) if total else 0.0,
+        "false_skips": fn,
+        "errors": errors,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evalúa el filtro de reescritura contra un conjunto etiquetado")
+    parser.add_argument("--labels", help="Archivo JSONL etiquetado (por defecto: conjunto de ejemplo)")
+    parser.add_argument("--embeddings", action="store_true",
+                        help="Activar la comprobación por similitud (carga el modelo de embeddings)")
+    args = parser.parse_args()
+
+    examples = load_labeled_set(args.labels) if args.labels else EXAMPLE_LABELED_SET
+    embed_fn = None
+    if args.embeddings:
+        from ingest_utils import load_embeddings
+        embeddings = load_embeddings()
+        embed_fn = lambda texts: np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+
+    report = evaluate_gate(StandaloneQueryGate(embed_fn=embed_fn), examples)
+    print(f"\n📊 Filtro de reescritura sobre {report['examples']} ejemplos")
+    print(f"   Accuracy: {report['accuracy']} | Precision: {report['precision']} | "
+          f"Recall: {report['recall']} | Omitidas: {report['skip_rate']}")
+    print(f"   Reescrituras necesarias omitidas (falsos negativos): {report['false_skips']}")
+    for error in report["errors"]:
+        print(f"   ❌ '{error['question']}' -> esperado {error['expected']} ({error['reason']})")
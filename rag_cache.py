@@ -0,0 +1,261 @@
+"""
+rag_cache.py - Cachés en memoria para la recuperación (RAG)
+
+Este módulo encapsula:
+- Caché semántica de resultados: consultas "casi iguales" (mismo significado,
+  distinta redacción) reutilizan la lista de Documentos ya recuperada
+- Desalojo LRU + expiración por TTL
+- Contadores de aciertos/fallos para monitorizar la efectividad
+- Memo de embeddings de consultas: consulta normalizada -> vector float32,
+  guardado en una matriz NumPy preasignada (memoria acotada)
+
+Objetivo: Evitar repetir el pase MMR completo cuando los estudiantes preguntan
+lo mismo con otras palabras, y no volver a ejecutar el encoder para consultas
+idénticas (reintentos del frontend, preguntas sin historial).
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+# --- CONFIGURACIÓN POR DEFECTO ---
+SEMANTIC_CACHE_CONFIG = {
+    "similarity_threshold": 0.95,  # Coseno mínimo para considerar dos consultas equivalentes
+    "max_entries": 256,            # Entradas máximas (LRU)
+    "ttl_seconds": 3600            # Vida máxima de una entrada
+}
+
+QUERY_EMBEDDING_CACHE_SIZE = 1024  # Consultas memorizadas (~1.5 MB con MiniLM, dim 384)
+
+
+def _normalize(vector) -> np.ndarray:
+    """Convierte a float32 y normaliza a norma 1 (coseno = producto punto)."""
+    vec = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+class SemanticRetrievalCache:
+    """
+    Caché de resultados de búsqueda indexada por el embedding de la consulta.
+
+    Un acierto ocurre cuando existe una entrada con los MISMOS parámetros de
+    búsqueda (k, modo, filtros...) cuyo embedding tiene similitud coseno
+    >= similarity_threshold con la consulta actual.
+    """
+
+    def __init__(
+        self,
+        similarity_threshold: float = SEMANTIC_CACHE_CONFIG["similarity_threshold"],
+        max_entries: int = SEMANTIC_CACHE_CONFIG["max_entries"],
+        ttl_seconds: float = SEMANTIC_CACHE_CONFIG["ttl_seconds"]
+    ):
+        """
+        Inicializa la caché.
+
+        Args:
+            similarity_threshold (float): Coseno mínimo para un acierto
+            max_entries (int): Número máximo de entradas antes de desalojar (LRU)
+            ttl_seconds (float): Segundos de vida de cada entrada
+        """
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        # clave incremental -> (params, vector normalizado, documentos, timestamp)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _expire(self, now: float):
+        """Elimina entradas cuyo TTL venció (el OrderedDict no está ordenado por edad)."""
+        expired = [key for key, entry in self._entries.items() if now - entry[3] > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+        self.evictions += len(expired)
+
+    def get(self, vector, params: Hashable) -> Optional[List[Document]]:
+        """
+        Busca un resultado cacheado para una consulta semánticamente equivalente.
+
+        Args:
+            vector: Embedding de la consulta
+            params (Hashable): Parámetros de búsqueda que deben coincidir exactamente
+
+        Returns:
+            Optional[List[Document]]: Copia de la lista cacheada o None si no hay acierto
+        """
+        query_vec = _normalize(vector)
+        now = time.monotonic()
+
+        with self._lock:
+            self._expire(now)
+
+            candidates = [(key, entry) for key, entry in self._entries.items() if entry[0] == params]
+            if candidates:
+                matrix = np.stack([entry[1] for _, entry in candidates])
+                similarities = matrix @ query_vec
+                best = int(np.argmax(similarities))
+
+                if similarities[best] >= self.similarity_threshold:
+                    key, entry = candidates[best]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    # Copia de la lista: los llamadores ordenan/recortan el resultado
+                    return list(entry[2])
+
+            self.misses += 1
+            return None
+
+    def put(self, vector, params: Hashable, docs: List[Document]):
+        """
+        Guarda el resultado de una búsqueda.
+
+        Args:
+            vector: Embedding de la consulta
+            params (Hashable): Parámetros de búsqueda
+            docs (List[Document]): Documentos recuperados
+        """
+        entry = (params, _normalize(vector), list(docs), time.monotonic())
+
+        with self._lock:
+            self._entries[self._next_key] = entry
+            self._next_key += 1
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Invalida todas las entradas (p. ej. cuando cambia el índice en disco)."""
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Devuelve contadores de uso de la caché."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class QueryEmbeddingCache:
+    """
+    Memo LRU acotado: consulta normalizada -> embedding float32.
+
+    Los vectores viven en una matriz (capacity x dim) preasignada al primer
+    uso; un OrderedDict mapea cada consulta a su fila (slot). Al desalojar,
+    el slot se reutiliza, así que la memoria nunca crece más allá de la matriz.
+    """
+
+    def __init__(self, capacity: int = QUERY_EMBEDDING_CACHE_SIZE):
+        """
+        Inicializa el memo.
+
+        Args:
+            capacity (int): Número máximo de consultas memorizadas
+        """
+        self.capacity = capacity
+        self._matrix: Optional[np.ndarray] = None  # Se asigna al conocer la dimensión
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.encoder_calls = 0
+        self.encoder_seconds = 0.0
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """
+        Normaliza la consulta para que variaciones triviales compartan entrada.
+        MiniLM es uncased, así que pasar a minúsculas no cambia el embedding.
+        """
+        return re.sub(r"\s+", " ", query).strip().lower()
+
+    def get(self, query: str) -> Optional[np.ndarray]:
+        """
+        Devuelve una copia del embedding memorizado o None.
+
+        Args:
+            query (str): Consulta original (se normaliza internamente)
+        """
+        key = self.normalize_query(query)
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                self.misses += 1
+                return None
+            self._slots.move_to_end(key)
+            self.hits += 1
+            return self._matrix[slot].copy()
+
+    def put(self, query: str, vector, encode_seconds: float = 0.0):
+        """
+        Memoriza el embedding de una consulta.
+
+        Args:
+            query (str): Consulta original
+            vector: Embedding calculado por el encoder
+            encode_seconds (float): Tiempo que costó calcularlo (para estadísticas)
+        """
+        key = self.normalize_query(query)
+        vec = np.asarray(vector, dtype=np.float32).ravel()
+
+        with self._lock:
+            self.encoder_calls += 1
+            self.encoder_seconds += encode_seconds
+
+            if self._matrix is None:
+                self._matrix = np.zeros((self.capacity, vec.shape[0]), dtype=np.float32)
+
+            slot = self._slots.get(key)
+            if slot is None:
+                if len(self._slots) < self.capacity:
+                    slot = len(self._slots)
+                else:
+                    # Desalojar la consulta menos usada y reutilizar su fila
+                    _, slot = self._slots.popitem(last=False)
+                self._slots[key] = slot
+            else:
+                self._slots.move_to_end(key)
+
+            self._matrix[slot] = vec
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Estadísticas del memo, incluido el tiempo de encoder ahorrado
+        (aciertos x tiempo medio por llamada al encoder).
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            avg_encode = self.encoder_seconds / self.encoder_calls if self.encoder_calls else 0.0
+            return {
+                "entries": len(self._slots),
+                "capacity": self.capacity,
+                "matrix_bytes": int(self._matrix.nbytes) if self._matrix is not None else 0,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "encoder_calls": self.encoder_calls,
+                "encoder_seconds": round(self.encoder_seconds, 4),
+                "encoder_seconds_saved": round(self.hits * avg_encode, 4),
+            }
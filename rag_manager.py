@@ -3,24 +3,47 @@ rag_manager.py - Gestor centralizado de recuperación de documentos (RAG)
 
 Este módulo encapsula toda la lógica relacionada con:
 - Carga de embeddings
-- Carga de la base de datos vectorial FAISS
+- Carga de la base de datos vectorial FAISS (índice mmap + docstore SQLite)
 - Búsqueda y recuperación de documentos usando MMR (Diversidad)
+- Búsqueda híbrida: BM25 (índice invertido en docstore.db) + vectores, fusionados con RRF
+- Filtros por metadatos (rango de páginas, source, file_name) aplicados dentro de la búsqueda
+- Caché semántica de resultados (invalidada si cambia el índice en disco)
+- Búsqueda reentrante: los parámetros de cada llamada (k, fetch_k, modo,
+  filtros) nunca se guardan en estado compartido y cada búsqueda trabaja
+  sobre una instantánea del vectorstore, así que varias pueden ejecutarse
+  en paralelo desde un pool de hilos (ver stress_test_concurrent_search)
 - Manejo de contexto
 
 Objetivo: Optimizar la recuperación para encontrar datos específicos.
 """
 
 import os
-from typing import List, Tuple
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
 from dotenv import load_dotenv
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.documents import Document
 
+from faiss_index import describe_index_spec
+from ingest_utils import EMBEDDING_MODEL, load_embeddings
+from lexical_index import HYBRID_SEARCH_CONFIG, reciprocal_rank_fusion, tokenize
+from mmr import mmr_select, normalize_rows
+from rag_cache import (
+    SemanticRetrievalCache,
+    QueryEmbeddingCache,
+    SEMANTIC_CACHE_CONFIG,
+    QUERY_EMBEDDING_CACHE_SIZE
+)
+from vectorstore import DOCSTORE_FILE, LocalVectorStore, normalize_filters
+
 # --- CONFIGURACIÓN ---
 load_dotenv()
 DB_FAISS_PATH = "vectorstore_faiss"
-EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+MMR_LAMBDA = 0.6  # Balancea relevancia (1.0) vs diversidad (0.0)
+SEARCH_MODES = ("mmr", "hybrid")
 
 
 class RAGManager:
@@ -29,74 +52,322 @@ class RAGManager:
     Utiliza MMR (Maximal Marginal Relevance) para evitar redundancia.
     """
     
-    def __init__(self, db_path: str = DB_FAISS_PATH):
+    def __init__(
+        self,
+        db_path: str = DB_FAISS_PATH,
+        cache_threshold: float = SEMANTIC_CACHE_CONFIG["similarity_threshold"],
+        cache_size: int = SEMANTIC_CACHE_CONFIG["max_entries"],
+        cache_ttl: float = SEMANTIC_CACHE_CONFIG["ttl_seconds"],
+        embedding_cache_size: int = QUERY_EMBEDDING_CACHE_SIZE
+    ):
         """
         Inicializa el RAGManager.
         Args:
             db_path (str): Ruta a la base de datos FAISS
+            cache_threshold (float): Coseno mínimo para reutilizar un resultado cacheado
+            cache_size (int): Entradas máximas de la caché semántica
+            cache_ttl (float): Segundos de vida de cada entrada cacheada
+            embedding_cache_size (int): Consultas cuyo embedding se memoriza
         """
         self.db_path = db_path
         self.embeddings = None
         self.vector_store = None
-        self.retriever = None
+        self.index_spec = None
+        self.retrieval_cache = SemanticRetrievalCache(
+            similarity_threshold=cache_threshold,
+            max_entries=cache_size,
+            ttl_seconds=cache_ttl
+        )
+        self.query_embedding_cache = QueryEmbeddingCache(capacity=embedding_cache_size)
+        self._index_fingerprint = None
+        self.index_version = None  # LocalVectorStore.version() del índice cargado
+        self._reload_lock = threading.Lock()
+        # (vectorstore, generación): se sustituye con UNA asignación al recargar,
+        # así una búsqueda en curso nunca mezcla el índice viejo con el nuevo
+        self._snapshot: Tuple[Optional[LocalVectorStore], int] = (None, 0)
         
         self._initialize()
     
     def _initialize(self):
-        """Inicializa embeddings y carga la base de datos FAISS con configuración MMR."""
+        """Inicializa embeddings y carga la base de datos FAISS."""
         try:
-            print("🧠 Inicializando embeddings...")
-            self.embeddings = HuggingFaceEmbeddings(
-                model_name=EMBEDDING_MODEL
-            )
+            # Con caché persistente: las consultas ya vistas (también antes de
+            # reiniciar el servidor) no vuelven a pasar por el encoder
+            self.embeddings = load_embeddings(EMBEDDING_MODEL)
             
-            print(f"📚 Cargando base de datos FAISS desde '{self.db_path}'...")
-            self.vector_store = FAISS.load_local(
-                self.db_path, 
-                self.embeddings, 
-                allow_dangerous_deserialization=True
-            )
-            
-            # --- CONFIGURACIÓN CRÍTICA: MMR (Diversidad) ---
-            # search_type="mmr": Busca diversidad en lugar de similitud pura.
-            # fetch_k: Número de documentos iniciales a analizar (antes de filtrar).
-            self.retriever = self.vector_store.as_retriever(
-                search_type="mmr",
-                search_kwargs={
-                    "k": 10,           # Valor base (se sobreescribe en search)
-                    "fetch_k": 50,     # Leemos 50 candidatos para encontrar la aguja en el pajar
-                    "lambda_mult": 0.6 # Balancea relevancia (1.0) vs diversidad (0.0)
-                }
-            )
+            self._load_vector_store()
             
-            print("✅ RAG Manager inicializado correctamente (Modo MMR Activado)")
+            print(f"✅ RAG Manager inicializado correctamente (Modo {self.default_search_mode().upper()} Activado)")
             
         except Exception as e:
             print(f"❌ ERROR al inicializar RAG Manager: {e}")
             print("   Por favor, ejecuta 'python ingest_data.py' primero")
             raise
     
-    def search(self, query: str, k: int = 10) -> List[Document]:
+    def _load_vector_store(self):
+        """
+        Carga (o recarga) el vectorstore desde disco y registra su huella.
+        El índice se mapea en memoria y los fragmentos se leen de docstore.db
+        solo cuando una búsqueda los devuelve.
+        """
+        print(f"📚 Cargando base de datos FAISS desde '{self.db_path}'...")
+        # Sin docstore.db, load() migra el formato anterior y reescribe index.faiss
+        migrating = not os.path.exists(os.path.join(self.db_path, DOCSTORE_FILE))
+        version_before = None if migrating else LocalVectorStore.version(self.db_path)
+        vector_store = LocalVectorStore.load(self.db_path)
+        # Huella después de load(): puede migrar index.pkl o generar la matriz normalizada,
+        # y una huella tomada antes provocaría una recarga en la primera búsqueda
+        fingerprint = self._current_fingerprint()
+        version = LocalVectorStore.version(self.db_path)
+        if version_before is not None and version_before != version:
+            # Una ingesta sustituyó index.faiss durante la carga: se recarga en la próxima búsqueda
+            fingerprint = None
+        self._snapshot = (vector_store, self._snapshot[1] + 1)
+        self.vector_store = vector_store
+        self.index_spec = vector_store.index_spec
+        print(f"   Índice: {describe_index_spec(self.index_spec)}, {vector_store.ntotal} vectores")
+        self._index_fingerprint = fingerprint
+        self.index_version = version
+    
+    def _current_fingerprint(self) -> Tuple:
+        """Huella del índice en disco: (archivo, mtime, tamaño) de cada archivo."""
+        try:
+            entries = sorted(os.scandir(self.db_path), key=lambda entry: entry.name)
+            return tuple(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in entries if entry.is_file()
+            )
+        except FileNotFoundError:
+            return ()
+    
+    def _refresh_if_index_changed(self):
+        """
+        Si el índice en disco cambió (re-ingesta), lo recarga e invalida la caché.
+        Comprobarlo cuesta un stat() por archivo, despreciable frente a una búsqueda.
+        """
+        if self._current_fingerprint() == self._index_fingerprint:
+            return
+        
+        with self._reload_lock:
+            if self._current_fingerprint() == self._index_fingerprint:
+                return
+            print("🔄 El índice FAISS cambió en disco, recargando...")
+            try:
+                self._load_vector_store()
+            except Exception as e:
+                # Ingesta a medio escribir: seguimos con el índice anterior
+                print(f"⚠️ No se pudo recargar el índice: {e}")
+                return
+            self.retrieval_cache.clear()
+    
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Vectoriza varias consultas reutilizando el memo.
+        Las que no están memorizadas se codifican en UN SOLO lote del encoder.
+        El memo no depende del índice, así que no se invalida al recargarlo.
+        
+        Returns:
+            np.ndarray: Matriz (len(queries), dim) en float32
+        """
+        vectors = [self.query_embedding_cache.get(query) for query in queries]
+        
+        # Consultas pendientes, deduplicadas por su forma normalizada
+        pending: Dict[str, List[int]] = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                key = QueryEmbeddingCache.normalize_query(queries[i])
+                pending.setdefault(key, []).append(i)
+        
+        if pending:
+            texts = [queries[positions[0]] for positions in pending.values()]
+            start = time.perf_counter()
+            # embed_documents == embed_query por texto en HuggingFaceEmbeddings,
+            # pero procesa todo el lote en una sola pasada del modelo
+            embedded = self.embeddings.embed_documents(texts)
+            per_query = (time.perf_counter() - start) / len(texts)
+            
+            for text, positions, embedding in zip(texts, pending.values(), embedded):
+                self.query_embedding_cache.put(text, embedding, per_query)
+                vector = np.asarray(embedding, dtype=np.float32)
+                for i in positions:
+                    vectors[i] = vector
+        
+        return np.vstack(vectors).astype(np.float32, copy=False)
+    
+    def _mmr_search_batch(
+        self,
+        vector_store: LocalVectorStore,
+        query_matrix: np.ndarray,
+        k: int,
+        fetch_k: int,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Document]]:
         """
-        Busca documentos relevantes usando MMR.
-        Permite ajustar k dinámicamente.
+        Búsqueda MMR para varias consultas: UNA llamada batched a FAISS para
+        obtener los candidatos de todas y luego la selección MMR por consulta
+        (mismo resultado que max_marginal_relevance_search_by_vector).
+        
+        Los candidatos se toman de la matriz normalizada residente del
+        vectorstore y la selección usa el kernel vectorizado de mmr.py.
+        Solo los k seleccionados se leen del docstore.
         """
-        if not self.retriever:
-            return []
+        _, candidate_ids = vector_store.search(query_matrix, fetch_k, filters)
+        normalized_queries = normalize_rows(query_matrix)
         
-        # Actualizamos dinámicamente k y fetch_k en el retriever
-        self.retriever.search_kwargs["k"] = k
-        # Aseguramos que fetch_k sea siempre mayor que k para que MMR funcione
-        if self.retriever.search_type == "mmr":
-            self.retriever.search_kwargs["fetch_k"] = max(k * 3, 50)
+        results = []
+        for query_vec, row in zip(normalized_queries, candidate_ids):
+            ids = [int(i) for i in row if i != -1]
+            if not ids:
+                results.append([])
+                continue
+            
+            candidate_vecs = vector_store.normalized_vectors(ids)
+            selected = mmr_select(query_vec, candidate_vecs, k, MMR_LAMBDA)
+            docs = vector_store.get_documents([ids[j] for j in selected])
+            results.append([doc for doc in docs if doc is not None])
+        
+        return results
+    
+    def _hybrid_search_batch(
+        self,
+        vector_store: LocalVectorStore,
+        queries: List[str],
+        query_matrix: np.ndarray,
+        k: int,
+        fetch_k: int,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Document]]:
+        """
+        Búsqueda híbrida: ranking vectorial (una llamada batched a FAISS) y
+        ranking BM25 por consulta, fusionados con Reciprocal Rank Fusion.
+        No necesita reconstruir vectores ni ejecutar MMR; solo los k
+        fusionados se leen del docstore.
+        """
+        _, candidate_ids = vector_store.search(query_matrix, fetch_k, filters)
+        
+        results = []
+        for query, row in zip(queries, candidate_ids):
+            vector_ranking = [int(i) for i in row if i != -1]
+            lexical_ranking = vector_store.lexical_search(query, HYBRID_SEARCH_CONFIG["lexical_k"], filters)
+            fused = reciprocal_rank_fusion([vector_ranking, lexical_ranking], k)
+            docs = vector_store.get_documents(fused)
+            results.append([doc for doc in docs if doc is not None])
+        
+        return results
+    
+    def search(
+        self,
+        query: str,
+        k: int = 10,
+        mode: Optional[str] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[Document]:
+        """
+        Busca documentos relevantes usando MMR (o búsqueda híbrida).
+        Permite ajustar k dinámicamente y filtrar por metadatos, p. ej.
+        filters={"pages": (0, 1)} para buscar solo en las portadas.
+        
+        La consulta se vectoriza una sola vez: el mismo embedding sirve para
+        consultar la caché semántica y, si no hay acierto, para la búsqueda.
+        """
+        return self.search_many([query], k, mode, filters)[0]
+    
+    def default_search_mode(self) -> str:
+        """'hybrid' si está habilitada en HYBRID_SEARCH_CONFIG, si no 'mmr'."""
+        return "hybrid" if HYBRID_SEARCH_CONFIG["enabled"] else "mmr"
+    
+    def search_many(
+        self,
+        queries: List[str],
+        k: int = 10,
+        mode: Optional[str] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Document]]:
+        """
+        Busca documentos para varias consultas a la vez (evaluaciones, preguntas múltiples).
+        
+        1. Embeddings de todas las consultas en un único lote
+        2. Caché semántica por consulta
+        3. Una sola búsqueda FAISS batched para las que no estaban en caché
+        4. Por consulta: selección MMR sobre sus candidatos ("mmr") o fusión
+           RRF con el ranking BM25 ("hybrid")
+        
+        Args:
+            queries (List[str]): Consultas a buscar
+            k (int): Documentos a devolver por consulta
+            mode (str): "mmr" o "hybrid" (None = default_search_mode())
+            filters (Dict): Filtro de metadatos {"pages": (inicio, fin), "source": ..., "file_name": ...};
+                            solo se puntúan los fragmentos que lo cumplen
+            
+        Returns:
+            List[List[Document]]: Resultados en el mismo orden que queries
+        """
+        if not self.vector_store or not queries:
+            return [[] for _ in queries]
+        
+        mode = mode or self.default_search_mode()
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Modo de búsqueda desconocido: {mode}. Usa uno de {SEARCH_MODES}")
+        filter_key = normalize_filters(filters)
+        
+        self._refresh_if_index_changed()
+        # Instantánea: toda la llamada usa el mismo vectorstore aunque otro hilo lo recargue
+        vector_store, generation = self._snapshot
+        
+        # Parámetros locales de la llamada (la generación evita que un resultado
+        # calculado con el índice anterior se cachee para el nuevo)
+        if mode == "hybrid":
+            fetch_k = max(k * 3, HYBRID_SEARCH_CONFIG["min_fetch_k"])
+            cache_params = ("hybrid", generation, k, fetch_k, HYBRID_SEARCH_CONFIG["lexical_k"],
+                            HYBRID_SEARCH_CONFIG["rrf_k"], filter_key)
+        else:
+            # Aseguramos que fetch_k sea siempre mayor que k para que MMR funcione
+            fetch_k = max(k * 3, 50)
+            cache_params = ("mmr", generation, k, fetch_k, MMR_LAMBDA, filter_key)
         
         # Ejecutar búsqueda
         try:
-            docs = self.retriever.invoke(query)
-            return docs
+            query_matrix = self.embed_queries(queries)
+            
+            # En modo híbrido el resultado depende de los términos exactos (un nombre
+            # distinto con embedding casi igual NO debe reutilizar el resultado)
+            query_params = [
+                cache_params + (tuple(sorted(set(tokenize(query)))),) if mode == "hybrid" else cache_params
+                for query in queries
+            ]
+            results: List[Optional[List[Document]]] = [
+                self.retrieval_cache.get(vector, params) for vector, params in zip(query_matrix, query_params)
+            ]
+            misses = [i for i, docs in enumerate(results) if docs is None]
+            
+            if len(misses) < len(queries):
+                print(f"⚡ [CACHE] {len(queries) - len(misses)}/{len(queries)} resultado(s) reutilizado(s)")
+            
+            if misses:
+                if mode == "hybrid":
+                    found = self._hybrid_search_batch(
+                        vector_store, [queries[i] for i in misses], query_matrix[misses], k, fetch_k, filters
+                    )
+                else:
+                    found = self._mmr_search_batch(vector_store, query_matrix[misses], k, fetch_k, filters)
+                for i, docs in zip(misses, found):
+                    self.retrieval_cache.put(query_matrix[i], query_params[i], docs)
+                    results[i] = list(docs)
+            
+            return results
         except Exception as e:
             print(f"⚠️ Error en búsqueda: {e}")
-            return []
+            return [[] for _ in queries]
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        """Estadísticas de las cachés: resultados (semántica) y embeddings de consultas."""
+        stats = {
+            "retrieval": self.retrieval_cache.stats(),
+            "query_embeddings": self.query_embedding_cache.stats(),
+        }
+        if hasattr(self.embeddings, "stats"):
+            stats["persistent_embeddings"] = self.embeddings.stats()
+        return stats
     
     def format_context(self, docs: List[Document]) -> str:
         """
@@ -125,10 +396,115 @@ class RAGManager:
 
 # --- INSTANCIA GLOBAL (Lazy Singleton) ---
 _rag_manager_instance = None
+# El primer acceso puede llegar desde varios hilos a la vez (nodos async -> to_thread)
+_rag_manager_lock = threading.Lock()
 
 def get_rag_manager() -> RAGManager:
     """Obtiene la instancia global del RAGManager."""
     global _rag_manager_instance
     if _rag_manager_instance is None:
-        _rag_manager_instance = RAGManager()
-    return _rag_manager_instance
\ No newline at end of file
+        with _rag_manager_lock:
+            if _rag_manager_instance is None:
+                _rag_manager_instance = RAGManager()
+    return _rag_manager_instance
+
+
+def stress_test_concurrent_search(
+    rag_mgr: RAGManager,
+    queries: List[str],
+    workers: int = 8,
+    tasks: int = 400,
+    reload_every: int = 100,
+    use_cache: bool = False
+) -> Dict[str, Any]:
+    """
+    Prueba de estrés: muchas búsquedas simultáneas con k, modo y filtros
+    distintos desde un pool de hilos, recargando el índice en medio.
+    Cada resultado debe coincidir con el de la misma búsqueda en serie.
+
+    Args:
+        rag_mgr (RAGManager): Gestor a probar
+        queries (List[str]): Consultas base
+        workers (int): Hilos del pool
+        tasks (int): Búsquedas concurrentes a lanzar
+        reload_every (int): Cada cuántas tareas se recarga el vectorstore (0 = nunca)
+        use_cache (bool): Permitir aciertos de la caché semántica durante la prueba
+
+    Returns:
+        Dict[str, Any]: Tareas, discrepancias, recargas y tiempos serie/concurrente
+    """
+    combos = [
+        (query, k, mode, pages)
+        for query in queries
+        for k in (3, 10, 25)
+        for mode in SEARCH_MODES
+        for pages in (None, (0, 5))
+    ]
+    threshold = rag_mgr.retrieval_cache.similarity_threshold
+    if not use_cache:
+        rag_mgr.retrieval_cache.similarity_threshold = float("inf")
+    rag_mgr.retrieval_cache.clear()
+
+    def run(combo):
+        query, k, mode, pages = combo
+        filters = {"pages": pages} if pages else None
+        return [doc.page_content for doc in rag_mgr.search(query, k=k, mode=mode, filters=filters)]
+
+    try:
+        start = time.perf_counter()
+        reference = {combo: run(combo) for combo in combos}
+        serial_seconds = time.perf_counter() - start
+
+        rng = random.Random(0)
+        plan = [rng.choice(combos) for _ in range(tasks)]
+        reloads = 0
+
+        def task(position, combo):
+            nonlocal reloads
+            if reload_every and position and position % reload_every == 0:
+                with rag_mgr._reload_lock:
+                    rag_mgr._load_vector_store()
+                    reloads += 1
+            return combo, run(combo)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stress") as pool:
+            outcomes = list(pool.map(lambda item: task(*item), enumerate(plan)))
+        concurrent_seconds = time.perf_counter() - start
+    finally:
+        rag_mgr.retrieval_cache.similarity_threshold = threshold
+
+    mismatches = sum(result != reference[combo] for combo, result in outcomes)
+    return {
+        "tasks": tasks,
+        "workers": workers,
+        "mismatches": mismatches,
+        "reloads": reloads,
+        "serial_ms_per_search": round(serial_seconds / len(combos) * 1000, 3),
+        "concurrent_ms_per_search": round(concurrent_seconds / tasks * 1000, 3),
+    }
+
+
+if __name__ == "__main__":
+    # Prueba de estrés: python rag_manager.py --workers 8 --tasks 400
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Búsquedas concurrentes contra el vectorstore")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--tasks", type=int, default=400)
+    parser.add_argument("--reload-every", type=int, default=100)
+    args = parser.parse_args()
+
+    sample_queries = [
+        "¿Quiénes son los tutores de la tesis?",
+        "¿Qué es Agentic RAG?",
+        "¿Cómo se configura el almacén vectorial con FAISS?",
+        "Sala de Fondos Raros y Valiosos",
+    ]
+    report = stress_test_concurrent_search(
+        get_rag_manager(), sample_queries, args.workers, args.tasks, args.reload_every
+    )
+    print(f"\n{report}")
+    if report["mismatches"]:
+        raise SystemExit(f"❌ {report['mismatches']} resultado(s) distintos de la ejecución en serie")
+    print("✅ Todas las búsquedas concurrentes coinciden con la ejecución en serie")
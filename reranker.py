@@ -0,0 +1,287 @@
+"""
+reranker.py - Reordenamiento de fragmentos con un cross-encoder en CPU
+
+Este módulo encapsula:
+- Carga perezosa (en segundo plano) de un cross-encoder multilingüe pequeño
+- Puntuación de pares (consulta, fragmento) en lotes
+- Caché de puntuaciones por (consulta normalizada, hash del fragmento)
+- Corte por confianza: solo pasan los fragmentos con probabilidad suficiente
+  (entre un mínimo y un máximo de fragmentos)
+- Presupuesto de tiempo: la puntuación corre en un executor y se espera como
+  mucho time_budget_seconds; si se agota, se devuelve la lista original sin
+  reordenar (los lotes ya lanzados terminan en segundo plano y alimentan la caché)
+
+Objetivo: Pasar a Gemma pocos fragmentos bien ordenados en lugar de 25
+ordenados solo por similitud de embeddings (prompts más cortos, respuestas
+más rápidas).
+
+Paso opcional, desactivado por defecto: RERANKER_ENABLED=1 lo activa (el
+servidor descarga y carga el modelo al arrancar solo en ese caso).
+
+Dependencia opcional: sentence-transformers (ya la instala langchain-huggingface).
+Si no está disponible, el reordenamiento se desactiva y se usa la lista original.
+"""
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+from rag_cache import QueryEmbeddingCache
+from vectorstore import content_hash
+
+# --- CONFIGURACIÓN ---
+RERANK_CONFIG = {
+    "enabled": os.getenv("RERANKER_ENABLED", "0") == "1",  # Opcional: RERANKER_ENABLED=1 lo activa
+    "model": os.getenv("RERANKER_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"),
+    "batch_size": 16,
+    "max_length": 512,           # Tokens por par (consulta + fragmento)
+    "min_confidence": 0.3,       # Probabilidad (sigmoide del logit) mínima para conservar un fragmento
+    "min_keep": 3,               # Siempre se conservan al menos estos fragmentos
+    "max_keep": 8,               # Y como mucho estos
+    "time_budget_seconds": 1.5,  # Si se supera, se usa la lista sin reordenar
+    "scoring_workers": 2,        # Puntuaciones simultáneas (hilos del executor de scoring)
+    "score_cache_size": 20_000   # Pares (consulta, fragmento) memorizados
+}
+
+
+def _sigmoid(logit: float) -> float:
+    """Convierte el logit del cross-encoder en una probabilidad de relevancia."""
+    return 1.0 / (1.0 + math.exp(-logit))
+
+
+class CrossEncoderReranker:
+    """
+    Reordena los fragmentos recuperados con un cross-encoder.
+
+    El modelo se carga en un hilo la primera vez que se necesita; mientras
+    carga, rerank() devuelve la lista original (nunca bloquea una respuesta).
+    """
+
+    def __init__(
+        self,
+        model_name: str = RERANK_CONFIG["model"],
+        model: Any = None,
+        batch_size: int = RERANK_CONFIG["batch_size"],
+        time_budget_seconds: float = RERANK_CONFIG["time_budget_seconds"],
+        score_cache_size: int = RERANK_CONFIG["score_cache_size"]
+    ):
+        """
+        Args:
+            model_name (str): Modelo de HuggingFace (cross-encoder)
+            model: Modelo ya cargado con predict(pares, batch_size=...) (opcional)
+            batch_size (int): Pares por lote de inferencia
+            time_budget_seconds (float): Tiempo máximo de puntuación por consulta
+            score_cache_size (int): Entradas máximas de la caché de puntuaciones
+        """
+        self.model_name = model_name
+        self.model = model
+        self.batch_size = batch_size
+        self.time_budget_seconds = time_budget_seconds
+        self.score_cache_size = score_cache_size
+
+        self._scores: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_thread: Optional[threading.Thread] = None
+        self._load_error: Optional[str] = None
+        self._executor = ThreadPoolExecutor(max_workers=RERANK_CONFIG["scoring_workers"],
+                                            thread_name_prefix="rerank")
+
+        self.stats_counters = {"reranked": 0, "timeouts": 0, "not_ready": 0, "errors": 0,
+                               "cache_hits": 0, "scored_pairs": 0}
+
+    # --- Carga del modelo ---
+
+    def _load_model(self):
+        """Carga el cross-encoder (se ejecuta en segundo plano)."""
+        try:
+            from sentence_transformers import CrossEncoder
+            print(f"🧠 [RERANK] Cargando cross-encoder '{self.model_name}'...")
+            self.model = CrossEncoder(self.model_name, max_length=RERANK_CONFIG["max_length"], device="cpu")
+            print("   ✅ Cross-encoder listo")
+        except Exception as e:
+            self._load_error = str(e)
+            print(f"⚠️ [RERANK] No se pudo cargar el cross-encoder ({e}); se desactiva el reordenamiento")
+
+    def is_ready(self) -> bool:
+        """True si el modelo está cargado. Lanza la carga la primera vez."""
+        if self.model is not None:
+            return True
+        if self._load_error is not None:
+            return False
+        with self._lock:
+            if self._load_thread is None:
+                self._load_thread = threading.Thread(target=self._load_model, name="reranker-load", daemon=True)
+                self._load_thread.start()
+        return False
+
+    def warm_up(self, timeout: Optional[float] = None) -> bool:
+        """Carga el modelo y espera a que esté listo (p. ej. al arrancar el servidor)."""
+        if not self.is_ready() and self._load_thread is not None:
+            self._load_thread.join(timeout)
+        return self.model is not None
+
+    def _reopen_after_fork(self):
+        """Proceso hijo (servidor multi-worker): lock y executor propios."""
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=RERANK_CONFIG["scoring_workers"],
+                                            thread_name_prefix="rerank")
+
+    def _count(self, name: str):
+        """Incrementa un contador (rerank() se llama desde varios hilos a la vez)."""
+        with self._lock:
+            self.stats_counters[name] += 1
+
+    # --- Puntuación ---
+
+    def _score(self, query: str, docs: Sequence[Document], deadline: float) -> Optional[List[float]]:
+        """
+        Probabilidad de relevancia de cada fragmento. Los pares cacheados no se
+        vuelven a puntuar. Devuelve None si se agota el presupuesto de tiempo.
+        """
+        query_key = QueryEmbeddingCache.normalize_query(query)
+        keys = [(query_key, content_hash(doc.page_content)) for doc in docs]
+
+        scores: Dict[Tuple[str, str], float] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._scores:
+                    self._scores.move_to_end(key)
+                    scores[key] = self._scores[key]
+            self.stats_counters["cache_hits"] += len(scores)
+
+        pending = list(dict.fromkeys(
+            (key, doc.page_content) for key, doc in zip(keys, docs) if key not in scores
+        ))
+        for start in range(0, len(pending), self.batch_size):
+            if time.perf_counter() > deadline:
+                return None
+            batch = pending[start:start + self.batch_size]
+            logits = self.model.predict(
+                [(query, text) for _, text in batch],
+                batch_size=self.batch_size,
+                show_progress_bar=False
+            )
+            computed = {key: _sigmoid(float(logit)) for (key, _), logit in zip(batch, logits)}
+            scores.update(computed)
+
+            with self._lock:
+                self.stats_counters["scored_pairs"] += len(batch)
+                self._scores.update(computed)
+                while len(self._scores) > self.score_cache_size:
+                    self._scores.popitem(last=False)
+
+        return [scores[key] for key in keys]
+
+    def rerank(
+        self,
+        query: str,
+        docs: List[Document],
+        min_confidence: float = RERANK_CONFIG["min_confidence"],
+        min_keep: int = RERANK_CONFIG["min_keep"],
+        max_keep: int = RERANK_CONFIG["max_keep"]
+    ) -> List[Document]:
+        """
+        Reordena los fragmentos y corta por confianza.
+
+        Se conservan los fragmentos con probabilidad >= min_confidence, con un
+        mínimo de min_keep y un máximo de max_keep. Si el modelo no está listo,
+        falla o se agota el presupuesto de tiempo, se devuelve docs tal cual.
+
+        Args:
+            query (str): Consulta usada en la búsqueda
+            docs (List[Document]): Candidatos en el orden de la búsqueda
+
+        Returns:
+            List[Document]: Fragmentos de mayor a menor relevancia
+        """
+        if len(docs) <= 1:
+            return docs
+        if not self.is_ready():
+            self._count("not_ready")
+            return docs
+
+        start = time.perf_counter()
+        deadline = start + self.time_budget_seconds
+        try:
+            # Se espera al resultado como mucho hasta el plazo (un lote de
+            # predict() no se puede interrumpir, pero la respuesta no lo espera)
+            future = self._executor.submit(self._score, query, docs, deadline)
+            scores = future.result(timeout=max(0.0, deadline - time.perf_counter()))
+        except FutureTimeoutError:
+            scores = None
+        except Exception as e:
+            self._count("errors")
+            print(f"⚠️ [RERANK] Error al puntuar ({e}); se usa el orden de la búsqueda")
+            return docs
+
+        elapsed = time.perf_counter() - start
+        if scores is None:
+            self._count("timeouts")
+            print(f"⏱️  [RERANK] Presupuesto de {self.time_budget_seconds}s agotado; se usa el orden de la búsqueda")
+            return docs
+
+        ranked = sorted(zip(scores, range(len(docs))), key=lambda item: (-item[0], item[1]))
+        kept = [i for position, (score, i) in enumerate(ranked)
+                if position < max_keep and (score >= min_confidence or position < min_keep)]
+
+        self._count("reranked")
+        print(f"🎯 [RERANK] {len(docs)} -> {len(kept)} fragmentos en {elapsed * 1000:.0f} ms "
+              f"(mejor: {ranked[0][0]:.2f})")
+        return [docs[i] for i in kept]
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores de uso."""
+        with self._lock:
+            counters = dict(self.stats_counters)
+        return {**counters, "model": self.model_name, "ready": self.model is not None,
+                "cached_scores": len(self._scores)}
+
+
+# --- INSTANCIA GLOBAL (Lazy Singleton) ---
+_reranker_instance = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> Optional[CrossEncoderReranker]:
+    """Reranker global, o None si está desactivado (por defecto; RERANKER_ENABLED=1 lo activa)."""
+    global _reranker_instance
+    if not RERANK_CONFIG["enabled"]:
+        return None
+    if _reranker_instance is None:
+        with _reranker_lock:
+            if _reranker_instance is None:
+                _reranker_instance = CrossEncoderReranker()
+    return _reranker_instance
+
+
+def _reset_reranker_after_fork():
+    """Los hilos del executor no sobreviven al fork: cada worker crea el suyo."""
+    if _reranker_instance is not None:
+        _reranker_instance._reopen_after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_reranker_after_fork)
+
+
+if __name__ == "__main__":
+    # Demo: python reranker.py "pregunta"  (compara el orden antes y después)
+    import sys
+    from rag_manager import get_rag_manager
+
+    query = " ".join(sys.argv[1:]) or "¿Quiénes son los tutores de la tesis?"
+    reranker = CrossEncoderReranker(time_budget_seconds=30)
+    if not reranker.warm_up():
+        sys.exit(1)
+
+    docs = get_rag_manager().search(query, k=25)
+    for label, ordered in (("Búsqueda", docs), ("Reordenado", reranker.rerank(query, docs))):
+        print(f"\n{label}:")
+        for doc in ordered:
+            print(f"  Pág {doc.metadata.get('page', '?')}: {doc.page_content[:80].replace(chr(10), ' ')}")
+    print(f"\n{reranker.stats()}")
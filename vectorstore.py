@@ -0,0 +1,1055 @@
+"""
+vectorstore.py - Almacenamiento local del índice vectorial y de los fragmentos
+
+Este módulo encapsula:
+- ChunkStore: texto y metadatos de cada fragmento en SQLite (docstore.db),
+  indexado por el id del vector en FAISS y leído bajo demanda
+- Resúmenes de documento guardados UNA vez por documento (no copiados en
+  los metadatos de cada fragmento)
+- LocalVectorStore: índice FAISS (memory-mapped) + ChunkStore + especificación
+- Guardado atómico (archivo temporal + os.replace)
+- Actualización incremental: hash de contenido por fragmento (deduplicación)
+  y hash de archivo por fuente (reemplazo de documentos modificados)
+- Índice invertido BM25 (tabla postings) mantenido junto con los fragmentos
+- Filtros por metadatos (rango de páginas, source, file_name) resueltos con
+  conjuntos de ids precalculados: la búsqueda solo puntúa los vectores que cumplen
+- Migración automática del formato anterior de LangChain (index.pkl)
+
+Objetivo: Que arrancar un worker no cueste leer todo el índice a RAM ni
+deserializar todos los fragmentos; solo se materializan como Document los
+top-k resultados de cada búsqueda.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from faiss_index import (
+    build_index,
+    extract_vectors,
+    index_ids,
+    load_index_spec,
+    load_index_spec_and_generation,
+    normalize_index_spec,
+    read_index,
+    save_index_spec,
+    search_parameters
+)
+from mmr import normalize_rows
+from lexical_index import bm25_scores, term_frequencies, tokenize
+
+# --- CONFIGURACIÓN ---
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "docstore.db"
+LEGACY_DOCSTORE_FILE = "index.pkl"  # Formato de FAISS.save_local (pickle)
+# Vectores normalizados para MMR (ordenados por id), abiertos con mmap: todos
+# los workers comparten las mismas páginas en lugar de una copia privada cada uno.
+# Un par de archivos por generación: normalized-<gen>.npy y normalized_ids-<gen>.npy
+NORMALIZED_PREFIXES = ("normalized", "normalized_ids")
+# save() sustituye varios archivos: load() comprueba que docstore.db e
+# index_spec.json sean de la misma generación y, si no, reintenta
+LOAD_CONFIG = {
+    "attempts": 5,
+    "retry_delay_seconds": 0.2
+}
+SUMMARY_METADATA_KEY = "document_summary"
+
+# Búsqueda filtrada por metadatos
+METADATA_FILTER_CONFIG = {
+    "brute_force_max_ids": 4096,  # Selecciones pequeñas: distancia exacta en NumPy
+    "max_cached_filters": 256     # Filtros resueltos (ids + selector FAISS) memorizados
+}
+FILTER_KEYS = ("pages", "source", "file_name")
+
+
+def normalize_filters(filters: Optional[Dict[str, Any]]) -> Optional[Tuple]:
+    """
+    Convierte un filtro en una clave hashable y canónica (o None si no filtra).
+
+    Formato aceptado:
+        {"pages": (0, 1)}                   rango de páginas inclusivo (páginas 0-based)
+        {"source": "data/a.pdf"}            una fuente o una lista de fuentes
+        {"file_name": ["a.pdf", "b.pdf"]}   uno o varios nombres de archivo
+
+    Las condiciones se combinan con AND.
+    """
+    if not filters:
+        return None
+
+    unknown = set(filters) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Filtro desconocido: {sorted(unknown)}. Usa {FILTER_KEYS}")
+
+    key = []
+    for name in FILTER_KEYS:
+        value = filters.get(name)
+        if value is None:
+            continue
+        if name == "pages":
+            first, last = value
+            key.append((name, (int(first), int(last))))
+        else:
+            values = [value] if isinstance(value, str) else list(value)
+            key.append((name, tuple(sorted(values))))
+    return tuple(key) or None
+
+
+def content_hash(text: str) -> str:
+    """Hash SHA-256 del texto de un fragmento (clave de deduplicación)."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Docstores abiertos en este proceso: tras un fork cada hijo reabre sus conexiones
+_open_chunk_stores: "weakref.WeakSet[ChunkStore]" = weakref.WeakSet()
+
+
+class ChunkStore:
+    """
+    Docstore en SQLite: id (el mismo que en FAISS) -> texto + metadatos.
+
+    Tablas:
+    - chunks(id, content, metadata JSON, source, file_name, page, chunk_index, content_hash, token_count)
+    - postings(term, chunk_id, tf): índice invertido para la búsqueda BM25
+    - summaries(source, summary): el resumen de cada documento una sola vez
+    - sources(source, file_hash, chunk_count, duplicate_count, ingested_at): archivos ingeridos
+
+    Las lecturas de la búsqueda (get_documents, lexical_search, metadata_rows)
+    usan una conexión de solo lectura por hilo cuando el docstore está en disco,
+    así que varias búsquedas concurrentes no se serializan en un único lock.
+    Las escrituras usan la conexión principal protegida por el lock.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        """
+        Abre (o crea) el docstore.
+
+        Args:
+            path (str): Ruta de docstore.db (":memory:" para construir en RAM)
+        """
+        self.path = path
+        # copy_of() conserva la ruta de origen en path, pero la base sigue en RAM
+        self.in_memory = path == ":memory:"
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._lexical_stats = None  # (fragmentos, longitud media); se invalida al escribir
+        self._setup()
+
+        # Conexiones de lectura por hilo (no aplica a bases en memoria: cada
+        # conexión a ":memory:" sería una base distinta)
+        self._concurrent_reads = not self.in_memory
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        # Generación del archivo abierto: las conexiones de lectura (que se abren
+        # por ruta más tarde) deben ver el mismo archivo
+        self._generation = self.generation
+        _open_chunk_stores.add(self)
+
+    def _reopen_after_fork(self):
+        """
+        Proceso hijo: conexiones y locks nuevos. Las heredadas del padre quedan
+        sin usar (no se cierran). Un docstore en memoria es una copia privada
+        del hijo y conserva su conexión (también las copias de copy_of(), cuya
+        path apunta al archivo de origen).
+        """
+        if not self.in_memory:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._readers = []
+
+    def _setup(self):
+        """Crea las tablas e índices si no existen."""
+        with self._lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    source TEXT,
+                    file_name TEXT,
+                    page INTEGER,
+                    chunk_index INTEGER,
+                    content_hash TEXT,
+                    token_count INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS idx_chunks_source ON chunks(source);
+                CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    chunk_id INTEGER NOT NULL,
+                    tf INTEGER NOT NULL,
+                    PRIMARY KEY (term, chunk_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings(chunk_id);
+                CREATE TABLE IF NOT EXISTS summaries (
+                    source TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS sources (
+                    source TEXT PRIMARY KEY,
+                    file_hash TEXT NOT NULL,
+                    chunk_count INTEGER NOT NULL,
+                    duplicate_count INTEGER NOT NULL DEFAULT 0,
+                    ingested_at TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+
+            # docstore.db creado antes de la ingesta incremental: añadir y rellenar content_hash
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(chunks)")}
+            if "content_hash" not in columns:
+                self.conn.execute("ALTER TABLE chunks ADD COLUMN content_hash TEXT")
+                rows = self.conn.execute("SELECT id, content FROM chunks").fetchall()
+                self.conn.executemany(
+                    "UPDATE chunks SET content_hash = ? WHERE id = ?",
+                    [(content_hash(content), chunk_id) for chunk_id, content in rows]
+                )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_hash ON chunks(content_hash)")
+
+            # docstore.db creado antes de la búsqueda híbrida: construir el índice invertido
+            if "token_count" not in columns:
+                self.conn.execute("ALTER TABLE chunks ADD COLUMN token_count INTEGER")
+                rows = self.conn.execute("SELECT id, content FROM chunks").fetchall()
+                self._write_postings(rows)
+            self.conn.commit()
+
+    def _write_postings(self, rows: Sequence[Tuple[int, str]]):
+        """(Re)escribe postings y token_count de los fragmentos dados (con el lock tomado)."""
+        posting_rows = []
+        length_rows = []
+        for chunk_id, content in rows:
+            frequencies, length = term_frequencies(content)
+            posting_rows.extend((term, chunk_id, tf) for term, tf in frequencies.items())
+            length_rows.append((length, chunk_id))
+
+        self.conn.executemany("DELETE FROM postings WHERE chunk_id = ?", [(row[0],) for row in rows])
+        self.conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", posting_rows)
+        self.conn.executemany("UPDATE chunks SET token_count = ? WHERE id = ?", length_rows)
+        self._lexical_stats = None
+
+    @contextmanager
+    def _reader(self) -> Iterator[sqlite3.Connection]:
+        """Conexión para leer: la de solo lectura del hilo actual, o la principal con el lock."""
+        if not self._concurrent_reads:
+            with self._lock:
+                yield self.conn
+            return
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+            if (row[0] if row else None) != self._generation:
+                # save() sustituyó el archivo después de abrir este docstore: la
+                # ruta ya apunta a otra generación (la del índice nuevo). Se sigue
+                # leyendo el archivo original por la conexión principal hasta recargar.
+                conn.close()
+                self._concurrent_reads = False
+                with self._lock:
+                    yield self.conn
+                return
+            self._local.conn = conn
+            with self._lock:
+                self._readers.append(conn)
+        yield conn
+
+    @classmethod
+    def copy_of(cls, path: str) -> "ChunkStore":
+        """
+        Carga una copia en memoria de un docstore en disco. Las modificaciones
+        no tocan el archivo hasta que se guarda con save_to() (escritura atómica).
+        """
+        store = cls(":memory:")
+        source = sqlite3.connect(path)
+        try:
+            with store._lock:
+                source.backup(store.conn)
+        finally:
+            source.close()
+        store.path = path
+        store._setup()
+        return store
+
+    def add_documents(self, ids: Sequence[int], documents: Sequence[Document]):
+        """
+        Inserta fragmentos con sus ids.
+
+        El resumen del documento (metadata["document_summary"]) se separa del
+        fragmento y se guarda en la tabla summaries, una fila por documento.
+        """
+        chunk_rows = []
+        summary_rows = {}
+        for chunk_id, doc in zip(ids, documents):
+            metadata = dict(doc.metadata)
+            source = metadata.get("source")
+            summary = metadata.pop(SUMMARY_METADATA_KEY, None)
+            if summary is not None:
+                summary_rows[source] = summary
+
+            chunk_rows.append((
+                int(chunk_id),
+                doc.page_content,
+                json.dumps(metadata, ensure_ascii=False, default=str),
+                source,
+                metadata.get("file_name"),
+                metadata.get("page"),
+                metadata.get("chunk_index"),
+                content_hash(doc.page_content),
+            ))
+
+        with self._lock:
+            self.conn.executemany(
+                """INSERT OR REPLACE INTO chunks
+                   (id, content, metadata, source, file_name, page, chunk_index, content_hash)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                chunk_rows
+            )
+            self._write_postings([(row[0], row[1]) for row in chunk_rows])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO summaries VALUES (?, ?)", list(summary_rows.items())
+            )
+            self.conn.commit()
+
+    def get_documents(self, ids: Sequence[int]) -> List[Optional[Document]]:
+        """
+        Materializa los Documentos de los ids pedidos, en el MISMO orden.
+
+        Returns:
+            List[Optional[Document]]: None para ids inexistentes
+        """
+        ids = [int(i) for i in ids]
+        if not ids:
+            return []
+
+        placeholders = ",".join("?" * len(ids))
+        with self._reader() as conn:
+            rows = conn.execute(
+                f"""SELECT c.id, c.content, c.metadata, s.summary
+                    FROM chunks c LEFT JOIN summaries s ON s.source = c.source
+                    WHERE c.id IN ({placeholders})""",
+                ids
+            ).fetchall()
+
+        found = {}
+        for chunk_id, content, metadata_json, summary in rows:
+            metadata = json.loads(metadata_json)
+            if summary is not None:
+                metadata[SUMMARY_METADATA_KEY] = summary
+            found[chunk_id] = Document(page_content=content, metadata=metadata)
+
+        return [found.get(i) for i in ids]
+
+    def lexical_search(
+        self,
+        query: str,
+        k: int,
+        allowed_ids: Optional[np.ndarray] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        Búsqueda BM25 sobre el índice invertido.
+
+        Args:
+            query (str): Consulta
+            k (int): Resultados a devolver
+            allowed_ids (np.ndarray): Si se indica, solo se devuelven estos ids (filtro)
+
+        Returns:
+            List[Tuple[int, float]]: (chunk_id, puntuación) de mayor a menor
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        placeholders = ",".join("?" * len(terms))
+        with self._reader() as conn:
+            lexical_stats = self._lexical_stats
+            if lexical_stats is None:
+                lexical_stats = self._lexical_stats = conn.execute(
+                    "SELECT COUNT(*), COALESCE(AVG(token_count), 0) FROM chunks"
+                ).fetchone()
+            total_documents, average_length = lexical_stats
+
+            document_frequencies = dict(conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({placeholders}) GROUP BY term",
+                terms
+            ).fetchall())
+            postings = conn.execute(
+                f"""SELECT p.chunk_id, p.term, p.tf, c.token_count
+                    FROM postings p JOIN chunks c ON c.id = p.chunk_id
+                    WHERE p.term IN ({placeholders})""",
+                terms
+            ).fetchall()
+
+        if allowed_ids is not None:
+            allowed = set(allowed_ids.tolist())
+            postings = [row for row in postings if row[0] in allowed]
+
+        scores = bm25_scores(postings, document_frequencies, total_documents, average_length)
+        return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+    def metadata_rows(self) -> List[Tuple[int, Optional[str], Optional[str], Optional[int]]]:
+        """(id, source, file_name, page) de todos los fragmentos (sin leer el texto)."""
+        with self._reader() as conn:
+            return conn.execute("SELECT id, source, file_name, page FROM chunks").fetchall()
+
+    def count(self) -> int:
+        """Número de fragmentos almacenados."""
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def next_id(self) -> int:
+        """Primer id libre (los ids nunca se reutilizan mientras exista uno mayor)."""
+        with self._lock:
+            return self.conn.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM chunks").fetchone()[0]
+
+    def existing_hashes(self, hashes: Sequence[str]) -> set:
+        """Subconjunto de hashes de contenido que ya están almacenados."""
+        found = set()
+        hashes = list(set(hashes))
+        with self._lock:
+            # Por lotes: SQLite limita el número de parámetros por consulta
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                found.update(row[0] for row in self.conn.execute(
+                    f"SELECT content_hash FROM chunks WHERE content_hash IN ({placeholders})", batch
+                ))
+        return found
+
+    def ids_for_source(self, source: str) -> List[int]:
+        """Ids de todos los fragmentos de una fuente."""
+        with self._lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT id FROM chunks WHERE source = ?", (source,)
+            )]
+
+    def hashes_for_source(self, source: str) -> Dict[str, int]:
+        """Hash de contenido -> id de los fragmentos de una fuente."""
+        with self._lock:
+            return {row[0]: row[1] for row in self.conn.execute(
+                "SELECT content_hash, id FROM chunks WHERE source = ?", (source,)
+            )}
+
+    def delete_ids(self, ids: Sequence[int]):
+        """Elimina fragmentos por id."""
+        with self._lock:
+            rows = [(int(i),) for i in ids]
+            self.conn.executemany("DELETE FROM postings WHERE chunk_id = ?", rows)
+            self.conn.executemany("DELETE FROM chunks WHERE id = ?", rows)
+            self._lexical_stats = None
+            self.conn.commit()
+
+    def delete_source(self, source: str) -> int:
+        """Elimina los fragmentos, el resumen y el registro de una fuente."""
+        with self._lock:
+            self.conn.execute(
+                "DELETE FROM postings WHERE chunk_id IN (SELECT id FROM chunks WHERE source = ?)",
+                (source,)
+            )
+            deleted = self.conn.execute("DELETE FROM chunks WHERE source = ?", (source,)).rowcount
+            self._lexical_stats = None
+            self.conn.execute("DELETE FROM summaries WHERE source = ?", (source,))
+            self.conn.execute("DELETE FROM sources WHERE source = ?", (source,))
+            self.conn.commit()
+        return deleted
+
+    def invalidate_sources_with_duplicates(self, except_source: str) -> int:
+        """
+        Olvida el hash de archivo de las fuentes que omitieron fragmentos por
+        duplicados: al borrar fragmentos, su contenido pudo depender de ellos,
+        así que la próxima ingesta incremental las vuelve a procesar.
+        """
+        with self._lock:
+            updated = self.conn.execute(
+                "UPDATE sources SET file_hash = '' WHERE duplicate_count > 0 AND source != ?",
+                (except_source,)
+            ).rowcount
+            self.conn.commit()
+        return updated
+
+    def get_source_hash(self, source: str) -> Optional[str]:
+        """Hash del archivo con el que se ingirió la fuente (None si no consta)."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT file_hash FROM sources WHERE source = ?", (source,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def record_source(self, source: str, file_hash: str, chunk_count: int, duplicate_count: int = 0):
+        """Registra (o actualiza) el archivo ingerido para una fuente."""
+        with self._lock:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO sources
+                   (source, file_hash, chunk_count, duplicate_count, ingested_at)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (source, file_hash, chunk_count, duplicate_count, datetime.now().isoformat())
+            )
+            self.conn.commit()
+
+    @property
+    def generation(self) -> Optional[str]:
+        """Generación del vectorstore guardada con save() (None en docstores anteriores)."""
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else None
+
+    def set_generation(self, generation: str):
+        """Registra la generación que comparte con index_spec.json."""
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (generation,))
+            self.conn.commit()
+
+    def save_to(self, path: str):
+        """Copia consistente de la base completa a otro archivo (API de backup de SQLite)."""
+        target = sqlite3.connect(path)
+        try:
+            with self._lock:
+                self.conn.backup(target)
+        finally:
+            target.close()
+
+    def close(self):
+        """Cierra la conexión principal y las de lectura de cada hilo."""
+        with self._lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers.clear()
+            self.conn.close()
+
+
+def _reopen_chunk_stores_after_fork():
+    for store in list(_open_chunk_stores):
+        store._reopen_after_fork()
+
+
+os.register_at_fork(after_in_child=_reopen_chunk_stores_after_fork)
+
+
+class MetadataIdIndex:
+    """
+    Ids de fragmentos agrupados por valor de metadato (page, source, file_name).
+
+    Se construye una vez por carga del vectorstore leyendo solo esas columnas;
+    resolver un filtro es concatenar / intersectar arrays ordenados de ids.
+    """
+
+    def __init__(self, rows: Sequence[Tuple[int, Optional[str], Optional[str], Optional[int]]]):
+        groups: Dict[str, Dict[Any, List[int]]] = {"source": {}, "file_name": {}, "page": {}}
+        for chunk_id, source, file_name, page in rows:
+            groups["source"].setdefault(source, []).append(chunk_id)
+            groups["file_name"].setdefault(file_name, []).append(chunk_id)
+            if page is not None:
+                groups["page"].setdefault(int(page), []).append(chunk_id)
+
+        self.groups = {
+            name: {value: np.sort(np.asarray(ids, dtype=np.int64)) for value, ids in values.items()}
+            for name, values in groups.items()
+        }
+
+    def resolve(self, filter_key: Tuple) -> np.ndarray:
+        """Ids (ordenados) que cumplen TODAS las condiciones del filtro normalizado."""
+        empty = np.empty(0, dtype=np.int64)
+        result = None
+        for name, value in filter_key:
+            if name == "pages":
+                first, last = value
+                arrays = [ids for page, ids in self.groups["page"].items() if first <= page <= last]
+            else:
+                arrays = [self.groups[name].get(item, empty) for item in value]
+
+            ids = np.unique(np.concatenate(arrays)) if arrays else empty
+            result = ids if result is None else np.intersect1d(result, ids, assume_unique=True)
+        return empty if result is None else result
+
+
+def _normalized_matrix(index: faiss.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """(ids ordenados, vectores normalizados en ese orden) de todo el índice."""
+    all_ids, vectors = extract_vectors(index)
+    order = np.argsort(all_ids)
+    return all_ids[order], normalize_rows(vectors[order])
+
+
+def _normalized_paths(db_path: str, generation: Optional[str]) -> Tuple[str, str]:
+    """(matriz, ids) de la generación dada (sin generación: vectorstores anteriores)."""
+    suffix = f"-{generation}" if generation else ""
+    matrix_prefix, ids_prefix = NORMALIZED_PREFIXES
+    return (os.path.join(db_path, f"{matrix_prefix}{suffix}.npy"),
+            os.path.join(db_path, f"{ids_prefix}{suffix}.npy"))
+
+
+def _save_normalized(db_path: str, index: faiss.Index, generation: Optional[str] = None):
+    """Escribe la matriz normalizada y sus ids (temporal + os.replace, como save())."""
+    sorted_ids, matrix = _normalized_matrix(index)
+    for path, array in zip(_normalized_paths(db_path, generation), (matrix, sorted_ids)):
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, array)
+        os.replace(path + ".tmp", path)
+
+
+def _remove_stale_normalized(db_path: str, keep: Sequence[Optional[str]]):
+    """
+    Borra las matrices normalizadas de generaciones que no están en keep.
+    save() conserva también la anterior: un proceso que acaba de leer el
+    index_spec.json previo todavía puede abrirla.
+    """
+    for name in os.listdir(db_path):
+        stem, extension = os.path.splitext(name)
+        prefix, _, generation = stem.partition("-")
+        if extension == ".npy" and prefix in NORMALIZED_PREFIXES and (generation or None) not in keep:
+            try:
+                os.remove(os.path.join(db_path, name))
+            except FileNotFoundError:
+                pass
+
+
+def _load_normalized(db_path: str, index: faiss.Index, generation: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Abre con mmap la matriz normalizada del índice. Si falta (vectorstore
+    anterior) o no corresponde a los ids del índice, se genera una vez en disco.
+    """
+    matrix_path, ids_path = _normalized_paths(db_path, generation)
+    expected_ids = np.sort(index_ids(index))
+    try:
+        sorted_ids = np.load(ids_path, mmap_mode="r")
+        if np.array_equal(sorted_ids, expected_ids):
+            return sorted_ids, np.load(matrix_path, mmap_mode="r")
+    except FileNotFoundError:
+        pass
+
+    if generation is not None and load_index_spec_and_generation(db_path)[1] != generation:
+        # Generación ya sustituida por otro save() (se recargará): no se escriben archivos obsoletos
+        return _normalized_matrix(index)
+
+    print("   🧮 Precalculando vectores normalizados para MMR...")
+    try:
+        _save_normalized(db_path, index, generation)
+    except OSError as e:
+        # Carpeta de solo lectura: matriz en memoria de este proceso
+        print(f"   ⚠️  No se pudo guardar {os.path.basename(matrix_path)} ({e}); se usa en memoria")
+        return _normalized_matrix(index)
+    return np.load(ids_path, mmap_mode="r"), np.load(matrix_path, mmap_mode="r")
+
+
+class LocalVectorStore:
+    """
+    Índice FAISS + docstore SQLite, guardados en una carpeta:
+
+        vectorstore_faiss/
+            index.faiss      vectores con ids explícitos (se abre con mmap)
+            docstore.db      fragmentos, resúmenes e índice invertido BM25
+            index_spec.json  tipo de índice y parámetros de búsqueda
+            normalized-<gen>.npy  vectores normalizados para MMR (+ normalized_ids-<gen>.npy), con mmap
+
+    docstore.db e index_spec.json guardan la misma generación (un id por cada
+    save()); load() nunca empareja un docstore con el índice de otra generación.
+    """
+
+    def __init__(self, index: faiss.Index, chunks: ChunkStore, index_spec: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            index (faiss.Index): Índice con ids = ids de ChunkStore
+            chunks (ChunkStore): Docstore de fragmentos
+            index_spec (Dict): Especificación del índice
+        """
+        self.index = index
+        self.chunks = chunks
+        self.index_spec = normalize_index_spec(index_spec)
+
+        # Filtros por metadatos: índice de ids (perezoso) y filtros ya resueltos
+        self._metadata_ids: Optional[MetadataIdIndex] = None
+        self._resolved_filters: "OrderedDict[Tuple, Tuple[np.ndarray, Optional[faiss.SearchParameters]]]" = OrderedDict()
+        self._filter_lock = threading.Lock()
+
+        # Matriz residente de vectores normalizados (ids ordenados, matriz) para MMR
+        self._normalized: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._normalized_lock = threading.Lock()
+
+    @classmethod
+    def build(
+        cls,
+        documents: List[Document],
+        vectors: np.ndarray,
+        index_spec: Optional[Dict[str, Any]] = None,
+        ids: Optional[Sequence[int]] = None
+    ) -> "LocalVectorStore":
+        """
+        Construye el vectorstore en memoria (se persiste con save()).
+
+        Args:
+            documents (List[Document]): Fragmentos
+            vectors (np.ndarray): Embeddings (n, dim), alineados con documents
+            index_spec (Dict): Tipo de índice FAISS
+            ids (Sequence[int]): Ids de los fragmentos (por defecto 0..n-1)
+        """
+        ids = np.arange(len(documents), dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        index = build_index(vectors, index_spec, ids=ids)
+        chunks = ChunkStore()
+        chunks.add_documents(ids, documents)
+        return cls(index, chunks, index_spec)
+
+    @staticmethod
+    def exists(db_path: str) -> bool:
+        """True si db_path contiene un vectorstore (formato actual o anterior)."""
+        return os.path.exists(os.path.join(db_path, INDEX_FILE)) and (
+            os.path.exists(os.path.join(db_path, DOCSTORE_FILE))
+            or os.path.exists(os.path.join(db_path, LEGACY_DOCSTORE_FILE))
+        )
+
+    @staticmethod
+    def version(db_path: str) -> Optional[str]:
+        """
+        Versión del vectorstore guardado en db_path: (mtime, tamaño) de index.faiss.
+        save() siempre sustituye ese archivo, así que cambia con cada
+        reconstrucción o ingesta incremental (y no con las lecturas).
+        """
+        try:
+            stat = os.stat(os.path.join(db_path, INDEX_FILE))
+        except FileNotFoundError:
+            return None
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    @classmethod
+    def load(cls, db_path: str, mmap: bool = True, writable: bool = False) -> "LocalVectorStore":
+        """
+        Abre un vectorstore guardado. Si la carpeta tiene el formato anterior
+        (index.pkl), se migra primero.
+
+        Args:
+            db_path (str): Carpeta del vectorstore
+            mmap (bool): Mapear el índice en memoria (solo lectura)
+            writable (bool): Cargar índice y docstore en memoria para modificarlos
+                             (ingesta incremental); los cambios se escriben con save()
+        """
+        if not os.path.exists(os.path.join(db_path, DOCSTORE_FILE)):
+            if os.path.exists(os.path.join(db_path, LEGACY_DOCSTORE_FILE)):
+                migrate_legacy_vectorstore(db_path)
+            else:
+                raise FileNotFoundError(f"No existe un vectorstore en '{db_path}'")
+
+        # Orden de lectura inverso al de save(): primero index_spec.json (se
+        # escribe el último), luego el índice y por último docstore.db. Si la
+        # generación del docstore coincide con la del spec, el índice leído
+        # entre ambos también es de esa generación.
+        docstore_path = os.path.join(db_path, DOCSTORE_FILE)
+        for attempt in range(LOAD_CONFIG["attempts"]):
+            index_spec, generation = load_index_spec_and_generation(db_path)
+            index = read_index(os.path.join(db_path, INDEX_FILE), index_spec, mmap=mmap and not writable)
+            chunks = ChunkStore.copy_of(docstore_path) if writable else ChunkStore(docstore_path)
+            if chunks.generation == generation:
+                break
+            # save() en curso en otro proceso: se espera a que termine
+            chunks.close()
+            time.sleep(LOAD_CONFIG["retry_delay_seconds"])
+        else:
+            raise RuntimeError(f"docstore.db e index.faiss de '{db_path}' son de generaciones distintas "
+                               "(¿ingesta en curso?)")
+
+        store = cls(index, chunks, index_spec)
+        if not writable:
+            store._normalized = _load_normalized(db_path, index, generation)
+        return store
+
+    def save(self, db_path: str):
+        """
+        Guarda índice, docstore y especificación en db_path.
+
+        Cada archivo se escribe primero a un temporal y se sustituye con
+        os.replace, de modo que un lector nunca ve un archivo a medio escribir.
+        Todos llevan una generación nueva: docstore.db (tabla meta), la matriz
+        normalizada (nombre del archivo) e index_spec.json, que se escribe el
+        último y "publica" la generación.
+        """
+        os.makedirs(db_path, exist_ok=True)
+        previous_generation = load_index_spec_and_generation(db_path)[1]
+        generation = uuid.uuid4().hex
+        self.chunks.set_generation(generation)
+
+        docstore_path = os.path.join(db_path, DOCSTORE_FILE)
+        tmp_docstore = docstore_path + ".tmp"
+        if os.path.exists(tmp_docstore):
+            os.remove(tmp_docstore)
+        self.chunks.save_to(tmp_docstore)
+        os.replace(tmp_docstore, docstore_path)
+
+        _save_normalized(db_path, self.index, generation)
+
+        index_path = os.path.join(db_path, INDEX_FILE)
+        faiss.write_index(self.index, index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+
+        save_index_spec(db_path, self.index_spec, self.index, generation)
+        _remove_stale_normalized(db_path, keep=(generation, previous_generation))
+
+    @property
+    def ntotal(self) -> int:
+        """Número de vectores en el índice."""
+        return self.index.ntotal
+
+    def _invalidate_filters(self):
+        """Descarta los ids precalculados y la matriz normalizada (tras modificar el vectorstore)."""
+        with self._filter_lock:
+            self._metadata_ids = None
+            self._resolved_filters.clear()
+        with self._normalized_lock:
+            self._normalized = None
+
+    def normalized_vectors(self, ids: Sequence[int]) -> np.ndarray:
+        """
+        Vectores normalizados (norma 1) de los ids dados, en el mismo orden.
+
+        Los vectorstores abiertos con load() usan normalized-<gen>.npy mapeado en
+        memoria (páginas compartidas entre workers, sin copia por proceso).
+        Los construidos o modificados en memoria (ingesta) la calculan aquí
+        la primera vez. Cada consulta es un único indexado NumPy, sin
+        reconstruir vector a vector desde FAISS.
+        """
+        with self._normalized_lock:
+            if self._normalized is None:
+                self._normalized = _normalized_matrix(self.index)
+            sorted_ids, matrix = self._normalized
+
+        rows = np.searchsorted(sorted_ids, np.asarray(ids, dtype=np.int64))
+        return matrix[rows]
+
+    def _resolve_filter(self, filter_key: Tuple) -> Tuple[np.ndarray, Optional[faiss.SearchParameters]]:
+        """
+        Ids que cumplen el filtro y, si son demasiados para fuerza bruta, los
+        SearchParameters con su IDSelectorBatch (construidos una sola vez).
+        """
+        with self._filter_lock:
+            if filter_key in self._resolved_filters:
+                self._resolved_filters.move_to_end(filter_key)
+                return self._resolved_filters[filter_key]
+
+            if self._metadata_ids is None:
+                self._metadata_ids = MetadataIdIndex(self.chunks.metadata_rows())
+            ids = self._metadata_ids.resolve(filter_key)
+
+            params = None
+            if len(ids) > METADATA_FILTER_CONFIG["brute_force_max_ids"]:
+                params = search_parameters(self.index_spec, faiss.IDSelectorBatch(ids))
+
+            self._resolved_filters[filter_key] = (ids, params)
+            if len(self._resolved_filters) > METADATA_FILTER_CONFIG["max_cached_filters"]:
+                self._resolved_filters.popitem(last=False)
+            return ids, params
+
+    def filter_ids(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Ids que cumplen el filtro (None = sin filtro)."""
+        filter_key = normalize_filters(filters)
+        return None if filter_key is None else self._resolve_filter(filter_key)[0]
+
+    def search(
+        self,
+        query_matrix: np.ndarray,
+        k: int,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Búsqueda k-NN batched; devuelve (distancias, ids), con -1 en huecos.
+
+        Con filtros solo se puntúan los vectores que los cumplen: distancia
+        exacta sobre esos vectores si son pocos, o búsqueda FAISS con un
+        IDSelectorBatch si son muchos (sin post-filtrar resultados).
+        """
+        query_matrix = np.ascontiguousarray(query_matrix, dtype=np.float32)
+        filter_key = normalize_filters(filters)
+        if filter_key is None:
+            return self.index.search(query_matrix, k)
+
+        ids, params = self._resolve_filter(filter_key)
+        if params is not None:
+            return self.index.search(query_matrix, k, params=params)
+        return self._exact_search(query_matrix, k, ids)
+
+    def _exact_search(self, query_matrix: np.ndarray, k: int, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """k-NN exacto (L2 al cuadrado, como FAISS) restringido a unos pocos ids."""
+        n_queries = len(query_matrix)
+        distances = np.full((n_queries, k), np.inf, dtype=np.float32)
+        labels = np.full((n_queries, k), -1, dtype=np.int64)
+        if not len(ids):
+            return distances, labels
+
+        vectors = self.reconstruct(ids)
+        all_distances = (
+            (query_matrix ** 2).sum(axis=1, keepdims=True)
+            - 2 * query_matrix @ vectors.T
+            + (vectors ** 2).sum(axis=1)
+        )
+        top = min(k, len(ids))
+        order = np.argsort(all_distances, axis=1, kind="stable")[:, :top]
+        distances[:, :top] = np.take_along_axis(all_distances, order, axis=1)
+        labels[:, :top] = ids[order]
+        return distances, labels
+
+    def reconstruct(self, ids: Sequence[int]) -> np.ndarray:
+        """Vectores almacenados para los ids dados, en el mismo orden."""
+        return np.vstack([self.index.reconstruct(int(i)) for i in ids])
+
+    def get_documents(self, ids: Sequence[int]) -> List[Optional[Document]]:
+        """Materializa los Documentos de los ids dados (lectura bajo demanda)."""
+        return self.chunks.get_documents(ids)
+
+    def lexical_search(self, query: str, k: int, filters: Optional[Dict[str, Any]] = None) -> List[int]:
+        """Ids de los k fragmentos con mayor puntuación BM25 para la consulta (y el filtro)."""
+        allowed_ids = self.filter_ids(filters)
+        return [chunk_id for chunk_id, _ in self.chunks.lexical_search(query, k, allowed_ids)]
+
+    def filter_new_documents(self, documents: List[Document]) -> List[Document]:
+        """
+        Descarta los fragmentos cuyo contenido ya está en el vectorstore
+        (o repetido dentro del propio lote). Se llama ANTES de vectorizar.
+        """
+        hashes = [content_hash(doc.page_content) for doc in documents]
+        seen = self.chunks.existing_hashes(hashes)
+
+        new_documents = []
+        for doc, doc_hash in zip(documents, hashes):
+            if doc_hash not in seen:
+                seen.add(doc_hash)
+                new_documents.append(doc)
+        return new_documents
+
+    def add_documents(self, documents: List[Document], vectors: np.ndarray) -> List[int]:
+        """
+        Añade fragmentos (y sus vectores) con ids nuevos.
+
+        Returns:
+            List[int]: Ids asignados
+        """
+        if not documents:
+            return []
+        start = self.chunks.next_id()
+        ids = np.arange(start, start + len(documents), dtype=np.int64)
+        self.index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), ids)
+        self.chunks.add_documents(ids, documents)
+        self._invalidate_filters()
+        return ids.tolist()
+
+    def remove_ids(self, ids: Sequence[int]):
+        """
+        Elimina vectores del índice. Flat e IVF borran en sitio; HNSW no admite
+        borrado, así que se reconstruye con los vectores restantes (sin volver
+        a calcular embeddings).
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        if self.index_spec["type"] == "hnsw":
+            all_ids, vectors = extract_vectors(self.index)
+            keep = ~np.isin(all_ids, ids)
+            self.index = build_index(vectors[keep], self.index_spec, ids=all_ids[keep])
+        else:
+            self.index.remove_ids(ids)
+        self._invalidate_filters()
+
+    def remove_source(self, source: str) -> int:
+        """
+        Elimina todos los fragmentos de una fuente (archivo borrado).
+
+        Returns:
+            int: Fragmentos eliminados
+        """
+        ids = self.chunks.ids_for_source(source)
+        self.remove_ids(ids)
+        self.chunks.delete_source(source)
+        if ids:
+            self.chunks.invalidate_sources_with_duplicates(source)
+        self._invalidate_filters()
+        return len(ids)
+
+    def update_source(self, source: str, documents: List[Document]) -> Tuple[List[Document], int, int]:
+        """
+        Sincroniza los fragmentos de una fuente modificada con su nueva versión.
+
+        - Fragmentos antiguos cuyo contenido ya no aparece: se eliminan
+        - Fragmentos con el mismo contenido: conservan id y vector (solo se
+          actualizan sus metadatos, p. ej. la página)
+        - Fragmentos nuevos: se devuelven para vectorizarlos (sin los que ya
+          estén indexados bajo otra fuente)
+
+        Returns:
+            Tuple[List[Document], int, int]: (fragmentos a vectorizar, conservados, eliminados)
+        """
+        hashes = [content_hash(doc.page_content) for doc in documents]
+        old_ids = self.chunks.hashes_for_source(source)
+
+        wanted = set(hashes)
+        stale_ids = [chunk_id for doc_hash, chunk_id in old_ids.items() if doc_hash not in wanted]
+        self.remove_ids(stale_ids)
+        self.chunks.delete_ids(stale_ids)
+        if stale_ids:
+            self.chunks.invalidate_sources_with_duplicates(source)
+
+        kept = {}
+        remaining = []
+        for doc, doc_hash in zip(documents, hashes):
+            if doc_hash in old_ids:
+                kept.setdefault(old_ids[doc_hash], doc)
+            else:
+                remaining.append(doc)
+        self.chunks.add_documents(list(kept.keys()), list(kept.values()))
+        self._invalidate_filters()  # Los conservados pueden haber cambiado de página
+
+        return self.filter_new_documents(remaining), len(kept), len(stale_ids)
+
+    def source_hash(self, source: str) -> Optional[str]:
+        """Hash del archivo con el que se ingirió la fuente."""
+        return self.chunks.get_source_hash(source)
+
+    def record_source(self, source: str, file_hash: str, duplicate_count: int = 0):
+        """Registra el archivo ingerido para una fuente (con su número de fragmentos actual)."""
+        chunk_count = len(self.chunks.ids_for_source(source))
+        self.chunks.record_source(source, file_hash, chunk_count, duplicate_count)
+
+    def close(self):
+        """Cierra el docstore."""
+        self.chunks.close()
+
+
+def migrate_legacy_vectorstore(db_path: str) -> LocalVectorStore:
+    """
+    Convierte una carpeta guardada con FAISS.save_local (index.faiss + index.pkl)
+    al formato actual. El pickle se conserva como index.pkl.bak.
+
+    Args:
+        db_path (str): Carpeta del vectorstore antiguo
+
+    Returns:
+        LocalVectorStore: Vectorstore migrado (en memoria)
+    """
+    print(f"🔄 Migrando '{db_path}' al formato docstore.db + índice mmap...")
+    legacy_path = os.path.join(db_path, LEGACY_DOCSTORE_FILE)
+
+    # index.pkl lo generó este mismo proyecto con FAISS.save_local
+    with open(legacy_path, "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    index = faiss.read_index(os.path.join(db_path, INDEX_FILE))
+    ids, vectors = extract_vectors(index)
+    documents = [docstore.search(index_to_docstore_id[int(i)]) for i in ids]
+
+    vectorstore = LocalVectorStore.build(documents, vectors, load_index_spec(db_path), ids=ids)
+    vectorstore.save(db_path)
+    os.replace(legacy_path, legacy_path + ".bak")
+
+    print(f"   ✅ {len(documents)} fragmentos migrados")
+    return vectorstore